@@ -1,7 +1,7 @@
 """ pyCBook
     Python Carbon Bookkeeping Model
 """
-from . import carbon, common, io
+import importlib
 
 __version__ = '0.0.5'
 
@@ -11,3 +11,10 @@ __all__ = [
     'io',
     'carbon'
 ]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.{}'.format(name), __name__)
+    raise AttributeError('module {} has no attribute {}'.format(__name__,
+                                                                    name))
@@ -0,0 +1,20 @@
+""" Command line entry of pyCBook
+
+    Usage:
+        python -m pyCBook run [-w workers] [--overwrite] config
+
+"""
+import sys
+
+from .common import log
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 2) or (sys.argv[1] != 'run'):
+        log.error('Usage: python -m pyCBook run [-w workers] [--overwrite] '
+                    'config')
+        sys.exit(1)
+    import runpy
+    sys.argv = [sys.argv[0]] + sys.argv[2:]
+    runpy.run_module('{}.run'.format(__package__), run_name='__main__',
+                        alter_sys=True)
@@ -3,8 +3,11 @@
     Args:
         -t (time): report time frame
         -i (lapse): reporting interval
+        -k (key): region or scenario column of a long format input
+        -w (workers): number of processes for batch processing
+        --cache: keep a binary copy of activity data for reloading
         --overwrite: overwrite or not
-        ori: origin
+        ori: origin, a folder or a long format table for batch processing
         para: parameter files location
         des: destination
 
@@ -14,13 +17,16 @@ import sys
 import argparse
 import numpy as np
 
-from .common import log, ordinal_to_doy, doy_to_ordinal
-from .io import csv2ndarray
+from functools import partial
+
+from .common import log, ordinal_to_doy, map_pool
+from .io import csv2ndarray, csv2table
 from .carbon import aggregated, pools
 from .common import constants as cons
 
 
-def area_carbon(ori, para, des, period=[2001, 2015], lapse=1, overwrite=False):
+def area_carbon(ori, para, des, period=[2001, 2015], lapse=1, overwrite=False,
+                cache=False):
     """ carbon bookkeeping on aggregated results
 
     Args:
@@ -30,6 +36,7 @@ def area_carbon(ori, para, des, period=[2001, 2015], lapse=1, overwrite=False):
         period (list, int): reporting time period, [start, end]
         laspe (int): reporting interval
         overwrite (bool): overwrite or not
+        cache (bool): keep a binary copy of activity data for reloading
 
     Returns:
         0: successful
@@ -57,51 +64,155 @@ def area_carbon(ori, para, des, period=[2001, 2015], lapse=1, overwrite=False):
     # reading input data
     log.info('Reading input...')
     try:
-        actvt = csv2ndarray(ori)
+        actvt = csv2table(ori, cache=cache)
     except:
         log.error('Failed to read activity data from: {}'.format(ori))
         return 2
 
-    # initialize output data
-    log.info('Initializing output...')
+    # bookkeeping
+    log.info('Start booking carbon...')
+    r = area_region(actvt, p, period, lapse)
+    if r is None:
+        log.error('Failed to process.')
+        return 3
+
+    # writing output
+    log.info('Writing output...')
     try:
-        if max(period) < cons.MAX_YEAR:
-            period2 = [doy_to_ordinal(x * 1000 + 1) for x in range(period[0],
-                        period[1] + 1, lapse)]
-        else:
-            period2 = range(doy_to_ordinal(period[0]),
-                            doy_to_ordinal(period[1]) + 1, lapse)
-        r = np.array([(ordinal_to_doy(x), 0.0, 0.0, 0.0, 0.0,
-                        0.0) for x in period2], dtype=cons.DTYPES2)
+        np.savetxt(des, r, delimiter=',', fmt=cons.FMT, header=cons.HEADER,
+                    comments='')
     except:
-        log.error('Failed to initialize output')
-        return 3
+        log.error('Failed to save results to {}'.format(des))
+        return 4
 
-    # bookkeeping
-    log.info('Start booking carbon...')
+    # done
+    log.info('Process completed.')
+    return 0
+
+
+def area_region(actvt, p, period=[2001, 2015], lapse=1):
+    """ carbon bookkeeping on activity data of a region
+
+    Args:
+        actvt (ndarray): activity data
+        p (list, ndarray): parameters
+        period (list, int): reporting time period, [start, end]
+        laspe (int): reporting interval
+
+    Returns:
+        r (ndarray): carbon report, None if failed
+
+    """
     try:
         r1 = aggregated(p, actvt)
         r2 = pools(r1.pools)
-        r3 = r2.report(period, lapse)
-        r['emission'] = r3['emission']
-        r['productivity'] = r3['productivity']
-        r['net'] = r3['net']
-        r['unreleased'] = r3['unreleased']
+        r = r2.report_interval([[period, lapse]])[0]
+        r['above'] = 0.0
     except:
-        log.error('Failed to process.')
+        return None
+    return r
+
+
+def area_groups(ori, key='NA', cache=False):
+    """ read activity data of many regions or scenarios
+
+    Args:
+        ori (str): folder of activity tables, or a long format table
+        key (str): region or scenario column of the long format table
+        cache (bool): keep a binary copy of activity data for reloading
+
+    Returns:
+        groups (list): [name, activity data] of each region
+
+    """
+    if os.path.isdir(ori):
+        return [[os.path.splitext(x)[0], csv2table(os.path.join(ori, x),
+                cache=cache)] for x in sorted(os.listdir(ori))
+                if x.endswith('.csv')]
+    actvt = csv2table(ori, cache=cache)
+    names, first = np.unique(actvt[key], return_index=True)
+    return [[str(x), actvt[actvt[key] == x]] for x in names[np.argsort(first)]]
+
+
+def area_batch(ori, para, des, period=[2001, 2015], lapse=1, overwrite=False,
+                key='NA', workers=1, cache=False):
+    """ carbon bookkeeping on aggregated results of many regions
+
+    Args:
+        ori (str): folder of activity tables, or a long format table
+        para (str): place to look for parameters
+        des (str): output file in long format
+        period (list, int): reporting time period, [start, end]
+        laspe (int): reporting interval
+        overwrite (bool): overwrite or not
+        key (str): region or scenario column of the long format table
+        workers (int): number of processes
+        cache (bool): keep a binary copy of activity data for reloading
+
+    Returns:
+        0: successful
+        1: error due to des
+        2: error reading inputs
+        3: error processin
+        4: error writing output
+
+    """
+    # check if output already exists
+    if (not overwrite) and os.path.isfile(des):
+        log.error('{} already exists.'.format(os.path.basename(des)))
+        return 1
+
+    # reading Parameters
+    log.info('Reading parameters...')
+    try:
+        p = [csv2ndarray(os.path.join(para, 'biomass.csv')),
+                csv2ndarray(os.path.join(para, 'flux.csv')),
+                csv2ndarray(os.path.join(para, 'product.csv'))]
+    except:
+        log.error('Failed to read parameter from {}'.format(para))
+        return 2
+
+    # reading input data
+    log.info('Reading input...')
+    try:
+        groups = area_groups(ori, key, cache)
+    except:
+        log.error('Failed to read activity data from: {}'.format(ori))
+        return 2
+    log.info('Found {} regions.'.format(len(groups)))
+
+    # bookkeeping
+    log.info('Start booking carbon...')
+    results = map_pool(partial(area_region, p=p, period=period, lapse=lapse),
+                        [x[1] for x in groups], workers, True)
+    count = 0
+    for name, r in zip([x[0] for x in groups], results):
+        if r is None:
+            log.warning('Failed to process region {}.'.format(name))
+        else:
+            log.info('Processed region {}'.format(name))
+            count += 1
+    if count == 0:
+        log.error('Failed to process anything.')
         return 3
 
     # writing output
     log.info('Writing output...')
     try:
-        np.savetxt(des, r, delimiter=',', fmt=cons.FMT, header=cons.HEADER,
-                    comments='')
+        with open(des, 'w') as f:
+            f.write('key,{}\n'.format(cons.HEADER))
+            for name, r in zip([x[0] for x in groups], results):
+                if r is not None:
+                    for x in r:
+                        f.write('{},{}\n'.format(name, cons.FMT % tuple(x)))
     except:
         log.error('Failed to save results to {}'.format(des))
         return 4
 
     # done
     log.info('Process completed.')
+    log.info('Successfully processed {}/{} regions.'.format(count,
+                                                            len(groups)))
     return 0
 
 
@@ -113,6 +224,14 @@ if __name__ == '__main__':
                         help='reporting period, [start, end]')
     parser.add_argument('-i', '--lapse', action='store', type=int,
                         dest='lapse', default=1, help='reporting interval')
+    parser.add_argument('-k', '--key', action='store', type=str,
+                        dest='key', default='NA',
+                        help='region or scenario column of long format input')
+    parser.add_argument('-w', '--workers', action='store', type=int,
+                        dest='workers', default=1,
+                        help='number of processes for batch processing')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep a binary copy of activity data or not')
     parser.add_argument('--overwrite', action='store_true',
                         help='overwrite or not')
     parser.add_argument('ori', default='./', help='origin')
@@ -128,9 +247,16 @@ if __name__ == '__main__':
     log.info('Reporting period {} to {}'.format(args.period[0],
                                                     args.period[1]))
     log.info('Reporting interval: {}.'.format(args.lapse))
+    if args.cache:
+        log.info('Caching activity data.')
     if args.overwrite:
         log.info('Overwriting old files.')
 
     # run function to bookkeeping
-    area_carbon(args.ori, args.para, args.des, args.period, args.lapse,
-                args.overwrite)
+    if os.path.isdir(args.ori) or (args.key != 'NA'):
+        log.info('Batch processing with {} workers.'.format(args.workers))
+        area_batch(args.ori, args.para, args.des, args.period, args.lapse,
+                    args.overwrite, args.key, args.workers, args.cache)
+    else:
+        area_carbon(args.ori, args.para, args.des, args.period, args.lapse,
+                    args.overwrite, args.cache)
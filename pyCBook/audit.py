@@ -0,0 +1,279 @@
+""" Module for auditing mass balance of bookkeeping results
+
+    Checks of each line, done on all pools of the line at once:
+        nan: biomass, coefficients or pixel size that is not a number
+        negative: negative biomass or pixel size, or negative reported stock
+                    or emission at the end date
+        transfer: biomass left in a main pool at a land cover change that
+                    is not passed on to product or burned pools
+        balance: initial biomass of main pools that does not show up as net
+                    flux, remaining stock or unreleased product at the end
+                    date of the pixel
+
+    Args:
+        -p (pattern): searching pattern
+        -T (tolerance): relative tolerance of transfer and balance checks
+        -R (recursive): recursive when seaching files
+        -M (manifest): use a cached manifest to locate files
+        --prefetch: number of lines to read ahead
+        --overwrite: overwrite or not
+        ori: origin
+        des: destination
+
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+from .common import log, get_files, get_int, prefetch
+from .io import yatsm2records, carbon2stable, pixel_index, store, is_store
+from .carbon import pools
+from .common import constants as cons
+
+
+CHECKS = ['nan', 'negative', 'transfer', 'balance']
+
+
+def violations(px, py, check, pid, value):
+    """ assemble violations of a check
+
+    Args:
+        px (ndarray): pixel x location of each violation
+        py (int): line number
+        check (str): name of the check
+        pid (ndarray): pool id of each violation, -1 for the whole pixel
+        value (ndarray): offending value or residual
+
+    Returns:
+        r (ndarray): violations
+
+    """
+    r = np.zeros(len(px), dtype=cons.AUDIT)
+    r['px'] = px
+    r['py'] = py
+    r['check'] = check
+    r['id'] = pid
+    r['value'] = value
+    return r
+
+
+def audit_line(records, stable, py, tolerance=cons.AUDIT_TOLERANCE):
+    """ check conservation of biomass of all pixels in a line
+
+    Args:
+        records (ndarray): carbon pools of the line, grouped by pixel
+        stable (ndarray): summary records of stable pixels
+        py (int): line number
+        tolerance (float): relative tolerance of transfer and balance checks
+
+    Returns:
+        r (ndarray): violations found in the line
+
+    """
+    r = [np.zeros(0, dtype=cons.AUDIT)]
+
+    # stable pixels only hold a constant pool
+    if len(stable) > 0:
+        _f = ~(np.isfinite(stable['biomass']) & np.isfinite(stable['psize']))
+        r.append(violations(stable['px'][_f], py, 'nan', 0,
+                            stable['biomass'][_f]))
+        _f = (stable['biomass'] < 0) | (stable['psize'] <= 0)
+        r.append(violations(stable['px'][_f], py, 'negative', 0,
+                            stable['biomass'][_f]))
+    if len(records) == 0:
+        return np.concatenate(r)
+
+    # pixel of each pool
+    index = pixel_index(records)
+    n = len(index)
+    gid = np.repeat(np.arange(n), index['stop'] - index['start'])
+    px = index['px']
+    b = records['biomass']
+    pid = records['id'].astype(np.int32)
+
+    # values that are not a number or negative, such pixels are not balanced
+    _f = ~(np.isfinite(b).all(axis=1) & np.isfinite(records['coef']).all(axis=1)
+            & np.isfinite(records['psize']))
+    r.append(violations(px[gid[_f]], py, 'nan', pid[_f], b[_f, 0]))
+    bad = np.bincount(gid[_f], minlength=n) > 0
+    _f = (b.min(axis=1) < 0) | (records['psize'] <= 0)
+    r.append(violations(px[gid[_f]], py, 'negative', pid[_f],
+                        b[_f].min(axis=1)))
+
+    # biomass left in a main pool goes to the pools created after it
+    above = records['subpool'] == cons.SPNAME[0]
+    main = np.nonzero(above)[0]
+    moved = np.bincount((np.cumsum(above) - 1)[~above], b[~above, 0],
+                        len(main))
+    changed = np.append(gid[main][1:] == gid[main][:-1], False)
+    residual = np.where(changed, b[main, 1], 0) - moved
+    _f = ((np.abs(residual) > tolerance * (1 + np.abs(b[main, 1]))) &
+            ~bad[gid[main]])
+    r.append(violations(px[gid[main][_f]], py, 'transfer', pid[main][_f],
+                        residual[_f]))
+
+    # initial biomass of main pools is net flux, stock or product at the end
+    t_end = np.zeros(n, dtype=np.int64)
+    np.maximum.at(t_end, gid, records['end'])
+    for t in np.unique(t_end[~bad]):
+        _p = (t_end == t) & ~bad
+        _r = _p[gid]
+        g2 = (np.cumsum(_p) - 1)[gid[_r]]
+        k = int(_p.sum())
+        report = pools(records[_r]).report_interval([[[int(t), int(t)], 1]],
+                                                    g2, k)[0]
+        report = report[:, 0]
+        inputs = np.bincount(g2[above[_r]], b[_r][above[_r], 0], k)
+        residual = (inputs - report['net'] - report['above'] -
+                    report['unreleased'])
+        _f = np.abs(residual) > tolerance * (1 + np.abs(inputs))
+        r.append(violations(px[_p][_f], py, 'balance', -1, residual[_f]))
+        lowest = np.minimum(np.minimum(report['above'], report['unreleased']),
+                            report['emission'])
+        _f = lowest < 0
+        r.append(violations(px[_p][_f], py, 'negative', -1, lowest[_f]))
+    return np.concatenate(r)
+
+
+def audit_carbon(pattern, ori, des, tolerance=cons.AUDIT_TOLERANCE,
+                    recursive=False, ahead=0, manifest=False, overwrite=False):
+    """ audit mass balance of bookkeeping results
+
+    Args:
+        pattern (str): searching pattern, e.g. carbon_r*.npz
+        ori (str): place to look for inputs
+        des (str): output file of violations
+        tolerance (float): relative tolerance of transfer and balance checks
+        recursive (bool): recursive when searching file, or not
+        ahead (int): number of lines to read ahead, 0 for no prefetch
+        manifest (bool): use a cached manifest to locate files or not
+        overwrite (bool): overwrite or not
+
+    Returns:
+        0: successful, no violation
+        1: error due to des
+        2: error when searching files
+        3: found no file
+        4: error processing
+        5: error writing output
+        6: found violations
+
+    """
+    # check if output already exists
+    if (not overwrite) and os.path.isfile(des):
+        log.error('{} already exists.'.format(os.path.basename(des)))
+        return 1
+
+    # locate files
+    log.info('Locating files...')
+    try:
+        if is_store(ori):
+            carbon_list = store(ori).files(pattern)
+        else:
+            carbon_list = get_files(ori, pattern, recursive, manifest)
+        n = len(carbon_list)
+    except:
+        log.error('Failed to search for {}'.format(pattern))
+        return 2
+    else:
+        if n == 0:
+            log.error('Found no {}'.format(pattern))
+            return 3
+        else:
+            log.info('Found {} files.'.format(n))
+
+    # read bookkeeping results of a line
+    def read_line(_line):
+        return [yatsm2records(os.path.join(_line[0], _line[1])),
+                carbon2stable(os.path.join(_line[0], _line[1]))]
+
+    # audit line by line
+    log.info('Start auditing...')
+    r = []
+    count = 0
+    for _line, inputs, error in prefetch(read_line, carbon_list, ahead):
+        try:
+            py = get_int(_line[1])[0]
+            if error is not None:
+                raise error
+            r.append(audit_line(inputs[0], inputs[1], py, tolerance))
+            if len(r[-1]) > 0:
+                log.warning('Found {} violations in line {}.'.format(
+                                                            len(r[-1]), py))
+            else:
+                log.info('Processed line {}'.format(py))
+            count += 1
+        except:
+            log.warning('Failed to process line {}.'.format(_line[1]))
+            continue
+
+    # see if anything is processed
+    if count == 0:
+        log.error('Nothing is processed.')
+        return 4
+
+    # write output
+    log.info('Writing output...')
+    try:
+        r = np.concatenate(r)
+        np.savetxt(des, r, delimiter=',', fmt=cons.AUDIT_FMT,
+                    header=','.join(r.dtype.names), comments='')
+    except:
+        log.error('Failed to write output to {}'.format(des))
+        return 5
+
+    # done
+    log.info('Process completed.')
+    log.info('Successfully processed {}/{} files.'.format(count, n))
+    if len(r) > 0:
+        for check in CHECKS:
+            if (r['check'] == check).any():
+                log.warning('{} {} violations.'.format(
+                                        (r['check'] == check).sum(), check))
+        return 6
+    log.info('No violation found.')
+    return 0
+
+
+if __name__ == '__main__':
+    # parse options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--pattern', action='store', type=str,
+                        dest='pattern', default='carbon_r*.npz',
+                        help='searching pattern')
+    parser.add_argument('-T', '--tolerance', action='store', type=float,
+                        dest='tolerance', default=cons.AUDIT_TOLERANCE,
+                        help='relative tolerance of balance checks')
+    parser.add_argument('--prefetch', action='store', type=int,
+                        dest='ahead', default=0,
+                        help='number of lines to read ahead')
+    parser.add_argument('-M', '--manifest', action='store_true',
+                        help='use a cached manifest to locate files or not')
+    parser.add_argument('-R', '--recursive', action='store_true',
+                        help='recursive or not')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite or not')
+    parser.add_argument('ori', default='./', help='origin')
+    parser.add_argument('des', default='./', help='destination')
+    args = parser.parse_args()
+
+    # print logs
+    log.info('Start auditing bookkeeping results...')
+    log.info('Tolerance {}.'.format(args.tolerance))
+    log.info('Looking for {}'.format(args.pattern))
+    log.info('In {}'.format(args.ori))
+    log.info('Saving as {}'.format(args.des))
+    if args.ahead > 0:
+        log.info('Reading {} lines ahead.'.format(args.ahead))
+    if args.manifest:
+        log.info('Locating files with manifest.')
+    if args.recursive:
+        log.info('Recursive seaching.')
+    if args.overwrite:
+        log.info('Overwriting old files.')
+
+    # run function to audit
+    sys.exit(audit_carbon(args.pattern, args.ori, args.des, args.tolerance,
+                            args.recursive, args.ahead, args.manifest,
+                            args.overwrite))
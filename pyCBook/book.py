@@ -6,6 +6,19 @@
         -m (mask): mask image
         -b (batch): batch process, thisjob and totaljob
         -R (recursive): recursive when seaching files
+        -M (manifest): use a cached manifest to locate files
+        -e (end): force bookkeeping to end on this date
+        -r (resume): previous results to resume from
+        -s (stable): summarize stable pixels or not
+        --store: save results in a consolidated store or not
+        -c (cache): place to cache slim YATSM records
+        --bundle: inputs are bundles of many lines
+        --matrix: place to save land cover transition matrices
+        --retry-failed: only redo lines recorded as failed by this job
+        --timeout: give up a line after this many seconds
+        --compact: drop rewritten records from the store when done
+        --prefetch: number of lines to read ahead
+        --write-behind: number of lines to write behind
         --overwrite: overwrite or not
         ori: origin
         para: parameter files location
@@ -17,13 +30,21 @@ import sys
 import argparse
 import numpy as np
 
-from .common import log, get_files, manage_batch, get_int
-from .io import yatsm2pixels, csv2ndarray, image2array
-from .carbon import carbon
+from .common import (log, get_files, manage_batch, get_int, prefetch, writer,
+                        line_timeout, read_failures, failures)
+from .io import (yatsm2pixels, csv2ndarray, carbon2state,
+                    carbon2stable, stable2records, store, is_store,
+                    pixel_index, bundle2files)
+from .carbon import carbon, transition_matrix
+from .common import constants as cons
 
 
 def book_carbon(pattern, ori, para, des, img='NA', mask='NA', overwrite=False,
-                recursive=False, batch=[1,1]):
+                recursive=False, batch=[1,1], force_end=cons.FORCE_END,
+                resume='NA', stable=False, store_des=False, ahead=0,
+                behind=0, cache='NA', bundle=False, manifest=False,
+                lines=None, matrix='NA', retry='NA', retry_failed=False,
+                timeout=0, compact=False):
     """ carbon bookkeeping on YATSM results
 
     Args:
@@ -36,6 +57,23 @@ def book_carbon(pattern, ori, para, des, img='NA', mask='NA', overwrite=False,
         overwrite (bool): overwrite or not
         recursive (bool): recursive when searching file, or not
         batch (list, int): batch processing, [thisjob, totaljob]
+        force_end (int): force bookkeeping to end on this date
+        resume (str): place to look for previous results to resume from
+        stable (bool): save stable pixels as summary records or not
+        store_des (bool): save results in a consolidated store at des or not
+        ahead (int): number of lines to read ahead, 0 for no prefetch
+        behind (int): number of lines to write behind, 0 for direct write
+        cache (str): place to cache slim YATSM records, NA for no cache
+        bundle (bool): inputs are bundles of many lines or not
+        manifest (bool): use a cached manifest to locate files or not
+        lines (list, int): only process these lines, None for all
+        matrix (str): place to save transition matrices of the whole history,
+                        resumed pixels included, NA for none
+        retry (str): file to record failed lines in, NA for one in des
+        retry_failed (bool): only redo lines recorded in the retry file
+        timeout (int): give up a line after this many seconds, 0 for never
+        compact (bool): drop records of rewritten lines from the store at
+                        des when done, only when no other job uses it
 
     Returns:
         0: successful
@@ -54,11 +92,49 @@ def book_carbon(pattern, ori, para, des, img='NA', mask='NA', overwrite=False,
         except:
             log.error('Cannot create output folder {}'.format(des))
             return 1
+    if (matrix != 'NA') and (not os.path.exists(matrix)):
+        try:
+            os.makedirs(matrix)
+        except:
+            log.error('Cannot create output folder {}'.format(matrix))
+            return 1
+    _store = None
+    done = set()
+    if store_des:
+        try:
+            _store = store(des)
+            done = set(_store.lines())
+        except:
+            log.error('Cannot open store {}'.format(des))
+            return 1
+
+    # failed lines are recorded in a retry file of each job
+    if retry == 'NA':
+        retry = os.path.join(des, cons.RETRY_FILE.format(batch[0], batch[1]))
+    retries = failures(retry)
+    if retry_failed:
+        try:
+            _lines = set([x['line'] for x in read_failures(retry)])
+        except:
+            log.error('Failed to read retry file {}'.format(retry))
+            return 2
+        if len(_lines) == 0:
+            log.info('No failed line to retry.')
+            return 0
+        lines = _lines if lines is None else _lines & set(lines)
+        overwrite = True
+        log.info('Retrying {} failed lines.'.format(len(lines)))
 
     # locate files
     log.info('Locating files...')
     try:
-        yatsm_list = get_files(ori, pattern, recursive)
+        yatsm_list = get_files(ori, pattern, recursive, manifest)
+        if bundle:
+            yatsm_list = [x for y in yatsm_list
+                            for x in bundle2files(os.path.join(y[0], y[1]))]
+        if lines is not None:
+            lines = set(lines)
+            yatsm_list = [x for x in yatsm_list if get_int(x[1])[0] in lines]
         n = len(yatsm_list)
     except:
         log.error('Failed to search for {}'.format(pattern))
@@ -68,10 +144,10 @@ def book_carbon(pattern, ori, para, des, img='NA', mask='NA', overwrite=False,
             log.error('Found no {}'.format(pattern))
             return 3
         else:
-            log.info('Found {} files.'.format(n))
+            log.info('Found {} {}.'.format(n, 'lines' if bundle else 'files'))
 
-    # handle batch processing
-    if batch[1] > 1:
+    # handle batch processing, lines to retry belong to this job already
+    if (batch[1] > 1) and (not retry_failed):
         log.info('Handling batch process...')
         yatsm_list = manage_batch(yatsm_list, batch[0], batch[1])
         n = len(yatsm_list)
@@ -87,7 +163,9 @@ def book_carbon(pattern, ori, para, des, img='NA', mask='NA', overwrite=False,
         log.error('Failed to read parameter from {}'.format(para))
         return 4
 
-    # reading input image
+    # reading input image, gdal is only loaded when needed
+    if (img != 'NA') or (mask != 'NA'):
+        from .io import image2array
     if img != 'NA':
         log.info('Reading biomass base image...')
         try:
@@ -107,53 +185,117 @@ def book_carbon(pattern, ori, para, des, img='NA', mask='NA', overwrite=False,
     else:
         mask3 = 0
 
+    # read inputs of a line, None if the line is skipped
+    def read_line(yatsm):
+        py = get_int(yatsm[1])[0]
+        if (not overwrite) and line_exists(des, py, _store, done):
+            return None
+        if (mask != 'NA') and (min(mask2[py, :]) != 0):
+            return None
+        return [yatsm2pixels(os.path.join(yatsm[0], yatsm[1]), cache=cache),
+                resume_line(resume, py)]
+
     # loop through all files
     count = 0
+    output = writer(behind)
     log.info('Start booking carbon...')
-    for yatsm in yatsm_list:
+    for yatsm, inputs, error in prefetch(read_line, yatsm_list, ahead):
         try:
             records = []
+            states = []
+            summaries = []
+            changes = []
             py = get_int(yatsm[1])[0]
             px = -1
-            if (not overwrite) and os.path.isfile(os.path.join(des,
-                                                'carbon_r{}.npz'.format(py))):
+            if (not overwrite) and line_exists(des, py, _store, done):
                 log.warning('Line {} already exists.'.format(py))
                 continue
-            if mask != 'NA':
-                mask3 = min(mask2[py, :])
-            mcount = 0
-            if mask3 == 0:
-                pixels = yatsm2pixels(os.path.join(yatsm[0], yatsm[1]))
-                if len(pixels) > 0:
-                    for pixel in pixels:
-                        px = pixel[0]['px']
-                        if mask != 'NA':
-                            mask3 = mask2[py, px]
-                        if mask3 == 0:
-                            if img != 'NA':
-                                se_biomass = biomass[py, px]
-                            carbon_pixel = carbon(p, pixel, se_biomass)
-                            records.extend(carbon_pixel.pools)
+            if error is not None:
+                raise error
+            with line_timeout(timeout):
+                rcount = 0
+                if mask != 'NA':
+                    mask3 = min(mask2[py, :])
+                mcount = 0
+                if mask3 == 0:
+                    pixels, last = inputs
+                    if len(pixels) > 0:
+                        for pixel in pixels:
+                            px = pixel[0]['px']
+                            if mask != 'NA':
+                                mask3 = mask2[py, px]
+                            if mask3 == 0:
+                                if img != 'NA':
+                                    se_biomass = biomass[py, px]
+                                state = None
+                                if px in last:
+                                    state = last[px]
+                                carbon_pixel = carbon(p, pixel, se_biomass,
+                                                        force_end=force_end,
+                                                        state=state)
+                                if stable and carbon_pixel.stable:
+                                    summaries.extend(carbon_pixel.get_stable())
+                                else:
+                                    records.extend(carbon_pixel.pools)
+                                if len(carbon_pixel.pools) > 0:
+                                    states.extend(carbon_pixel.get_state())
+                                    rcount += carbon_pixel.resumed
+                                changes.extend([x + [carbon_pixel.pixel_size]
+                                                for x in carbon_pixel.changes])
+                            else:
+                                mcount += 1
+                        if len(records) + len(summaries) > 0:
+                            if len(records) > 0:
+                                records = np.array(records)
+                            if len(summaries) > 0:
+                                log.info('Line {} summarized {} stable'.format(
+                                                        py, len(summaries)))
+                            if rcount > 0:
+                                log.info('Line {} resumed {} pixels'.format(
+                                                                py, rcount))
+                            if mcount > 0:
+                                log.info('Line {} processed {} masked'.format(
+                                                                py, mcount))
+                            else:
+                                log.info('Line {} processed'.format(py))
                         else:
-                            mcount += 1
-                    if len(records) > 0:
-                        records = np.array(records)
-                        if mcount > 0:
-                            log.info('Line {} processed {} masked'.format(py, mcount))
-                        else:
-                            log.info('Line {} processed'.format(py))
+                            log.warning('Line {} no pixel {} masked.'.format(
+                                                                py, mcount))
                     else:
-                        log.warning('Line {} no pixel {} masked.'.format(py, mcount))
+                        log.warning('Line {} no pixel.'.format(py))
                 else:
-                    log.warning('Line {} no pixel.'.format(py))
-            else:
-                log.warning('Line {} all masked.'.format(py))
-            np.savez(os.path.join(des,'carbon_r{}.npz'.format(py)), records)
+                    log.warning('Line {} all masked.'.format(py))
+            output.put(py, save_line, des, py, records, states, summaries,
+                        _store, matrix, changes)
             count += 1
-        except:
+        except Exception as e:
             log.warning('Failed to process line {} pixel {}.'.format(py, px))
+            retries.add(py, px, e, yatsm[1])
             continue
 
+    # wait for outputs to be written
+    failed = output.close()
+    for py, error in failed:
+        log.warning('Failed to write line {}.'.format(py))
+        retries.add(py, -1, error)
+    count -= len(failed)
+
+    # record failed lines to be retried
+    try:
+        if retries.save() > 0:
+            log.warning('{} failed lines recorded in {}'.format(
+                                                len(retries.lines()), retry))
+    except:
+        log.warning('Failed to write retry file {}'.format(retry))
+
+    # rewritten lines leave old records in the store
+    if compact and (_store is not None):
+        try:
+            log.info('Compacted store, freed {} bytes.'.format(
+                                                        _store.compact()))
+        except:
+            log.warning('Failed to compact store {}'.format(des))
+
     # nothing is processed, all failed
     if count == 0:
         log.error('Failed to process anything.')
@@ -165,6 +307,98 @@ def book_carbon(pattern, ori, para, des, img='NA', mask='NA', overwrite=False,
     return 0
 
 
+def line_exists(des, py, _store=None, done=None):
+    """ check if bookkeeping result of a line already exists
+
+    Args:
+        des (str): place to save outputs
+        py (int): line number
+        _store (store): consolidated store at des, None for npz files
+        done (set): lines already in the store
+
+    Returns:
+        exists (bool): exists or not
+
+    """
+    if _store is not None:
+        return py in done
+    return os.path.isfile(os.path.join(des, 'carbon_r{}.npz'.format(py)))
+
+
+def save_line(des, py, records, states, summaries, _store=None, matrix='NA',
+                changes=[]):
+    """ save bookkeeping result of a line
+
+    Args:
+        des (str): place to save outputs
+        py (int): line number
+        records (list): pools of the line
+        states (list): terminal states of the line
+        summaries (list): stable summaries of the line
+        _store (store): consolidated store at des, None for npz files
+        matrix (str): place to save transition matrix, NA for none
+        changes (list): from, to, date and area of each transition
+
+    Returns:
+        0: successful
+
+    """
+    if matrix != 'NA':
+        np.savez(os.path.join(matrix, 'transition_r{}.npz'.format(py)),
+                    transition_matrix(changes))
+    index = pixel_index(np.array(records, dtype=cons.DTYPES))
+    if _store is not None:
+        _store.write_line(py, [[np.array(records, dtype=cons.DTYPES), 0],
+                                [np.array(states, dtype=cons.STATE), 1],
+                                [np.array(summaries, dtype=cons.STABLE), 2],
+                                [index, 3]])
+    else:
+        np.savez(os.path.join(des,'carbon_r{}.npz'.format(py)), records,
+                    state=np.array(states, dtype=cons.STATE),
+                    stable=np.array(summaries, dtype=cons.STABLE),
+                    index=index)
+    return 0
+
+
+def resume_line(resume, py):
+    """ read previous bookkeeping result of a line to resume from
+
+    Args:
+        resume (str): place to look for previous results, NA for none
+        py (int): line number
+
+    Returns:
+        last (dict): [pools, state] of each pixel that can be resumed
+
+    """
+    last = {}
+    if resume == 'NA':
+        return last
+    _file = os.path.join(resume, 'carbon_r{}.npz'.format(py))
+    if (not is_store(resume)) and (not os.path.isfile(_file)):
+        return last
+    try:
+        records, state = carbon2state(_file)
+    except KeyError:
+        return last
+    summaries = carbon2stable(_file)
+    if len(summaries) > 0:
+        if len(records) > 0:
+            records = np.concatenate([records, stable2records(summaries)])
+        else:
+            records = stable2records(summaries)
+        records = records[np.argsort(records['px'], kind='mergesort')]
+    if (len(records) == 0) or (len(state) == 0):
+        return last
+    state = dict([(x['px'], x) for x in state])
+    pxs, index = np.unique(records['px'], return_index=True)
+    index = list(index) + [len(records)]
+    for i, px in enumerate(pxs):
+        if px in state:
+            last[px] = [records[index[i]:index[i + 1]], state[px]]
+    return last
+
+
 if __name__ == '__main__':
     # parse options
     parser = argparse.ArgumentParser()
@@ -178,6 +412,39 @@ if __name__ == '__main__':
                         dest='img', default='NA', help='biomass base image')
     parser.add_argument('-m', '--mask', action='store', type=str,
                         dest='mask', default='NA', help='mask image')
+    parser.add_argument('-e', '--end', action='store', type=int,
+                        dest='end', default=cons.FORCE_END,
+                        help='force bookkeeping to end on this date')
+    parser.add_argument('-r', '--resume', action='store', type=str,
+                        dest='resume', default='NA',
+                        help='previous results to resume from')
+    parser.add_argument('-s', '--stable', action='store_true',
+                        help='summarize stable pixels or not')
+    parser.add_argument('--store', action='store_true',
+                        help='save results in a consolidated store or not')
+    parser.add_argument('-c', '--cache', action='store', type=str,
+                        dest='cache', default='NA',
+                        help='place to cache slim YATSM records')
+    parser.add_argument('--bundle', action='store_true',
+                        help='inputs are bundles of many lines or not')
+    parser.add_argument('--matrix', action='store', type=str, dest='matrix',
+                        default='NA', help='place to save transition matrices')
+    parser.add_argument('--retry-failed', action='store_true',
+                        dest='retry_failed',
+                        help='only redo lines recorded as failed or not')
+    parser.add_argument('--timeout', action='store', type=int,
+                        dest='timeout', default=0,
+                        help='give up a line after this many seconds')
+    parser.add_argument('--compact', action='store_true',
+                        help='drop rewritten records from the store or not')
+    parser.add_argument('--prefetch', action='store', type=int,
+                        dest='ahead', default=0,
+                        help='number of lines to read ahead')
+    parser.add_argument('--write-behind', action='store', type=int,
+                        dest='behind', default=0,
+                        help='number of lines to write behind')
+    parser.add_argument('-M', '--manifest', action='store_true',
+                        help='use a cached manifest to locate files or not')
     parser.add_argument('-R', '--recursive', action='store_true',
                         help='recursive or not')
     parser.add_argument('--overwrite', action='store_true',
@@ -204,6 +471,31 @@ if __name__ == '__main__':
         log.info('Biomass base image: {}'.format(args.img))
     if args.mask != 'NA':
         log.info('Mask image: {}'.format(args.mask))
+    log.info('Booking until {}'.format(args.end))
+    if args.resume != 'NA':
+        log.info('Resuming from {}'.format(args.resume))
+    if args.stable:
+        log.info('Summarizing stable pixels.')
+    if args.store:
+        log.info('Saving in consolidated store.')
+    if args.cache != 'NA':
+        log.info('Caching slim records in {}'.format(args.cache))
+    if args.bundle:
+        log.info('Reading lines from bundles.')
+    if args.matrix != 'NA':
+        log.info('Saving transition matrices in {}'.format(args.matrix))
+    if args.retry_failed:
+        log.info('Retrying failed lines.')
+    if args.timeout > 0:
+        log.info('Giving up lines after {} seconds.'.format(args.timeout))
+    if args.compact:
+        log.info('Compacting store when done.')
+    if args.ahead > 0:
+        log.info('Reading {} lines ahead.'.format(args.ahead))
+    if args.behind > 0:
+        log.info('Writing {} lines behind.'.format(args.behind))
+    if args.manifest:
+        log.info('Locating files with manifest.')
     if args.recursive:
         log.info('Recursive seaching.')
     if args.overwrite:
@@ -211,4 +503,8 @@ if __name__ == '__main__':
 
     # run function to bookkeeping
     book_carbon(args.pattern, args.ori, args.para, args.des, args.img,
-                args.mask, args.overwrite, args.recursive, args.batch)
+                args.mask, args.overwrite, args.recursive, args.batch,
+                args.end, args.resume, args.stable, args.store, args.ahead,
+                args.behind, args.cache, args.bundle, args.manifest, None,
+                args.matrix, 'NA', args.retry_failed, args.timeout,
+                args.compact)
@@ -1,6 +1,7 @@
 """ Modules for carbon models
 """
-from .processing import get_biomass, get_flux, run_flux
+from .processing import (get_biomass, get_flux, run_flux, run_flux_array,
+                            eval_stable, transition_matrix, sum_matrices)
 from .track import carbon, pools, aggregated
 
 __all__ = [
@@ -8,6 +9,10 @@ __all__ = [
     'get_biomass',
     'get_flux',
     'run_flux',
+    'run_flux_array',
+    'eval_stable',
+    'transition_matrix',
+    'sum_matrices',
     'pools',
     'aggregated'
 ]
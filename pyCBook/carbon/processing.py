@@ -1,6 +1,7 @@
 """ Module for processing when tracking carbon
 """
 import math
+import numpy as np
 
 from ..common import constants as cons
 
@@ -69,3 +70,109 @@ def run_flux(y1, x1, x2, func, coef, scale_factor):
     if y2 < 0:
         y2 = 0.0
     return y2 * scale_factor
+
+
+def run_flux_array(y1, x1, x2, func, coef, scale_factor):
+    """ calculate fluxes of many pools at once
+
+    Args:
+        y1 (ndarray): initial biomass
+        x1 (ndarray): start time
+        x2 (ndarray): end time
+        func (ndarray): decay function
+        coef (ndarray): decay function coefs, two columns
+        scale_factor (ndarray): scale factor
+
+    Returns:
+        y2 (ndarray): biomass at x2
+
+    """
+    dx = np.asarray(x2, dtype=np.float64) - np.asarray(x1, dtype=np.float64)
+    y1, dx, func, scale_factor = np.broadcast_arrays(
+                                    np.asarray(y1, dtype=np.float64), dx,
+                                    np.asarray(func),
+                                    np.asarray(scale_factor, dtype=np.float64))
+    coef = np.broadcast_to(np.asarray(coef, dtype=np.float64),
+                            y1.shape + (2, ))
+    c1 = coef[..., 0]
+    c2 = coef[..., 1]
+    y = y1 / scale_factor
+    y2 = np.zeros(y.shape)
+    _f = func == 'linear'
+    y2[_f] = y[_f] * (1 - dx[_f] / (cons.DIY / c1[_f]))
+    _f = func == 'logdc'
+    y2[_f] = y[_f] * np.exp(-dx[_f] / (cons.DIY / c1[_f]))
+    _f = func == 'const'
+    y2[_f] = y[_f] + c1[_f] * dx[_f] / cons.DIY
+    _f = func == 'log'
+    y2[_f] = c1[_f] * np.log(np.exp((y[_f] - c2[_f]) / c1[_f]) +
+                                dx[_f] / cons.DIY) + c2[_f]
+    _f = func == 'none'
+    y2[_f] = y[_f]
+    y2[y2 < 0] = 0.0
+    y2 = y2 * scale_factor
+    return np.where(dx == 0, y1, y2)
+
+
+def transition_matrix(changes):
+    """ count land cover transitions by classes and year
+
+    Args:
+        changes (list): from, to, date and area of each transition
+
+    Returns:
+        matrix (ndarray): count and area of each from, to and year
+
+    """
+    matrix = np.zeros(len(changes), dtype=cons.TRANSITION)
+    if len(changes) > 0:
+        changes = np.array(changes, dtype=np.float64)
+        matrix['from'] = changes[:, 0]
+        matrix['to'] = changes[:, 1]
+        matrix['year'] = changes[:, 2] // 1000
+        matrix['count'] = 1
+        matrix['area'] = changes[:, 3]
+    return sum_matrices([matrix])
+
+
+def sum_matrices(matrices):
+    """ sum up transition matrices
+
+    Args:
+        matrices (list, ndarray): transition matrices in a fixed order
+
+    Returns:
+        matrix (ndarray): total count and area of each from, to and year
+
+    """
+    if len(matrices) == 0:
+        return np.zeros(0, dtype=cons.TRANSITION)
+    m = np.concatenate(matrices)
+    key = ((m['from'].astype(np.int64) * 65536 + m['to']) * cons.MAX_YEAR +
+            m['year'])
+    key, inv = np.unique(key, return_inverse=True)
+    matrix = np.zeros(len(key), dtype=cons.TRANSITION)
+    matrix['from'] = key // cons.MAX_YEAR // 65536
+    matrix['to'] = key // cons.MAX_YEAR % 65536
+    matrix['year'] = key % cons.MAX_YEAR
+    matrix['count'] = np.bincount(inv, m['count'], len(key))
+    matrix['area'] = np.bincount(inv, m['area'], len(key))
+    return matrix
+
+
+def eval_stable(stable, t):
+    """ calculate total biomass and fluxes of stable pixels at date t
+
+    Args:
+        stable (ndarray): summary records of stable pixels
+        t (int): date
+
+    Returns:
+        r (ndarray): total biomass and fluxes of each stable pixel
+
+    """
+    r = np.zeros(len(stable), dtype=cons.DTYPES2)
+    r['date'] = t
+    active = (stable['start'] <= t) & (stable['end'] >= t)
+    r['above'][active] = stable['biomass'][active]
+    return r
@@ -4,8 +4,8 @@ from __future__ import division
 
 import numpy as np
 
-from . import get_flux, get_biomass, run_flux
-from ..common import doy_to_ordinal, ordinal_to_doy
+from . import get_flux, get_biomass, run_flux, run_flux_array
+from ..common import doy_to_ordinal, ordinal_to_doy, get_period
 from ..common import constants as cons
 
 class carbon:
@@ -16,6 +16,9 @@ class carbon:
         pixel (ndarray): yatsm result for a pixel
         se_biomass (float): spatially explicit initial biomass
         psize (float): size of the pixel
+        force_end (int): force bookkeeping to end on this date
+        state (list, ndarray): pools and terminal state of a previous run to
+                                resume from, [pools, state]
 
     Attributes:
         dtypes (dtype): template dtype for a carbon pool
@@ -40,9 +43,18 @@ class carbon:
         p: parameters
         px: pixel x coordinate
         py: pixel y coordinate
+        exact: whether the last segment reaches force_end without a gap
+        resumed: whether tracking is resumed from a previous run
+        stable: whether the pixel is a single constant pool
+        changes: land cover transitions of the whole history, including
+                    the ones rebuilt from a resumed run, [from, to, date]
 
     Functions:
         assess_pixel (): track carbon change of a pixel
+        resume_pixel (pixel, last, state): resume tracking from a previous run
+        assess_segments (pixel, last_class): track carbon change of segments
+        get_state (): terminal state of the pixel
+        get_stable (): summary record of a stable pixel
         assess_ts (ts): track carbon change of a time series segment
         new_main_pool (ts): create a new main pool based on a ts segment
         removal (): perform removal on current main pool
@@ -62,7 +74,9 @@ class carbon:
     force_start = doy_to_ordinal(cons.FORCE_START)
     force_end = doy_to_ordinal(cons.FORCE_END)
 
-    def __init__(self, para, pixel, se_biomass=-1.0, psize=(0.3*0.3)):
+    def __init__(self, para, pixel, se_biomass=-1.0, psize=(0.3*0.3),
+                    force_end=cons.FORCE_END, state=None):
+        self.force_end = doy_to_ordinal(force_end)
         self.pixel_size = psize
         self.scale_factor2 = self.scale_factor * self.pixel_size
         if se_biomass >= 0:
@@ -77,7 +91,21 @@ class carbon:
         self.py = pixel[0]['py']
         self.regrow_biomass = cons.REGROW_BIOMASS * self.scale_factor2
         self.forest_min = cons.FOREST_MIN * self.scale_factor2
-        self.assess_pixel(pixel)
+        self.exact = False
+        self.resumed = False
+        self.changes = []
+        if state is None:
+            self.assess_pixel(pixel)
+        elif self.resume_pixel(pixel, state[0], state[1]):
+            self.resumed = True
+        else:
+            self.pools = []
+            self.lc = []
+            self.pid = -1
+            self.changes = []
+            self.assess_pixel(pixel)
+        self.stable = ((len(self.pools) == 1) and
+                        (self.pools[0]['func'] == 'none'))
 
     def assess_pixel(self, pixel):
         if len(pixel[pixel['start'] > self.force_end]):
@@ -91,20 +119,69 @@ class carbon:
         else:
             if pixel[0]['start'] < self.force_start:
                 pixel[0]['start'] = self.force_start
-            if (pixel[-1]['break'] == 0) | (pixel[-1]['break'] >= self.force_end):
-                pixel[-1]['end'] = self.force_end
-                pixel[-1]['break'] = 0
-            else:
-                pixel = np.append(pixel, pixel[-1])
-                pixel[-1]['start'] = pixel[-2]['end'] + 1
-                pixel[-1]['end'] = self.force_end
-                pixel[-1]['break'] = 0
-                pixel[-1]['class'] = last_class
-            for i, x in enumerate(pixel):
-                if i > 0:
-                    x['start'] = doy_to_ordinal(self.pools[self.pmain]['end'])+1
-                self.assess_ts(x)
-            self.pools = np.array(self.pools)
+            self.assess_segments(pixel, last_class)
+
+    def resume_pixel(self, pixel, last, state):
+        end = doy_to_ordinal(state['end'])
+        if (not state['exact']) | (len(last) == 0) | (end > self.force_end):
+            return False
+        if len(pixel[pixel['start'] > self.force_end]):
+            last_class = pixel[pixel['start'] > self.force_end]['class'][0]
+        else:
+            last_class = self.unclassified
+        pixel = pixel[pixel['start'] <= self.force_end]
+        if len(pixel[pixel['start'] <= end]) == 0:
+            return False
+        pixel = pixel[(len(pixel[pixel['start'] <= end]) - 1):]
+        self.pools = list(np.array(last))
+        self.pid = len(self.pools) - 1
+        self.pmain = int(state['main'])
+        main = last[last['subpool'] == self.spname[0]]
+        self.lc = list(main['class'])
+        # transitions already booked, each later main pool starts with one
+        self.changes = [[main['class'][i - 1], main['class'][i],
+                            main['start'][i]] for i in range(1, len(main))]
+        if ((pixel[0]['class'] != self.lc[-1]) &
+            ((self.lc[-1] != self.forest[1]) |
+            (pixel[0]['class'] != self.forest[0]))):
+            return False
+        if (pixel[0]['break'] > 0) & (pixel[0]['break'] < end):
+            return False
+        for x in self.pools:
+            if (x['end'] == state['end']) & (x['id'] != self.pmain):
+                x['end'] = ordinal_to_doy(self.force_end)
+                if x['pool'] == self.pname[1]:
+                    self.emission(x['id'])
+        self.assess_segments(pixel, last_class)
+        return True
+
+    def assess_segments(self, pixel, last_class):
+        if (pixel[-1]['break'] == 0) | (pixel[-1]['break'] >= self.force_end):
+            pixel[-1]['end'] = self.force_end
+            pixel[-1]['break'] = 0
+            self.exact = True
+        else:
+            pixel = np.append(pixel, pixel[-1])
+            pixel[-1]['start'] = pixel[-2]['end'] + 1
+            pixel[-1]['end'] = self.force_end
+            pixel[-1]['break'] = 0
+            pixel[-1]['class'] = last_class
+        for i, x in enumerate(pixel):
+            if i > 0:
+                x['start'] = doy_to_ordinal(self.pools[self.pmain]['end'])+1
+            self.assess_ts(x)
+        self.pools = np.array(self.pools)
+
+    def get_state(self):
+        return np.array([(self.px, self.py, ordinal_to_doy(self.force_end),
+                            self.pmain, self.lc[-1], self.exact)],
+                            dtype=cons.STATE)
+
+    def get_stable(self):
+        x = self.pools[0]
+        return np.array([(x['px'], x['py'], x['class'], x['psize'],
+                            x['start'], x['end'], x['biomass'][0])],
+                            dtype=cons.STABLE)
 
     def assess_ts(self, ts):
         if len(self.lc) > 0:
@@ -116,6 +193,8 @@ class carbon:
             else:
                 if (self.lc[-1] not in self.forest) & (ts['class'] == self.forest[0]):
                     ts['class'] = self.forest[1]
+                self.changes.append([self.lc[-1], ts['class'],
+                                        ordinal_to_doy(ts['start'])])
                 if self.lc[-1] in self.forest:
                     self.deforest(ordinal_to_doy(ts['start'] - 1))
                 else:
@@ -195,12 +274,18 @@ class pools:
         pools: carbon pools
         start: start date
         end: end date
+        stable: whether the pools are a single constant pool
 
     Functions:
         eval (t): calculate biomass and flux for each pool at date t
         record (): generate daily record for each pool
         eval_sum(t): calculate total biomass and fluxes at date t
         report (): generate daily report of total biomass and fluxes
+        report_multi (specs): generate reports for several periods at once
+        report_interval (specs, group, ngroup): generate reports by evaluating
+                                    each pool only on dates within its active
+                                    window, optionally for groups of pools
+        transitions (): subpool and land cover transition of each pool
 
     """
     dtypes = cons.DTYPES
@@ -211,6 +296,7 @@ class pools:
         self.pools = pools
         self.start = pools[pools['subpool'] == 'above'][0]['start']
         self.end = pools[pools['subpool'] == 'above'][-1]['end']
+        self.stable = (len(pools) == 1) and (pools[0]['func'] == 'none')
 
     def eval(self, t):
         biomass = []
@@ -276,16 +362,109 @@ class pools:
                         dtype=self.dtypes2)
 
     def report(self, period, lapse=1):
-        r = []
-        if max(period) < 3000:
-            period2 = [doy_to_ordinal(x * 1000 + 1) for x in range(period[0],
-                        period[1] + 1, lapse)]
-        else:
-            period2 = range(doy_to_ordinal(period[0]),
-                            doy_to_ordinal(period[1]) + 1, lapse)
-        for t in period2:
-            r.extend(self.eval_sum(ordinal_to_doy(t)))
-        return np.array(r)
+        return self.report_multi([[period, lapse]])[0]
+
+    def report_multi(self, specs):
+        periods = [get_period(x[0], x[1]) for x in specs]
+        if self.stable:
+            r = []
+            x = self.pools[0]
+            for period in periods:
+                r.append(np.zeros(len(period), dtype=self.dtypes2))
+                r[-1]['date'] = [ordinal_to_doy(t) for t in period]
+                r[-1]['above'][(r[-1]['date'] >= x['start']) &
+                                (r[-1]['date'] <= x['end'])] = x['biomass'][0]
+            return r
+        evals = {}
+        for t in sorted(set().union(*periods)):
+            evals[t] = self.eval_sum(ordinal_to_doy(t))[0]
+        return [np.array([evals[t] for t in x], dtype=self.dtypes2)
+                for x in periods]
+
+    def report_interval(self, specs, group=None, ngroup=1):
+        periods = [get_period(x[0], x[1]) for x in specs]
+        dates = np.array(sorted(set().union(*periods)), dtype=np.int64)
+        doys = np.array([ordinal_to_doy(int(t)) for t in dates], dtype=np.int64)
+        n = len(dates)
+        pools = self.pools
+        grouped = group is not None
+        if not grouped:
+            group = np.zeros(len(pools), dtype=np.int64)
+        r = dict([(x, np.zeros(ngroup * n)) for x in ['above', 'emission',
+                    'productivity', 'unreleased']])
+        post = dict([(x, np.zeros((ngroup, n + 1))) for x in ['emission',
+                        'productivity']])
+        ordinal = dict([(x, doy_to_ordinal(int(x)))
+                        for x in np.unique(pools['start'])])
+        first = np.searchsorted(doys, pools['start'], 'left')
+        last = np.maximum(np.searchsorted(doys, pools['end'], 'right'), first)
+        b0 = pools['biomass'][:, 0]
+
+        # constant change after the end of each pool
+        delta = b0 - pools['biomass'][:, 1]
+        ended = last < n
+        for x, _f in [['emission', delta >= 0], ['productivity', delta < 0]]:
+            np.add.at(post[x], (group[ended & _f], last[ended & _f]),
+                        delta[ended & _f])
+            r[x] += np.cumsum(post[x], axis=1)[:, :n].ravel()
+
+        # burned pools release everything on their start date
+        burned = ((pools['pool'] == 'burned') & (first < n) &
+                    (doys[np.minimum(first, n - 1)] == pools['start']))
+        np.add.at(r['emission'], group[burned] * n + first[burned],
+                    b0[burned])
+
+        # evaluate pools on dates within their active window, in chunks
+        count = last - first
+        i = 0
+        while i < len(pools):
+            j = i + max(1, np.searchsorted(np.cumsum(count[i:]),
+                                            cons.REPORT_CHUNK, 'right'))
+            pid = np.repeat(np.arange(i, j), count[i:j])
+            offset = np.cumsum(count[i:j]) - count[i:j]
+            did = first[pid] + np.arange(len(pid)) - offset[pid - i]
+            biomass = run_flux_array(b0[pid],
+                                    [ordinal[x] for x in pools['start'][pid]],
+                                    dates[did], pools['func'][pid],
+                                    pools['coef'][pid],
+                                    self.scale_factor * pools['psize'][pid])
+            delta = b0[pid] - biomass
+            gid = group[pid] * n + did
+            r['emission'] += np.bincount(gid, np.where(delta >= 0, delta, 0),
+                                            ngroup * n)
+            r['productivity'] += np.bincount(gid, np.where(delta < 0, delta,
+                                                0), ngroup * n)
+            _f = pools['pool'][pid] == 'product'
+            r['unreleased'] += np.bincount(gid[_f], biomass[_f], ngroup * n)
+            _f = pools['pool'][pid] == 'biomass'
+            r['above'] += np.bincount(gid[_f], biomass[_f], ngroup * n)
+            i = j
+
+        # assemble reports
+        report = np.zeros((ngroup, n), dtype=self.dtypes2)
+        report['date'] = doys
+        for x in r:
+            report[x] = r[x].reshape(ngroup, n)
+        report['net'] = report['emission'] + report['productivity']
+        if not grouped:
+            report = report[0]
+        return [report[..., np.searchsorted(dates, x)] for x in periods]
+
+    def transitions(self):
+        pools = self.pools
+        n = len(pools)
+        i = np.arange(n)
+        above = pools['subpool'] == cons.SPNAME[0]
+        _class = np.append(pools['class'], cons.UNCLASSIFIED)
+        last = np.maximum.accumulate(np.where(above, i, -1))
+        after = np.minimum.accumulate(np.where(above, i, n)[::-1])[::-1]
+        keys = np.zeros(n, dtype=cons.BREAKDOWN)
+        keys['subpool'] = pools['subpool']
+        keys['from'] = np.where(above, _class[np.append(-1, last[:-1])],
+                                _class[last])
+        keys['to'] = np.where(above, _class[:n], _class[np.append(after[1:],
+                                                                    n)])
+        return keys
 
 
 class aggregated:
@@ -312,9 +491,6 @@ class aggregated:
 
     Functions:
         assess_data (data): track carbon change of activity data
-        regrow (start, end, area): add regrow pool
-        deforest (date, area): add deforestation pool
-        emission (pid): calculate emission for a pool
         update_pools (): update all pools to current end date
 
     """
@@ -335,54 +511,63 @@ class aggregated:
         self.assess_data(data)
 
     def assess_data(self, data):
-        for x in data:
-            start = x['start'] * 1000 + 1
-            end = x['end'] * 1000 + 1
-            middle = ordinal_to_doy(int((doy_to_ordinal(start)+doy_to_ordinal(end))/2))
-            self.regrow(start, end, x[self.transitions[0]], False)
-            self.deforest(middle, self.end, x[self.transitions[1]], self.forest[0])
-            self.deforest(middle, self.end, x[self.transitions[2]], self.forest[0])
-            self.regrow(start, end, x[self.transitions[3]], True)
-            self.deforest(middle, self.end, x[self.transitions[4]], self.forest[1])
-        self.update_pools()
-        self.pools = np.array(self.pools)
-
-    def regrow(self, start, end, area, new=False):
-        if area > 0:
-            self.pid += 1
-            if new:
-                biomass = 0
+        n = len(data)
+        start = data['start'] * 1000 + 1
+        end = data['end'] * 1000 + 1
+        middle = np.array([ordinal_to_doy(int((doy_to_ordinal(int(x)) +
+                            doy_to_ordinal(int(y))) / 2))
+                            for x, y in zip(start, end)], dtype=np.int64)
+        product = self.p[2][self.p[2]['fraction'] > 0]
+        flux = get_flux(self.p, self.forest[1])
+        blocks = []
+        for i, x in enumerate(self.transitions):
+            area = np.asarray(data[x])
+            if i in [0, 3]:
+                block = np.zeros((n, 1), dtype=self.dtypes)
+                block['pool'] = self.pname[0]
+                block['subpool'] = self.spname[0]
+                block['class'] = self.forest[1]
+                block['start'] = start[:, None]
+                block['end'] = end[:, None]
+                if i == 0:
+                    block['biomass'][:, 0, 0] = get_biomass(self.p,
+                                    self.forest[1], self.scale_factor * area)
+                block['func'] = flux['function']
+                block['coef'] = (flux['coef1'], flux['coef2'])
             else:
-                biomass = get_biomass(self.p, self.forest[1],
-                                        self.scale_factor * area)
-            flux = get_flux(self.p, self.forest[1])
-            self.pools.extend(np.array([(self.pname[0], self.spname[0],
-                                self.forest[1], self.pid, 0, 0, area, start,
-                                end, [biomass, 0.0], flux['function'],
-                                (flux['coef1'], flux['coef2']))],
-                                dtype=self.dtypes))
-
-    def deforest(self, start, end, area, ftype=0):
-        if area > 0:
-            biomass = get_biomass(self.p, ftype, self.scale_factor * area)
-            for x in self.p[2]:
-                if x['fraction'] > 0:
-                    self.pid += 1
-                    self.pools.extend(np.array([(self.pname[1], x['product'],
-                                        99, self.pid, 0, 0, area, start, end,
-                                        [biomass * x['fraction'], 0.0],
-                                        x['function'], [x['coef1'],
-                                        x['coef2']])], dtype=self.dtypes))
-                    if x['product'] == 'burned':
-                        self.pools[-1]['pool'] = self.pname[2]
-
-    def emission(self, pid):
-        pool = self.pools[pid]
-        biomass = run_flux(pool['biomass'][0], doy_to_ordinal(pool['start']),
-                            doy_to_ordinal(pool['end']), pool['func'],
-                            pool['coef'], self.scale_factor * pool['psize'])
-        self.pools[pid]['biomass'][1] = biomass
+                ftype = self.forest[1] if i == 4 else self.forest[0]
+                biomass = get_biomass(self.p, ftype, self.scale_factor * area)
+                block = np.zeros((n, len(product)), dtype=self.dtypes)
+                block['pool'] = np.where(product['product'] == 'burned',
+                                            self.pname[2], self.pname[1])
+                block['subpool'] = product['product']
+                block['class'] = 99
+                block['start'] = middle[:, None]
+                block['end'] = self.end
+                block['biomass'][:, :, 0] = (biomass[:, None] *
+                                                product['fraction'][None, :])
+                block['func'] = product['function']
+                block['coef'][:, :, 0] = product['coef1']
+                block['coef'][:, :, 1] = product['coef2']
+            block['psize'] = area[:, None]
+            blocks.append((block, np.repeat((area > 0)[:, None],
+                                            block.shape[1], 1)))
+        pools = np.concatenate([x[0] for x in blocks], 1)
+        keep = np.concatenate([x[1] for x in blocks], 1)
+        self.pools = pools[keep]
+        self.pid = len(self.pools) - 1
+        self.pools['id'] = np.arange(len(self.pools))
+        self.update_pools()
 
     def update_pools(self):
-        for pid in range(0, self.pid + 1):
-            self.emission(pid)
+        if len(self.pools) == 0:
+            return None
+        dates = np.unique(np.concatenate([self.pools['start'],
+                                            self.pools['end']]))
+        ordinal = dict([(x, doy_to_ordinal(int(x))) for x in dates])
+        self.pools['biomass'][:, 1] = run_flux_array(
+                            self.pools['biomass'][:, 0],
+                            [ordinal[x] for x in self.pools['start']],
+                            [ordinal[x] for x in self.pools['end']],
+                            self.pools['func'], self.pools['coef'],
+                            self.scale_factor * self.pools['psize'])
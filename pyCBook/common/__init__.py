@@ -1,10 +1,15 @@
 """ Modules for common libarary
 """
+import importlib
+
 from .logger import log
-from .plotting import plot_pools, plot_book
 from .utility import (date_to_doy, doy_to_date, get_files, show_progress,
                         manage_batch, get_date, get_int, doy_to_ordinal,
-                        ordinal_to_doy, select_samples, get_class_string)
+                        ordinal_to_doy, select_samples, get_class_string,
+                        get_period, sort_files, map_pool, get_checksum,
+                        scan_files, read_manifest)
+from .pipeline import prefetch, writer
+from .retry import line_timeout, read_failures, failures
 
 
 __all__ = [
@@ -21,5 +26,31 @@ __all__ = [
     'select_samples',
     'plot_pools',
     'get_class_string',
-    'plot_book'
+    'plot_book',
+    'get_period',
+    'sort_files',
+    'map_pool',
+    'get_checksum',
+    'scan_files',
+    'read_manifest',
+    'prefetch',
+    'writer',
+    'line_timeout',
+    'read_failures',
+    'failures'
 ]
+
+
+# plotting functions are imported on first use to avoid loading matplotlib
+_lazy = {
+    'plot_pools': 'plotting',
+    'plot_book': 'plotting'
+}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        return getattr(importlib.import_module('.{}'.format(_lazy[name]),
+                                                __name__), name)
+    raise AttributeError('module {} has no attribute {}'.format(__name__,
+                                                                    name))
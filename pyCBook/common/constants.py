@@ -25,3 +25,38 @@ AREA = 518131758 * 30 * 30 / 100 / 100
 SAREA = 13755 * 30 * 30 / 100 / 100
 SCALE_FACTOR2 = 1000 * 1000
 DIY = 365.25
+REDUCE_BLOCK = 16
+REDUCE_FIELDS = ['emission', 'productivity', 'net', 'unreleased']
+LEDGER = [('name', 'U64'), ('py', '<i4'), ('pixels', '<i4'), ('size', '<i8'),
+            ('mtime', '<f8'), ('checksum', 'U40')]
+STATE = [('px', '<u2'), ('py', '<u2'), ('end', '<i4'), ('main', '<u2'),
+            ('class', '<u2'), ('exact', '?')]
+STABLE = [('px', '<u2'), ('py', '<u2'), ('class', '<u2'), ('psize', '<f4'),
+            ('start', '<i4'), ('end', '<i4'), ('biomass', '<f8')]
+STORE_META = 'store.csv'
+STORE_CHUNK = 256
+PIXEL_INDEX = [('px', '<u2'), ('start', '<i8'), ('stop', '<i8')]
+EXTRACT = [('px', '<u2'), ('py', '<u2')]
+SLIM = [('px', '<u2'), ('py', '<u2'), ('start', '<i4'), ('end', '<i4'),
+            ('break', '<i4'), ('class', '<u2')]
+BUNDLE_INDEX = [('py', '<u2'), ('start', '<i8'), ('stop', '<i8')]
+MANIFEST_DIR = '.manifest'
+MANIFEST = [('size', '<i8'), ('mtime', '<f8'), ('py', '<i8'), ('count', '<i8')]
+REPORT_CHUNK = 4194304
+BREAKDOWN = [('subpool', 'U10'), ('from', '<u2'), ('to', '<u2')]
+BREAKDOWN_HEADER = 'date,subpool,from,to,emission,productivity,net,unreleased'
+BREAKDOWN_FMT = '%d,%s,%d,%d,%f,%f,%f,%f'
+TRANSITION = [('from', '<u2'), ('to', '<u2'), ('year', '<i4'),
+                ('count', '<i8'), ('area', '<f8')]
+TRANSITION_HEADER = 'from,to,year,count,area'
+TRANSITION_FMT = '%d,%d,%d,%d,%f'
+SERVE_CACHE = 64
+SERVE_PORT = 8765
+HOTSPOT = [('px', '<u2'), ('py', '<u2'), ('emission', '<f8'),
+            ('from', '<u2'), ('to', '<u2')]
+HOTSPOT_FMT = '%d,%d,%f,%d,%d'
+AUDIT = [('px', '<u2'), ('py', '<u2'), ('check', 'U10'), ('id', '<i4'),
+            ('value', '<f8')]
+AUDIT_FMT = '%d,%d,%s,%d,%f'
+AUDIT_TOLERANCE = 1e-6
+RETRY_FILE = 'failed_b{}_{}.json'
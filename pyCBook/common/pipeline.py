@@ -0,0 +1,105 @@
+""" Module for overlapping file IO with computation
+"""
+import queue
+import threading
+
+
+def prefetch(func, works, depth=0):
+    """ read work loads ahead of computation with a reader thread
+
+    Args:
+        func (function): function to read a work load
+        works (list): list of work loads
+        depth (int): number of work loads to read ahead, 0 for no prefetch
+
+    Returns:
+        results (generator): [work, result, error] in order of work loads,
+                                error is None if read successfully
+
+    """
+    if depth <= 0:
+        for x in works:
+            try:
+                r = [x, func(x), None]
+            except Exception as e:
+                r = [x, None, e]
+            yield r
+        return
+    done = threading.Event()
+    _queue = queue.Queue(depth)
+
+    def reader():
+        for x in works:
+            if done.is_set():
+                break
+            try:
+                r = [x, func(x), None]
+            except Exception as e:
+                r = [x, None, e]
+            while not done.is_set():
+                try:
+                    _queue.put(r, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+        _queue.put(None)
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            r = _queue.get()
+            if r is None:
+                break
+            yield r
+    finally:
+        done.set()
+
+
+class writer:
+    """ write outputs behind computation with a writer thread
+
+    Args:
+        depth (int): number of pending outputs, 0 for writing immediately
+
+    Variables:
+        depth: number of pending outputs
+        failed: [key, error] of each output failed to be written
+
+    Functions:
+        put (key, func, *args): write an output with func(*args)
+        run (): write pending outputs until closed
+        close (): wait for pending outputs to be written
+
+    """
+    def __init__(self, depth=0):
+        self.depth = depth
+        self.failed = []
+        if self.depth > 0:
+            self.queue = queue.Queue(depth)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def put(self, key, func, *args, **kwargs):
+        if self.depth > 0:
+            self.queue.put([key, func, args, kwargs])
+        else:
+            func(*args, **kwargs)
+
+    def run(self):
+        while True:
+            x = self.queue.get()
+            if x is None:
+                break
+            try:
+                x[1](*x[2], **x[3])
+            except Exception as e:
+                self.failed.append([x[0], e])
+
+    def close(self):
+        if self.depth > 0:
+            self.queue.put(None)
+            self.thread.join()
+        return self.failed
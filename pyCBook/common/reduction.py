@@ -0,0 +1,147 @@
+""" Module for deterministic reduction of reports
+"""
+import numpy as np
+
+
+METHODS = ['plain', 'pairwise', 'kahan']
+
+
+def block_sum(arrays, method='plain'):
+    """ sum a block of arrays in a fixed order
+
+    Args:
+        arrays (list, ndarray): arrays of the same shape
+        method (str): plain, pairwise or kahan summation
+
+    Returns:
+        partial (tuple, ndarray): sum and compensation, None if empty
+
+    """
+    if len(arrays) == 0:
+        return None
+    if method == 'pairwise':
+        return (pairwise_sum(arrays), np.zeros(arrays[0].shape))
+    s = np.array(arrays[0], dtype=np.float64)
+    c = np.zeros(s.shape)
+    for x in arrays[1:]:
+        if method == 'kahan':
+            (s, e) = two_sum(s, x)
+            c += e
+        else:
+            s = s + x
+    return (s, c)
+
+
+def pairwise_sum(arrays):
+    """ sum arrays by recursively splitting them in halves
+
+    Args:
+        arrays (list, ndarray): arrays of the same shape
+
+    Returns:
+        s (ndarray): sum of the arrays
+
+    """
+    if len(arrays) == 1:
+        return np.array(arrays[0], dtype=np.float64)
+    half = len(arrays) // 2
+    return pairwise_sum(arrays[:half]) + pairwise_sum(arrays[half:])
+
+
+def two_sum(a, b):
+    """ error free summation of two arrays
+
+    Args:
+        a (ndarray): first array
+        b (ndarray): second array
+
+    Returns:
+        s (ndarray): rounded sum
+        e (ndarray): rounding error of the sum
+
+    """
+    s = a + b
+    bp = s - a
+    e = (a - (s - bp)) + (b - bp)
+    return (s, e)
+
+
+def combine(a, b, method='plain'):
+    """ combine two partial sums
+
+    Args:
+        a (tuple, ndarray): first partial sum and compensation
+        b (tuple, ndarray): second partial sum and compensation
+        method (str): plain, pairwise or kahan summation
+
+    Returns:
+        partial (tuple, ndarray): combined sum and compensation
+
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if method == 'kahan':
+        (s, e) = two_sum(a[0], b[0])
+        return (s, a[1] + b[1] + e)
+    return (a[0] + b[0], a[1] + b[1])
+
+
+def tree_partial(partials, method='plain'):
+    """ combine partial sums with a balanced binary tree, pairing neighbours
+        from the left at each level so that the tree only depends on the
+        position of each partial sum
+
+    Args:
+        partials (list, tuple): partial sums in a fixed order, None for empty
+        method (str): plain, pairwise or kahan summation
+
+    Returns:
+        partial (tuple, ndarray): sum and compensation, None if nothing to sum
+
+    """
+    partials = list(partials)
+    if len(partials) == 0:
+        return None
+    while len(partials) > 1:
+        partials = [combine(partials[i], partials[i + 1], method)
+                    if i + 1 < len(partials) else partials[i]
+                    for i in range(0, len(partials), 2)]
+    return partials[0]
+
+
+def tree_sum(partials, method='plain'):
+    """ combine partial sums with a balanced binary tree
+
+    Args:
+        partials (list, tuple): partial sums in a fixed order
+        method (str): plain, pairwise or kahan summation
+
+    Returns:
+        s (ndarray): total, None if nothing to sum
+
+    """
+    partial = tree_partial(partials, method)
+    if partial is None:
+        return None
+    return partial[0] + partial[1]
+
+
+def tree_level(n, jobs):
+    """ level of the tree to split among jobs, a node of level k covers the
+        2 ** k leaves starting from a multiple of 2 ** k, so partial sums of
+        the nodes combine to the same total as the leaves
+
+    Args:
+        n (int): number of leaves
+        jobs (int): number of jobs
+
+    Returns:
+        level (int): highest level with at least as many nodes as jobs
+
+    """
+    level = 0
+    while (2 ** level < n) and (-(-n // 2 ** (level + 1)) >= jobs):
+        level += 1
+    return level
@@ -0,0 +1,98 @@
+""" Module for capturing failed lines and retrying them
+"""
+import os
+import json
+import math
+import signal
+import threading
+import traceback
+
+from contextlib import contextmanager
+
+
+@contextmanager
+def line_timeout(seconds=0):
+    """ give up processing a line that takes too long
+
+    Args:
+        seconds (float): time limit in seconds, 0 for no limit, only enforced
+                            in the main thread where SIGALRM is available
+
+    Returns:
+        context (contextmanager): raises TimeoutError when time is up
+
+    """
+    if ((seconds <= 0) or (not hasattr(signal, 'SIGALRM')) or
+        (threading.current_thread() is not threading.main_thread())):
+        yield
+        return
+
+    def alarm(signum, frame):
+        raise TimeoutError('Timed out after {} seconds.'.format(seconds))
+
+    previous = signal.signal(signal.SIGALRM, alarm)
+    signal.alarm(int(math.ceil(seconds)))
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def read_failures(_file):
+    """ read failures recorded in a retry file
+
+    Args:
+        _file (str): path to retry file
+
+    Returns:
+        records (list, dict): line, pixel, file, error, message and
+                                traceback of each failure, empty if no file
+
+    """
+    if not os.path.isfile(_file):
+        return []
+    with open(_file, 'r') as f:
+        return json.load(f)
+
+
+class failures:
+    """ failures of lines to be retried
+
+    Args:
+        _file (str): path to retry file
+
+    Variables:
+        _file: path to retry file
+        records: line, pixel, file, error, message and traceback of each
+                    failure
+
+    Functions:
+        add (py, px, error, name): record a failure
+        lines (): lines that failed
+        save (): write failures to retry file, remove it if there is none
+
+    """
+    def __init__(self, _file):
+        self._file = _file
+        self.records = []
+
+    def add(self, py, px=-1, error=None, name=''):
+        self.records.append({
+            'line': int(py), 'pixel': int(px), 'file': name,
+            'error': type(error).__name__, 'message': str(error),
+            'traceback': ''.join(traceback.format_exception(type(error),
+                                    error, error.__traceback__))})
+
+    def lines(self):
+        return sorted(set([x['line'] for x in self.records]))
+
+    def save(self):
+        if len(self.records) == 0:
+            if os.path.isfile(self._file):
+                os.remove(self._file)
+            return 0
+        with open(self._file + '.tmp', 'w') as f:
+            json.dump(self.records, f, indent=1)
+        os.replace(self._file + '.tmp', self._file)
+        return len(self.records)
@@ -6,11 +6,14 @@ import os
 import re
 import fnmatch
 import random
+import hashlib
 import numpy as np
 
 from calendar import isleap
 from datetime import date
 
+from . import constants as cons
+
 
 def date_to_doy(year, month, day, day_only=False):
     """ convert date to day-of-year
@@ -73,22 +76,162 @@ def doy_to_date(doy):
     return (year, month, day)
 
 
-def get_files(path, pattern, recursive=True):
+def get_files(path, pattern, recursive=True, manifest=False):
     """ search files with pattern
 
     Args:
         path (str): location to search in
         pattern (str): searching pattern
+        recursive (bool): search sub folders or not
+        manifest (bool): use a cached manifest of the location or not
 
     Returns:
         file_list (list): list of files, [path, name]
 
     """
-    if recursive:
-        return [[x[0], x[1]] for x in [[pn, f] for pn, dn, fn in os.walk(path)
-                for f in fn] if fnmatch.fnmatch(x[1], pattern)]
+    if manifest:
+        files = read_manifest(path, recursive)
+        return [[str(x['path']), str(x['name'])] for x in files
+                if fnmatch.fnmatch(x['name'], pattern)]
+    return [[x[0], x[1]] for x in scan_files(path, recursive)[0]
+            if fnmatch.fnmatch(x[1], pattern)]
+
+
+def scan_files(path, recursive=True):
+    """ scan a location for files and folders
+
+    Args:
+        path (str): location to scan
+        recursive (bool): scan sub folders or not
+
+    Returns:
+        files (list): [path, name, size, mtime] of each file
+        dirs (list): [path, mtime] of each folder scanned
+
+    """
+    files = []
+    dirs = []
+    folders = [path]
+    while len(folders) > 0:
+        folder = folders.pop(0)
+        dirs.append([folder, os.stat(folder).st_mtime])
+        # links to folders are not followed, as in os.walk
+        for x in sorted(os.scandir(folder), key=lambda x: x.name):
+            if x.is_dir(follow_symlinks=False):
+                if recursive and (x.name != cons.MANIFEST_DIR):
+                    folders.append(x.path)
+            elif x.is_file():
+                stat = x.stat()
+                files.append([folder, x.name, stat.st_size, stat.st_mtime])
+    return files, dirs
+
+
+def read_manifest(path, recursive=True):
+    """ read the cached manifest of a location, update it if outdated
+
+    Args:
+        path (str): location to search in
+        recursive (bool): search sub folders or not
+
+    Returns:
+        files (ndarray): path, name, size, mtime, py and count of each file,
+                            sorted numerically by the ints in the file name
+
+    """
+    _dir = os.path.join(path, cons.MANIFEST_DIR)
+    _file = os.path.join(_dir, 'manifest_{}.npz'.format('R' if recursive
+                                                        else 'l'))
+    if os.path.isfile(_file):
+        try:
+            manifest = np.load(_file)
+            if all([os.stat(x['path']).st_mtime == x['mtime']
+                    for x in manifest['dirs']]):
+                return manifest['files']
+        except:
+            pass
+    if not os.path.isdir(_dir):
+        try:
+            os.makedirs(_dir)
+        except OSError:
+            _dir = None
+    files, dirs = scan_files(path, recursive)
+    files = sort_files(files)
+    ints = [get_int(x[1]) for x in files]
+    files = np.array([(x[0], x[1], x[2], x[3],
+                        (y[0] if len(y) > 0 else -1),
+                        (y[-1] if len(y) > 1 else -1))
+                        for x, y in zip(files, ints)],
+                        dtype=[('path', 'U{}'.format(max([len(x[0])
+                                for x in files] + [1]))),
+                                ('name', 'U{}'.format(max([len(x[1])
+                                for x in files] + [1])))] + cons.MANIFEST)
+    if _dir is not None:
+        try:
+            dirs = np.array([tuple(x) for x in dirs],
+                            dtype=[('path', 'U{}'.format(max([len(x[0])
+                                    for x in dirs]))), ('mtime', '<f8')])
+            temp = '{}.{}.npz'.format(_file, os.getpid())
+            np.savez(temp, files=files, dirs=dirs)
+            os.rename(temp, _file)
+        except:
+            pass
+    return files
+
+
+def sort_files(file_list):
+    """ sort a list of files numerically by the ints in the file name
+
+    Args:
+        file_list (list): list of files, [path, name]
+
+    Returns:
+        file_list (list): sorted list of files, [path, name]
+
+    """
+    return sorted(file_list, key=lambda x: (get_int(x[1]), x[1], x[0]))
+
+
+def map_pool(func, works, workers=1, process=False):
+    """ apply a function on work loads with a pool of workers
+
+    Args:
+        func (function): function to apply, module level if process
+        works (list): list of work loads
+        workers (int): number of workers, 1 for no pool
+        process (bool): use processes instead of threads
+
+    Returns:
+        results (list): results in the same order as the work loads
+
+    """
+    if workers <= 1:
+        return [func(x) for x in works]
+    # pools are only imported when needed to keep start up fast
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    if process:
+        executor = ProcessPoolExecutor(workers)
     else:
-        return [[path, f] for f in fnmatch.filter(os.listdir(path), pattern)]
+        executor = ThreadPoolExecutor(workers)
+    with executor:
+        return list(executor.map(func, works))
+
+
+def get_checksum(_file, block=1048576):
+    """ calculate checksum of a file
+
+    Args:
+        _file (str): path to the file
+        block (int): size of blocks to read
+
+    Returns:
+        checksum (str): sha1 checksum of the file
+
+    """
+    sha1 = hashlib.sha1()
+    with open(_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
 
 
 def manage_batch(works, job, n_job):
@@ -181,23 +324,47 @@ def ordinal_to_doy(ordinal):
     return date_to_doy(_date.year, _date.month, _date.day)
 
 
-def select_samples(population, n):
+def get_period(period, lapse=1):
+    """ generate reporting dates of a reporting period
+
+    Args:
+        period (list, int): reporting time period, [start, end], in years or
+                            in day of year
+        lapse (int): reporting interval
+
+    Returns:
+        dates (list, int): ordinal dates to be reported
+
+    """
+    if max(period) < cons.MAX_YEAR:
+        return [doy_to_ordinal(x * 1000 + 1) for x in range(period[0],
+                period[1] + 1, lapse)]
+    else:
+        return list(range(doy_to_ordinal(period[0]),
+                            doy_to_ordinal(period[1]) + 1, lapse))
+
+
+def select_samples(population, n, seed=None):
     """ select sample from data withour replacement
 
     Args:
         population (ndarray/list): population
         n (int): number of samples
+        seed (int/Random): random seed or generator, None to seed from system
 
     Returns:
         samples (ndarray/list): samples selected
 
     """
-    random.seed()
+    if isinstance(seed, random.Random):
+        rng = seed
+    else:
+        rng = random.Random(seed)
     if type(population) == list:
-        return [population[i] for i in random.sample(range(0,
+        return [population[i] for i in rng.sample(range(0,
                                                         len(population)), n)]
     else:
-        return population[random.sample(range(0, len(population)), n)]
+        return population[rng.sample(range(0, len(population)), n)]
 
 
 def get_class_string(_class, lookup):
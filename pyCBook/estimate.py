@@ -0,0 +1,385 @@
+""" Module for estimating scene totals from a stratified sample of pixels
+
+    Args:
+        -p (pattern): searching pattern
+        -t (time): report time frame
+        -i (lapse): reporting interval
+        -n (number): total number of sample pixels, shared by all strata
+        -s (strata): stratify by blocks of lines or by class transition
+        --seed: random seed
+        --img: biomass bass image
+        --mask: mask image
+        -e (end): force bookkeeping to end on this date
+        -c (cache): place to cache slim YATSM records
+        -R (recursive): recursive when seaching files
+        --bundle: inputs are bundles of many lines
+        --overwrite: overwrite or not
+        ori: origin
+        para: parameter files location
+        des: destination
+
+"""
+import os
+import sys
+import random
+import argparse
+import numpy as np
+
+from .common import (log, get_files, get_int, select_samples, get_period,
+                        ordinal_to_doy)
+from .io import (yatsm2records, yatsm2slim, yatsm2pixels, csv2ndarray,
+                    bundle2files)
+from .carbon import carbon, pools
+from .common import constants as cons
+
+
+STRATA = ['line', 'class']
+
+
+def pixel_strata(records, py, strata='line'):
+    """ find pixels of a line and their strata
+
+    Args:
+        records (ndarray): YATSM records of a line
+        py (int): line number
+        strata (str): line, or class transition from first to last segment
+
+    Returns:
+        px (ndarray): pixels of the line
+        stratum (ndarray): stratum of each pixel
+
+    """
+    if len(records) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    order = np.lexsort((records['start'], records['px']))
+    px = np.asarray(records['px'])[order]
+    _class = np.asarray(records['class'], dtype=np.int64)[order]
+    first = np.concatenate([[0], np.nonzero(px[1:] != px[:-1])[0] + 1])
+    last = np.append(first[1:], len(px)) - 1
+    if strata == 'line':
+        stratum = np.zeros(len(first), dtype=np.int64) + py
+    else:
+        stratum = _class[first] * 65536 + _class[last]
+    return px[first].astype(np.int64), stratum
+
+
+def allocate(size, n):
+    """ allocate samples to strata in proportion to their size
+
+    Args:
+        size (ndarray): number of pixels in each stratum
+        n (int): total number of samples
+
+    Returns:
+        alloc (ndarray): number of samples of each stratum, adding up to n or
+                            to all pixels if fewer, at least two in each
+                            stratum where n allows so that variance can be
+                            estimated
+
+    """
+    n = min(n, int(size.sum()))
+    if n >= 2 * len(size):
+        floor = np.minimum(size, 2)
+    else:
+        floor = np.zeros(len(size), dtype=np.int64)
+    rest = size - floor
+    share = rest * (n - floor.sum()) / max(rest.sum(), 1)
+    alloc = floor + np.floor(share).astype(np.int64)
+    extra = n - alloc.sum()
+    if extra > 0:
+        order = np.argsort(np.floor(share) - share, kind='mergesort')
+        alloc[order[:extra]] += 1
+    return alloc
+
+
+def merge_lines(population, n):
+    """ merge line strata into blocks of contiguous lines so that each block
+        gets at least two of n samples
+
+    Args:
+        population (ndarray): line, pixel and stratum of each pixel, with
+                                line as stratum
+        n (int): total number of samples
+
+    Returns:
+        population (ndarray): line, pixel and stratum of each pixel, with the
+                                first line of its block as stratum
+
+    """
+    keys, size = np.unique(population[:, 2], return_counts=True)
+    blocks = max(n // 2, 1)
+    if (blocks >= len(keys)) or (n >= size.sum()):
+        return population
+    cum = np.cumsum(size)
+    block = (cum - size) * blocks // cum[-1]
+    first = keys[np.searchsorted(block, block)]
+    population = population.copy()
+    population[:, 2] = first[np.searchsorted(keys, population[:, 2])]
+    return population
+
+
+def estimate_totals(strata):
+    """ scale sample reports up to totals with standard errors
+
+    Args:
+        strata (dict): [population size, sample reports] of each stratum
+
+    Returns:
+        r (ndarray): estimated totals and their standard errors
+
+    """
+    fields = cons.DTYPES2[1:]
+    r = None
+    for size, reports in strata.values():
+        n = len(reports)
+        if n == 0:
+            continue
+        if r is None:
+            r = np.zeros(len(reports[0]), dtype=cons.DTYPES2 +
+                            [(x[0] + '_se', '<f8') for x in fields])
+            r['date'] = reports[0]['date']
+        for x, _ in fields:
+            y = np.array([z[x] for z in reports], dtype=np.float64)
+            r[x] += size * y.mean(axis=0)
+            if n > 1:
+                r[x + '_se'] += (size ** 2 * (1 - n / size) *
+                                    y.var(axis=0, ddof=1) / n)
+    for x, _ in fields:
+        r[x + '_se'] = np.sqrt(r[x + '_se'])
+    return r
+
+
+def estimate_scene(pattern, ori, para, des, period=[2000001, 2015365], lapse=1,
+                    n=1000, strata='line', seed=None, img='NA', mask='NA',
+                    force_end=cons.FORCE_END, cache='NA', recursive=False,
+                    bundle=False, overwrite=False):
+    """ estimate scene totals by bookkeeping a stratified sample of pixels
+
+    Args:
+        pattern (str): searching pattern, e.g. yatsm_r*.npz
+        ori (str): place to look for inputs
+        para (str): parameter files location
+        des (str): output file
+        period (list, int): reporting time period, [start, end]
+        lapse (int): reporting interval
+        n (int): total number of sample pixels, shared by all strata
+        strata (str): stratify by blocks of contiguous lines, as many as n
+                        allows with two samples each, or by class transition
+        seed (int): random seed, None to seed from system
+        img (str): biomass base image
+        mask (str): mask image, only pixels of 1 are sampled as in book
+        force_end (int): force bookkeeping to end on this date
+        cache (str): place to keep slim records, NA for no cache
+        recursive (bool): recursive when searching file, or not
+        bundle (bool): inputs are bundles of many lines or not
+        overwrite (bool): overwrite or not
+
+    Returns:
+        0: successful
+        1: error due to des
+        2: error when searching files
+        3: found no file
+        4: error reading parameters or images
+        5: error processing
+        6: error writing output
+
+    """
+    # check if output already exists
+    if (not overwrite) and os.path.isfile(des):
+        log.error('{} already exists.'.format(os.path.basename(des)))
+        return 1
+
+    # locate files
+    log.info('Locating files...')
+    try:
+        yatsm_list = get_files(ori, pattern, recursive)
+        if bundle:
+            yatsm_list = [x for y in yatsm_list
+                            for x in bundle2files(os.path.join(y[0], y[1]))]
+        n_file = len(yatsm_list)
+    except:
+        log.error('Failed to search for {}'.format(pattern))
+        return 2
+    else:
+        if n_file == 0:
+            log.error('Found no {}'.format(pattern))
+            return 3
+        else:
+            log.info('Found {} files.'.format(n_file))
+
+    # reading parameters and images
+    log.info('Reading parameters...')
+    try:
+        p = [csv2ndarray(os.path.join(para, 'biomass.csv')),
+                csv2ndarray(os.path.join(para, 'flux.csv')),
+                csv2ndarray(os.path.join(para, 'product.csv'))]
+        if (img != 'NA') or (mask != 'NA'):
+            from .io import image2array
+        biomass = image2array(img, 1) if img != 'NA' else None
+        masked = image2array(mask, 1) if mask != 'NA' else None
+    except:
+        log.error('Failed to read parameters or images.')
+        return 4
+
+    # find population of each stratum
+    log.info('Finding strata...')
+    lines = {}
+    population = []
+    for yatsm in yatsm_list:
+        try:
+            _file = os.path.join(yatsm[0], yatsm[1])
+            py = get_int(yatsm[1])[0]
+            if (cache == 'NA') or (not os.path.isfile(_file)):
+                records = yatsm2records(_file)
+            else:
+                records = yatsm2slim(_file, cache)
+            px, stratum = pixel_strata(records, py, strata)
+            if masked is not None:
+                keep = masked[py, px] == 1
+                px = px[keep]
+                stratum = stratum[keep]
+            lines[py] = _file
+            population.append(np.stack([np.zeros(len(px), np.int64) + py, px,
+                                        stratum], axis=1))
+        except:
+            log.warning('Failed to read line {}.'.format(yatsm[1]))
+            continue
+    if len(population) == 0:
+        log.error('Failed to read anything.')
+        return 5
+    population = np.concatenate(population)
+    if strata == 'line':
+        population = merge_lines(population, n)
+    keys, size = np.unique(population[:, 2], return_counts=True)
+    log.info('Found {} pixels in {} strata.'.format(len(population),
+                                                        len(keys)))
+
+    # draw samples
+    log.info('Drawing samples...')
+    rng = random.Random(seed)
+    alloc = allocate(size, n)
+    if (alloc == 0).any():
+        log.error('{} of {} strata would have no sample, need at least {} '
+                    'samples.'.format((alloc == 0).sum(), len(keys),
+                                        2 * len(keys)))
+        return 5
+    samples = {}
+    for key, _size, _n in zip(keys, size, alloc):
+        members = population[population[:, 2] == key]
+        for py, px, _ in select_samples(members, int(_n), rng):
+            samples.setdefault(int(py), []).append([int(px), key])
+    log.info('Selected {} samples.'.format(int(alloc.sum())))
+
+    # book and report samples line by line
+    log.info('Start bookkeeping samples...')
+    reports = dict([(key, [_size, []]) for key, _size in zip(keys, size)])
+    empty = np.zeros(len(get_period(period, lapse)), dtype=cons.DTYPES2)
+    empty['date'] = [ordinal_to_doy(t) for t in get_period(period, lapse)]
+    for py in sorted(samples):
+        try:
+            stratum = dict(samples[py])
+            for pixel in yatsm2pixels(lines[py], list(stratum), cache=cache):
+                px = int(pixel[0]['px'])
+                se_biomass = biomass[py, px] if biomass is not None else -1
+                _pools = carbon(p, pixel, se_biomass,
+                                force_end=force_end).pools
+                if len(_pools) > 0:
+                    report = pools(np.array(_pools, dtype=cons.DTYPES)
+                                    ).report_interval([[period, lapse]])[0]
+                else:
+                    report = empty
+                reports[stratum[px]][1].append(report)
+            log.info('Processed line {}'.format(py))
+        except:
+            log.warning('Failed to process line {}.'.format(py))
+            continue
+
+    # scale up to scene totals
+    try:
+        r = estimate_totals(reports)
+        if r is None:
+            raise ValueError('No sample is processed.')
+    except:
+        log.error('Failed to estimate totals.')
+        return 5
+
+    # write output
+    log.info('Writing output...')
+    try:
+        header = cons.HEADER + ''.join([',{}_se'.format(x[0])
+                                        for x in cons.DTYPES2[1:]])
+        fmt = cons.FMT + ',%f' * (len(cons.DTYPES2) - 1)
+        np.savetxt(des, r, delimiter=',', fmt=fmt, header=header, comments='')
+    except:
+        log.error('Failed to write output to {}'.format(des))
+        return 6
+
+    # done
+    log.info('Process completed.')
+    log.info('Estimated from {} samples.'.format(sum([len(x[1]) for x in
+                                                        reports.values()])))
+    return 0
+
+
+if __name__ == '__main__':
+    # parse options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--pattern', action='store', type=str,
+                        dest='pattern', default='yatsm_r*.npz',
+                        help='searching pattern')
+    parser.add_argument('-t', '--time', action='store', type=int, nargs=2,
+                        dest='period', default=[2000001, 2015365],
+                        help='reporting period, [start, end]')
+    parser.add_argument('-i', '--lapse', action='store', type=int,
+                        dest='lapse', default=1, help='reporting interval')
+    parser.add_argument('-n', '--number', action='store', type=int,
+                        dest='n', default=1000,
+                        help='total number of sample pixels of all strata')
+    parser.add_argument('-s', '--strata', action='store', type=str,
+                        dest='strata', default='line', choices=STRATA,
+                        help='stratify by blocks of lines or class transition')
+    parser.add_argument('--seed', action='store', type=int, dest='seed',
+                        default=None, help='random seed')
+    parser.add_argument('--img', action='store', type=str, dest='img',
+                        default='NA', help='biomass base image')
+    parser.add_argument('--mask', action='store', type=str, dest='mask',
+                        default='NA', help='mask image')
+    parser.add_argument('-e', '--end', action='store', type=int, dest='end',
+                        default=cons.FORCE_END, help='force end date')
+    parser.add_argument('-c', '--cache', action='store', type=str,
+                        dest='cache', default='NA',
+                        help='place to cache slim YATSM records')
+    parser.add_argument('-R', '--recursive', action='store_true',
+                        help='recursive or not')
+    parser.add_argument('--bundle', action='store_true',
+                        help='inputs are bundles of many lines')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite or not')
+    parser.add_argument('ori', default='./', help='origin')
+    parser.add_argument('para', default='./', help='parameters')
+    parser.add_argument('des', default='./', help='destination')
+    args = parser.parse_args()
+
+    # print logs
+    log.info('Start estimating from samples...')
+    log.info('Reporting period {} to {} interval {}.'.format(args.period[0],
+                                                args.period[1], args.lapse))
+    log.info('Drawing {} samples stratified by {}.'.format(args.n,
+                                                            args.strata))
+    if args.seed is not None:
+        log.info('Random seed {}.'.format(args.seed))
+    log.info('Looking for {}'.format(args.pattern))
+    log.info('In {}'.format(args.ori))
+    log.info('Parameters from {}'.format(args.para))
+    log.info('Saving as {}'.format(args.des))
+    if args.recursive:
+        log.info('Recursive seaching.')
+    if args.overwrite:
+        log.info('Overwriting old files.')
+
+    # run function to estimate
+    sys.exit(estimate_scene(args.pattern, args.ori, args.para, args.des,
+                            args.period, args.lapse, args.n, args.strata,
+                            args.seed, args.img, args.mask, args.end,
+                            args.cache, args.recursive, args.bundle,
+                            args.overwrite))
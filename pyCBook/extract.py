@@ -0,0 +1,159 @@
+""" Module for extracting bookkeeping results of sample pixels
+
+    Args:
+        -t (time): report time frame
+        -i (lapse): reporting interval
+        --overwrite: overwrite or not
+        ori: origin
+        samples: csv file of sample pixels with px and py columns
+        des: destination
+
+"""
+import os
+import argparse
+import numpy as np
+
+from .common import log
+from .io import csv2ndarray, carbon2pixels, store, is_store
+from .carbon import pools
+from .common import constants as cons
+
+
+def extract_pixels(ori, samples, period=[2000001, 2015365], lapse=1):
+    """ extract pools and reports of sample pixels, one pass for each line
+
+    Args:
+        ori (str): place to look for bookkeeping results
+        samples (list): sample pixels, [[px, py], ...]
+        period (list, int): reporting time period, [start, end]
+        laspe (int): reporting interval
+
+    Returns:
+        pixels (list): [px, py, pools, report] of each sample found
+
+    """
+    lines = {}
+    for px, py in samples:
+        lines.setdefault(int(py), []).append(int(px))
+    pixels = []
+    if is_store(ori):
+        stored = set(store(ori).lines())
+    for py in sorted(lines):
+        try:
+            _file = os.path.join(ori, 'carbon_r{}.npz'.format(py))
+            if is_store(ori):
+                exists = py in stored
+            else:
+                exists = os.path.isfile(_file)
+            if not exists:
+                log.warning('Find no line result for {}.'.format(py))
+                continue
+            found = carbon2pixels(_file, lines[py])
+            for px in lines[py]:
+                if px in found:
+                    pixels.append([px, py, found[px],
+                                    pools(found[px]).report(period, lapse)])
+                else:
+                    log.warning('Can not find pixel {} {}'.format(px, py))
+            log.info('Processed line {}'.format(py))
+        except:
+            log.warning('Failed to process line {}.'.format(py))
+            continue
+    return pixels
+
+
+def extract_samples(ori, samples, des, period=[2000001, 2015365], lapse=1,
+                    overwrite=False):
+    """ extract bookkeeping results of sample pixels into one file
+
+    Args:
+        ori (str): place to look for bookkeeping results
+        samples (str): csv file of sample pixels with px and py columns
+        des (str): output file
+        period (list, int): reporting time period, [start, end]
+        laspe (int): reporting interval
+        overwrite (bool): overwrite or not
+
+    Returns:
+        0: successful
+        1: error due to des
+        2: error reading samples
+        3: found no sample
+        4: error writing output
+
+    """
+    # check if output already exists
+    if (not overwrite) and os.path.isfile(des):
+        log.error('{} already exists.'.format(os.path.basename(des)))
+        return 1
+
+    # reading samples
+    log.info('Reading samples...')
+    try:
+        _samples = csv2ndarray(samples)
+        _samples = list(zip(_samples['px'], _samples['py']))
+    except:
+        log.error('Failed to read samples from {}'.format(samples))
+        return 2
+    log.info('Total number of samples: {}'.format(len(_samples)))
+
+    # extracting
+    log.info('Start extracting...')
+    pixels = extract_pixels(ori, _samples, period, lapse)
+    if len(pixels) == 0:
+        log.error('Found no sample.')
+        return 3
+
+    # write output
+    log.info('Writing output...')
+    try:
+        _pools = np.concatenate([x[2] for x in pixels])
+        report = np.zeros(sum([len(x[3]) for x in pixels]),
+                            dtype=cons.EXTRACT + cons.DTYPES2)
+        i = 0
+        for px, py, _pool, _report in pixels:
+            report['px'][i:(i + len(_report))] = px
+            report['py'][i:(i + len(_report))] = py
+            for x in _report.dtype.names:
+                report[x][i:(i + len(_report))] = _report[x]
+            i += len(_report)
+        np.savez(des, pools=_pools, report=report)
+    except:
+        log.error('Failed to write output to {}'.format(des))
+        return 4
+
+    # done
+    log.info('Process completed.')
+    log.info('Extracted {}/{} samples.'.format(len(pixels), len(_samples)))
+    return 0
+
+
+if __name__ == '__main__':
+    # parse options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--time', action='store', type=int, nargs=2,
+                        dest='period', default=[2000001,2015365],
+                        help='reporting period, [start, end]')
+    parser.add_argument('-i', '--lapse', action='store', type=int,
+                        dest='lapse', default=1, help='reporting interval')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite or not')
+    parser.add_argument('ori', default='./', help='origin')
+    parser.add_argument('samples', default='./', help='sample pixels')
+    parser.add_argument('des', default='./', help='destination')
+    args = parser.parse_args()
+
+    # print logs
+    log.info('Start extracting sample pixels...')
+    log.info('Looking in {}'.format(args.ori))
+    log.info('Samples from {}'.format(args.samples))
+    log.info('Saving as {}'.format(args.des))
+    log.info('Reporting period {} to {}'.format(args.period[0],
+                                                args.period[1]))
+    log.info('Reporting interval {}.'.format(args.lapse))
+    if args.overwrite:
+        log.info('Overwriting old files.')
+
+    # run function to extract samples
+    extract_samples(args.ori, args.samples, args.des, args.period, args.lapse,
+                    args.overwrite)
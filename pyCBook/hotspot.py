@@ -0,0 +1,196 @@
+""" Module for finding pixels with the highest emission
+
+    Args:
+        -p (pattern): searching pattern
+        -t (time): period of cumulative emission, [start, end]
+        -k (number): number of pixels to keep
+        -R (recursive): recursive when seaching files
+        -M (manifest): use a cached manifest to locate files
+        --prefetch: number of lines to read ahead
+        --overwrite: overwrite or not
+        ori: origin
+        des: destination
+
+"""
+import os
+import sys
+import heapq
+import argparse
+import numpy as np
+
+from .common import log, get_files, get_int, prefetch
+from .io import yatsm2pixels, store, is_store
+from .carbon import pools
+from .common import constants as cons
+
+
+def line_emission(pixels, period=[2000001, 2015365]):
+    """ cumulative emission of each pixel of a line over a period
+
+    Args:
+        pixels (list, ndarray): carbon pools of each pixel
+        period (list, int): period, [start, end]
+
+    Returns:
+        emission (ndarray): cumulative emission of each pixel
+        transition (ndarray): first and last land cover class of each pixel
+
+    """
+    group = np.repeat(np.arange(len(pixels)), [len(x) for x in pixels])
+    line_pools = pools(np.concatenate(pixels))
+    start, end = line_pools.report_interval([[[period[0], period[0]], 1],
+                                                [[period[1], period[1]], 1]],
+                                                group, len(pixels))
+    emission = end['emission'][:, 0] - start['emission'][:, 0]
+    transition = np.zeros((len(pixels), 2), dtype=np.int64)
+    for i, x in enumerate(pixels):
+        above = x[x['subpool'] == cons.SPNAME[0]]['class']
+        transition[i] = [above[0], above[-1]]
+    return emission, transition
+
+
+def hotspot_carbon(pattern, ori, des, period=[2000001, 2015365], k=100,
+                    recursive=False, ahead=0, manifest=False, overwrite=False):
+    """ find pixels with the highest cumulative emission
+
+    Args:
+        pattern (str): searching pattern, e.g. carbon_r*.npz
+        ori (str): place to look for inputs
+        des (str): output file
+        period (list, int): period of cumulative emission, [start, end]
+        k (int): number of pixels to keep
+        recursive (bool): recursive when searching file, or not
+        ahead (int): number of lines to read ahead, 0 for no prefetch
+        manifest (bool): use a cached manifest to locate files or not
+        overwrite (bool): overwrite or not
+
+    Returns:
+        0: successful
+        1: error due to des
+        2: error when searching files
+        3: found no file
+        4: error processing
+        5: error writing output
+
+    """
+    # check if output already exists
+    if (not overwrite) and os.path.isfile(des):
+        log.error('{} already exists.'.format(os.path.basename(des)))
+        return 1
+
+    # locate files
+    log.info('Locating files...')
+    try:
+        if is_store(ori):
+            carbon_list = store(ori).files(pattern)
+        else:
+            carbon_list = get_files(ori, pattern, recursive, manifest)
+        n = len(carbon_list)
+    except:
+        log.error('Failed to search for {}'.format(pattern))
+        return 2
+    else:
+        if n == 0:
+            log.error('Found no {}'.format(pattern))
+            return 3
+        else:
+            log.info('Found {} files.'.format(n))
+
+    # read bookkeeping results of a line, stable pixels have no emission
+    def read_line(_line):
+        return yatsm2pixels(os.path.join(_line[0], _line[1]))
+
+    # keep a heap of the top k pixels
+    heap = []
+    count = 0
+    log.info('Start finding hotspots...')
+    for _line, pixels, error in prefetch(read_line, carbon_list, ahead):
+        try:
+            py = get_int(_line[1])[0]
+            if error is not None:
+                raise error
+            if len(pixels) > 0:
+                emission, transition = line_emission(pixels, period)
+                for pixel, e, t in zip(pixels, emission, transition):
+                    item = (float(e), py, int(pixel[0]['px']), int(t[0]),
+                            int(t[1]))
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+                log.info('Processed line {}'.format(py))
+            else:
+                log.warning('Line {} empty.'.format(py))
+            count += 1
+        except:
+            log.warning('Failed to process line {}.'.format(_line[1]))
+            continue
+
+    # see if anything is processed
+    if count == 0:
+        log.error('Nothing is processed.')
+        return 4
+
+    # write output
+    log.info('Writing output...')
+    try:
+        r = np.array([(x[2], x[1], x[0], x[3], x[4]) for x in
+                        sorted(heap, reverse=True)], dtype=cons.HOTSPOT)
+        np.savetxt(des, r, delimiter=',', fmt=cons.HOTSPOT_FMT,
+                    header=','.join(r.dtype.names), comments='')
+    except:
+        log.error('Failed to write output to {}'.format(des))
+        return 5
+
+    # done
+    log.info('Process completed.')
+    log.info('Successfully processed {}/{} files.'.format(count, n))
+    return 0
+
+
+if __name__ == '__main__':
+    # parse options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--pattern', action='store', type=str,
+                        dest='pattern', default='carbon_r*.npz',
+                        help='searching pattern')
+    parser.add_argument('-t', '--time', action='store', type=int, nargs=2,
+                        dest='period', default=[2000001, 2015365],
+                        help='period of cumulative emission, [start, end]')
+    parser.add_argument('-k', '--number', action='store', type=int,
+                        dest='k', default=100,
+                        help='number of pixels to keep')
+    parser.add_argument('--prefetch', action='store', type=int,
+                        dest='ahead', default=0,
+                        help='number of lines to read ahead')
+    parser.add_argument('-M', '--manifest', action='store_true',
+                        help='use a cached manifest to locate files or not')
+    parser.add_argument('-R', '--recursive', action='store_true',
+                        help='recursive or not')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite or not')
+    parser.add_argument('ori', default='./', help='origin')
+    parser.add_argument('des', default='./', help='destination')
+    args = parser.parse_args()
+
+    # print logs
+    log.info('Start finding emission hotspots...')
+    log.info('Cumulative emission from {} to {}.'.format(args.period[0],
+                                                            args.period[1]))
+    log.info('Keeping top {} pixels.'.format(args.k))
+    log.info('Looking for {}'.format(args.pattern))
+    log.info('In {}'.format(args.ori))
+    log.info('Saving as {}'.format(args.des))
+    if args.ahead > 0:
+        log.info('Reading {} lines ahead.'.format(args.ahead))
+    if args.manifest:
+        log.info('Locating files with manifest.')
+    if args.recursive:
+        log.info('Recursive seaching.')
+    if args.overwrite:
+        log.info('Overwriting old files.')
+
+    # run function to find hotspots
+    sys.exit(hotspot_carbon(args.pattern, args.ori, args.des, args.period,
+                            args.k, args.recursive, args.ahead, args.manifest,
+                            args.overwrite))
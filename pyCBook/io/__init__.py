@@ -1,18 +1,53 @@
 """ Modules for io libarary
 """
-from .yatsm import yatsm2records, yatsm2pixels
-from .table import csv2list, csv2dict, csv2ndarray, list2csv
-from .image import imageGeo, image2array, array2image
+import importlib
+
+from .yatsm import (yatsm2records, yatsm2pixels, carbon2state, carbon2stable,
+                    stable2records, pixel_index, carbon2index, carbon2pixels,
+                    yatsm2slim, bundle2files, records2bundle,
+                    report2breakdown, report2nodes)
+from .table import csv2list, csv2dict, csv2ndarray, list2csv, csv2table
+from .store import store, is_store
 
 
 __all__ = [
     'yatsm2records',
     'yatsm2pixels',
+    'carbon2state',
+    'carbon2stable',
+    'stable2records',
+    'pixel_index',
+    'carbon2index',
+    'carbon2pixels',
+    'yatsm2slim',
+    'bundle2files',
+    'records2bundle',
+    'report2breakdown',
+    'report2nodes',
     'csv2dict',
     'csv2list',
     'csv2ndarray',
     'list2csv',
+    'csv2table',
     'imageGeo',
     'image2array',
-    'array2image'
+    'array2image',
+    'store',
+    'is_store'
 ]
+
+
+# image functions are imported on first use to avoid loading gdal
+_lazy = {
+    'imageGeo': 'image',
+    'image2array': 'image',
+    'array2image': 'image'
+}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        return getattr(importlib.import_module('.{}'.format(_lazy[name]),
+                                                __name__), name)
+    raise AttributeError('module {} has no attribute {}'.format(__name__,
+                                                                    name))
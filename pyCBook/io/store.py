@@ -0,0 +1,208 @@
+""" Module for IO of consolidated carbon stores
+"""
+import os
+import fnmatch
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ..common import get_int
+from ..common import constants as cons
+
+
+def is_store(path):
+    """ check if a folder is a carbon store
+
+    Args:
+        path (str): path to the folder
+
+    Returns:
+        is_store (bool): is store or not
+
+    """
+    return os.path.isfile(os.path.join(path, cons.STORE_META))
+
+
+class store:
+    """ consolidated store of line based bookkeeping results
+
+    Args:
+        path (str): place of the store
+        chunk (int): number of lines in each chunk file, for new store
+
+    Attributes:
+        kinds (list, dtype): dtype of records, state, stable summaries and
+                                pixel index
+
+    Variables:
+        path: place of the store
+        chunk: number of lines in each chunk file
+
+    Functions:
+        chunk_file (py, ext): path to the chunk file of a line
+        write (py, records, kind): append records of a line
+        write_line (py, parts): append records of several kinds of a line
+                                and commit them with one index entry
+        read (py, kind): read records of a line as memory map
+        index (k): read the index of a chunk
+        has (py, kind): check if a line is in the store, reads one index
+        lines (): list lines in the store, reads all indexes
+        files (pattern): list lines as files, [path, name]
+        compact (): drop records of rewritten lines from chunk files
+
+    Writing a line again, e.g. with overwrite or retry, appends the new
+    records to the chunk file and only the index points to them, so the old
+    records stay on disk until the store is compacted. An index entry with
+    records of kind 0 replaces all kinds of the line written before.
+
+    """
+    kinds = [cons.DTYPES, cons.STATE, cons.STABLE, cons.PIXEL_INDEX]
+
+    def __init__(self, path, chunk=cons.STORE_CHUNK):
+        self.path = path
+        meta = os.path.join(path, cons.STORE_META)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if not os.path.isfile(meta):
+            temp = '{}.{}'.format(meta, os.getpid())
+            with open(temp, 'w') as f:
+                f.write('chunk,{}\n'.format(chunk))
+            try:
+                os.link(temp, meta)
+            except OSError:
+                pass
+            os.remove(temp)
+        with open(meta, 'r') as f:
+            self.chunk = int(f.readline().strip().split(',')[1])
+
+    def chunk_file(self, py, ext='bin'):
+        return os.path.join(self.path, 'chunk_{}.{}'.format(py // self.chunk,
+                                                            ext))
+
+    def write(self, py, records, kind=0):
+        return self.write_line(py, [[records, kind]])
+
+    def write_line(self, py, parts):
+        parts = [[np.ascontiguousarray(x, dtype=self.kinds[k]), k]
+                    for x, k in parts]
+        entry = [py]
+        with open(self.chunk_file(py), 'ab') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0, 2)
+                for records, kind in parts:
+                    if kind == 0:
+                        pixels = len(np.unique(records['px']))
+                    else:
+                        pixels = len(records)
+                    entry.extend([kind, f.tell(), len(records), pixels])
+                    f.write(records.tobytes())
+                f.flush()
+                # a single index line commits all parts at once, a line
+                # left unfinished by a crash is dropped first
+                with open(self.chunk_file(py, 'idx'), 'a+b') as g:
+                    g.seek(0)
+                    data = g.read()
+                    if (len(data) > 0) and (not data.endswith(b'\n')):
+                        g.truncate(data.rfind(b'\n') + 1)
+                    g.write('{}\n'.format(','.join([str(x) for x in entry]))
+                            .encode())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return 0
+
+    def index(self, k):
+        index = {}
+        _file = os.path.join(self.path, 'chunk_{}.idx'.format(k))
+        if os.path.isfile(_file):
+            with open(_file, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        continue
+                    x = [int(y) for y in line.strip().split(',')]
+                    if (len(x) < 5) or ((len(x) - 1) % 4 != 0):
+                        continue
+                    parts = [x[i:(i + 4)] for i in range(1, len(x), 4)]
+                    if any([y[0] == 0 for y in parts]):
+                        for k in range(len(self.kinds)):
+                            index.pop((x[0], k), None)
+                    for y in parts:
+                        index[(x[0], y[0])] = y[1:]
+        return index
+
+    def read(self, py, kind=0):
+        index = self.index(py // self.chunk)
+        if (py, kind) not in index:
+            if (kind > 0) and ((py, 0) in index):
+                return np.array([], dtype=self.kinds[kind])
+            raise KeyError('Line {} not in store {}'.format(py, self.path))
+        offset, length, pixels = index[(py, kind)]
+        if length == 0:
+            return np.array([], dtype=self.kinds[kind])
+        return np.memmap(self.chunk_file(py), dtype=self.kinds[kind], mode='r',
+                            offset=offset, shape=(length, ))
+
+    def has(self, py, kind=0):
+        return (py, kind) in self.index(py // self.chunk)
+
+    def lines(self):
+        lines = set()
+        for _file in os.listdir(self.path):
+            if fnmatch.fnmatch(_file, 'chunk_*.idx'):
+                k = int(_file.split('_')[1].split('.')[0])
+                lines.update([x[0] for x in self.index(k) if x[1] == 0])
+        return sorted(lines)
+
+    def files(self, pattern='carbon_r*.npz'):
+        if not any(x in pattern for x in '*?['):
+            py = get_int(pattern)
+            if (len(py) > 0 and self.has(py[0]) and
+                    pattern == 'carbon_r{}.npz'.format(py[0])):
+                return [[self.path, pattern]]
+            return []
+        return [[self.path, x] for x in ['carbon_r{}.npz'.format(py)
+                for py in self.lines()] if fnmatch.fnmatch(x, pattern)]
+
+    def compact(self):
+        """ rewrite chunk files with only the latest records of each line,
+            must not run while another job reads or writes the store
+
+        Returns:
+            size (int): bytes freed
+
+        """
+        freed = 0
+        for _file in sorted(os.listdir(self.path)):
+            if not fnmatch.fnmatch(_file, 'chunk_*.idx'):
+                continue
+            k = int(_file.split('_')[1].split('.')[0])
+            _bin = os.path.join(self.path, 'chunk_{}.bin'.format(k))
+            _idx = os.path.join(self.path, _file)
+            index = self.index(k)
+            size = os.path.getsize(_bin) if os.path.isfile(_bin) else 0
+            used = sum([x[1] * np.dtype(self.kinds[key[1]]).itemsize
+                        for key, x in index.items()])
+            if used == size:
+                continue
+            with open(_bin, 'rb') as f, open(_bin + '.tmp', 'wb') as g, \
+                    open(_idx + '.tmp', 'w') as h:
+                for py in sorted(set([x[0] for x in index])):
+                    entry = [py]
+                    for kind in range(len(self.kinds)):
+                        if (py, kind) not in index:
+                            continue
+                        offset, length, pixels = index[(py, kind)]
+                        f.seek(offset)
+                        itemsize = np.dtype(self.kinds[kind]).itemsize
+                        entry.extend([kind, g.tell(), length, pixels])
+                        g.write(f.read(length * itemsize))
+                    h.write('{}\n'.format(','.join([str(x) for x in entry])))
+            os.replace(_bin + '.tmp', _bin)
+            os.replace(_idx + '.tmp', _idx)
+            freed += size - used
+        return freed
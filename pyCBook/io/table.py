@@ -79,6 +79,73 @@ def csv2ndarray(_file, header=True):
     return array
 
 
+def csv2table(_file, schema=None, cache=False):
+    """ read a csv file based table to a typed numpy array by column
+
+    Args:
+        _file (str): path to input text file, first line header
+        schema (list): dtype of the table, None to infer from data
+        cache (bool): keep a binary copy of the table next to the file
+
+    Returns:
+        array (ndarray): the numpy array, fixed width strings and numbers
+
+    """
+    sidecar = '{}.npy'.format(_file)
+    mtime = os.path.getmtime(_file)
+    if cache and os.path.isfile(sidecar) and (os.path.getmtime(sidecar) ==
+                                                mtime):
+        array = np.load(sidecar)
+        if (schema is None) or (array.dtype == np.dtype(schema)):
+            return array
+    with open(_file, 'r') as f:
+        reader = csv.reader(f)
+        header = [x.strip().strip('\'"') for x in next(reader)]
+        table = [x for x in reader if len(x) > 0]
+    columns = [np.array([x[i].strip() for x in table], dtype=str)
+                for i in range(len(header))]
+    if schema is None:
+        schema = [(x, column_type(y)) for x, y in zip(header, columns)]
+    array = np.zeros(len(table), dtype=schema)
+    for x, y in zip(header, columns):
+        if array.dtype[x].kind == 'U':
+            y = np.char.strip(y, '\'"')
+        array[x] = y
+    if cache:
+        try:
+            temp = '{}.{}.npy'.format(_file, os.getpid())
+            np.save(temp, array)
+            os.utime(temp, (mtime, mtime))
+            os.rename(temp, sidecar)
+        except:
+            pass
+    return array
+
+
+def column_type(column):
+    """ infer the type of a table column
+
+    Args:
+        column (ndarray): values of the column as strings
+
+    Returns:
+        _type (str): int, float or fixed width string
+
+    """
+    if (len(column) > 0) and (np.char.str_len(column).min() > 0):
+        quoted = (np.char.startswith(column, "'") |
+                    np.char.startswith(column, '"'))
+        if not quoted.any():
+            for _type in ['<i8', '<f8']:
+                try:
+                    column.astype(_type)
+                    return _type
+                except ValueError:
+                    pass
+    return 'U{}'.format(max(1, np.char.str_len(
+                        np.char.strip(column, '\'"')).max(initial=0)))
+
+
 def list2csv(_data, _file, overwrite=False):
     """ write a list of lists into csv file
 
@@ -1,8 +1,139 @@
 """ Module for IO of YATSM files
 """
+import os
+import hashlib
+import threading
 import numpy as np
+from collections import OrderedDict
 
-from ..common import log
+from .store import store, is_store
+from ..common import log, get_int
+from ..common import constants as cons
+
+
+_index_cache = OrderedDict()
+_index_lock = threading.Lock()
+_bundle_cache = {}
+
+
+def read_store(_file, kind=0):
+    """ read a line from a carbon store if the file is in a store
+
+    Args:
+        _file (str): path to the line file, e.g. store/carbon_r1.npz
+        kind (int): 0 for records, 1 for state, 2 for stable, 3 for index
+
+    Returns:
+        records (ndarray): records of the line, None if not in a store
+
+    """
+    if os.path.isfile(_file):
+        return None
+    path, name = os.path.split(_file)
+    if not is_store(path):
+        return None
+    return store(path).read(get_int(name)[0], kind)
+
+
+def bundle_rows(_file):
+    """ read records of a bundle and its row index, the last bundle is cached
+
+    Args:
+        _file (str): path to the bundle
+
+    Returns:
+        records (ndarray): records of the bundle grouped by row
+        rows (ndarray): py, start and stop record of each row
+
+    """
+    key = (_file, os.path.getmtime(_file))
+    if key in _bundle_cache:
+        return _bundle_cache[key]
+    records = yatsm2records(_file)
+    bundle = np.load(_file)
+    if 'rows' in list(bundle.keys()):
+        rows = bundle['rows']
+    else:
+        records, rows = row_index(records)
+    _bundle_cache.clear()
+    _bundle_cache[key] = (records, rows)
+    return records, rows
+
+
+def row_index(records):
+    """ group records of many lines by row and index the rows
+
+    Args:
+        records (ndarray): records of many lines
+
+    Returns:
+        records (ndarray): records grouped by row, original order kept
+        rows (ndarray): py, start and stop record of each row
+
+    """
+    records = records[np.argsort(records['py'], kind='mergesort')]
+    pys, start = np.unique(records['py'], return_index=True)
+    rows = np.zeros(len(pys), dtype=cons.BUNDLE_INDEX)
+    rows['py'] = pys
+    rows['start'] = start
+    rows['stop'] = np.append(start[1:], len(records))
+    return records, rows
+
+
+def read_bundle(_file):
+    """ read a line from a bundle if the file is in a bundle
+
+    Args:
+        _file (str): path to the line file, e.g. bundle.npz/yatsm_r1.npz
+
+    Returns:
+        records (ndarray): records of the line, None if not in a bundle
+
+    """
+    path, name = os.path.split(_file)
+    if not os.path.isfile(path):
+        return None
+    records, rows = bundle_rows(path)
+    row = rows[rows['py'] == get_int(name)[0]]
+    if len(row) == 0:
+        return records[0:0]
+    return records[row['start'][0]:row['stop'][0]]
+
+
+def bundle2files(_file, prefix='yatsm'):
+    """ list lines in a bundle as files
+
+    Args:
+        _file (str): path to the bundle
+        prefix (str): prefix of line file names
+
+    Returns:
+        files (list): lines in the bundle, [path, name]
+
+    """
+    # the row index is enough to list lines, records are decoded later
+    bundle = np.load(_file)
+    if 'rows' in list(bundle.keys()):
+        rows = bundle['rows']
+    else:
+        records, rows = bundle_rows(_file)
+    return [[_file, '{}_r{}.npz'.format(prefix, py)] for py in rows['py']]
+
+
+def records2bundle(_file, records):
+    """ save records of many lines as a bundle with a row index
+
+    Args:
+        _file (str): path to the bundle
+        records (ndarray): records of many lines
+
+    Returns:
+        0: successful
+
+    """
+    records, rows = row_index(records)
+    np.savez(_file, record=records, rows=rows)
+    return 0
 
 
 def yatsm2records(_file, verbose=False):
@@ -16,25 +147,276 @@ def yatsm2records(_file, verbose=False):
         records (ndarray): yatsm records
 
     """
+    records = read_store(_file)
+    if records is not None:
+        return records
+    records = read_bundle(_file)
+    if records is not None:
+        return records
     yatsm = np.load(_file)
     ks = list(yatsm.keys())
     if 'record' in ks:
         records = yatsm['record']
+    elif 'arr_0' in ks:
+        records = yatsm['arr_0']
     else:
         records = yatsm[ks[0]]
-        n = len(records)
     if verbose:
-        log.info('Total number of records: {}'.format(n))
+        log.info('Total number of records: {}'.format(len(records)))
     return records
 
 
-def yatsm2pixels(_file, x=[], verbose=False):
+def carbon2state(_file):
+    """ read terminal states of pixels from a bookkeeping result file
+
+    Args:
+        _file (str): path to bookkeeping result file
+
+    Returns:
+        records (ndarray): bookkeeping records
+        state (ndarray): terminal state of each pixel, empty if not saved
+
+    """
+    state = read_store(_file, 1)
+    if state is not None:
+        return read_store(_file), state
+    carbon = np.load(_file)
+    records = yatsm2records(_file)
+    if 'state' in list(carbon.keys()):
+        state = carbon['state']
+    else:
+        state = np.array([], dtype=cons.STATE)
+    return records, state
+
+
+def carbon2stable(_file):
+    """ read summary records of stable pixels from a bookkeeping result file
+
+    Args:
+        _file (str): path to bookkeeping result file
+
+    Returns:
+        stable (ndarray): summary records of stable pixels, empty if none
+
+    """
+    stable = read_store(_file, 2)
+    if stable is not None:
+        return stable
+    carbon = np.load(_file)
+    if 'stable' in list(carbon.keys()):
+        return carbon['stable']
+    else:
+        return np.array([], dtype=cons.STABLE)
+
+
+def report2breakdown(_file):
+    """ read breakdown by subpool and transition from a report file
+
+    Args:
+        _file (str): path to report file
+
+    Returns:
+        keys (ndarray): subpool and transition of each key, None if the
+                        report has no breakdown
+        values (ndarray): values of each key, [key, date, field]
+
+    """
+    report = np.load(_file)
+    if 'keys' not in list(report.keys()):
+        return None, None
+    return report['keys'], report['breakdown']
+
+
+def report2nodes(_file):
+    """ read partial sums of tree nodes from a condensed report
+
+    Args:
+        _file (str): path to condensed report
+
+    Returns:
+        level (int): level of the nodes in the tree, None if not kept
+        index (list, int): index of each node in the tree
+        nodes (list): [partial sum, partial breakdown] of each node, None
+                        for a node with nothing summed
+
+    """
+    report = np.load(_file)
+    if 'partial' not in list(report.keys()):
+        return None, None, None
+    keys = []
+    if 'keys' in list(report.keys()):
+        keys = [(str(x['subpool']), int(x['from']), int(x['to']))
+                for x in report['keys']]
+    partial = report['partial']
+    split = report['split']
+    has = report['has']
+    nodes = []
+    for i, filled in enumerate(report['filled']):
+        if not filled:
+            nodes.append(None)
+            continue
+        nodes.append([(partial[i, 0], partial[i, 1]),
+                        dict([(x, (split[i, j, 0], split[i, j, 1]))
+                                for j, x in enumerate(keys) if has[i, j]])])
+    return (int(report['level']), [int(x) for x in report['nodes']],
+            nodes)
+
+
+def stable2records(stable):
+    """ expand summary records of stable pixels to carbon pools
+
+    Args:
+        stable (ndarray): summary records of stable pixels
+
+    Returns:
+        records (ndarray): carbon pools of the stable pixels
+
+    """
+    records = np.zeros(len(stable), dtype=cons.DTYPES)
+    records['pool'] = cons.PNAME[0]
+    records['subpool'] = cons.SPNAME[0]
+    records['func'] = 'none'
+    for x in ['class', 'px', 'py', 'psize', 'start', 'end']:
+        records[x] = stable[x]
+    records['biomass'][:, 0] = stable['biomass']
+    records['biomass'][:, 1] = stable['biomass']
+    return records
+
+
+def pixel_index(records):
+    """ index the row range of each pixel in line records
+
+    Args:
+        records (ndarray): line records grouped by pixel
+
+    Returns:
+        index (ndarray): px, start and stop row of each pixel
+
+    """
+    if len(records) == 0:
+        return np.array([], dtype=cons.PIXEL_INDEX)
+    px = np.asarray(records['px'])
+    start = np.concatenate([[0], np.nonzero(px[1:] != px[:-1])[0] + 1])
+    index = np.zeros(len(start), dtype=cons.PIXEL_INDEX)
+    index['px'] = px[start]
+    index['start'] = start
+    index['stop'] = np.append(start[1:], len(px))
+    if len(np.unique(index['px'])) < len(index):
+        raise ValueError('Records are not grouped by pixel.')
+    return index
+
+
+def carbon2index(_file, records=None):
+    """ read or build pixel index of a bookkeeping result file
+
+    Args:
+        _file (str): path to bookkeeping result file
+        records (ndarray): records of the file if already read
+
+    Returns:
+        index (ndarray): px, start and stop row of each pixel
+
+    """
+    index = read_store(_file, 3)
+    if (index is not None) and (len(index) > 0):
+        return index
+    if index is not None:
+        if records is None:
+            records = yatsm2records(_file)
+        return pixel_index(records)
+    mtime = os.path.getmtime(_file)
+    with _index_lock:
+        if (_file in _index_cache) and (_index_cache[_file][0] == mtime):
+            _index_cache.move_to_end(_file)
+            return _index_cache[_file][1]
+    carbon = np.load(_file)
+    if 'index' in list(carbon.keys()):
+        index = carbon['index']
+    else:
+        if records is None:
+            records = yatsm2records(_file)
+        index = pixel_index(records)
+
+    # least recently used files are dropped, one entry per file
+    with _index_lock:
+        _index_cache[_file] = [mtime, index]
+        _index_cache.move_to_end(_file)
+        while len(_index_cache) > cons.SERVE_CACHE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def carbon2pixels(_file, x=[]):
+    """ read pools of selected pixels from a bookkeeping result file
+
+    Args:
+        _file (str): path to bookkeeping result file
+        x (list/int): which pixels to grab, [] for all
+
+    Returns:
+        pixels (dict): carbon pools of each pixel found
+
+    """
+    if type(x) == int:
+        x = [x]
+    pixels = {}
+    records = yatsm2records(_file)
+    if len(records) > 0:
+        for i in carbon2index(_file, records):
+            if (i['px'] in x) or (len(x) == 0):
+                pixels[i['px']] = np.array(records[i['start']:i['stop']])
+    stable = carbon2stable(_file)
+    if len(stable) > 0:
+        stable = stable2records(stable)
+        for i in range(0, len(stable)):
+            if (stable[i]['px'] in x) or (len(x) == 0):
+                pixels[stable[i]['px']] = stable[i:(i + 1)]
+    return pixels
+
+
+def yatsm2slim(_file, cache):
+    """ read YATSM result file through a cache of slim records
+
+    Args:
+        _file (str): path to yatsm file
+        cache (str): place to keep slim records, named by line and a hash
+                        of the full path and size of the file
+
+    Returns:
+        records (ndarray): yatsm records with only the columns in use
+
+    """
+    mtime = os.path.getmtime(_file)
+    key = hashlib.sha1('{}:{}'.format(os.path.abspath(_file),
+                        os.path.getsize(_file)).encode()).hexdigest()[:16]
+    slim = os.path.join(cache, '{}_{}.npy'.format(
+                        os.path.splitext(os.path.basename(_file))[0], key))
+    if os.path.isfile(slim) and (os.path.getmtime(slim) == mtime):
+        return np.load(slim, mmap_mode='r')
+    yatsm = yatsm2records(_file)
+    records = np.zeros(len(yatsm), dtype=cons.SLIM)
+    for x in records.dtype.names:
+        records[x] = yatsm[x]
+    try:
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+        temp = '{}.{}.npy'.format(slim[:-4], os.getpid())
+        np.save(temp, records)
+        os.utime(temp, (mtime, mtime))
+        os.rename(temp, slim)
+    except:
+        log.warning('Failed to cache slim records in {}'.format(cache))
+    return records
+
+
+def yatsm2pixels(_file, x=[], verbose=False, cache='NA'):
     """ read YATSM result file and arrange by pixel
 
     Args:
         _file (str): path to yatsm file
         x (list/int): which pixels to grab, [] for all
         verbose (bool): verbose or not
+        cache (str): place to keep slim records, NA for no cache
 
     Returns:
         pixels (ndarray): records of selected pixels
@@ -43,7 +425,10 @@ def yatsm2pixels(_file, x=[], verbose=False):
     if type(x) == int:
         x = [x]
     pixels = []
-    records = yatsm2records(_file, verbose)
+    if (cache == 'NA') or (not os.path.isfile(_file)):
+        records = yatsm2records(_file, verbose)
+    else:
+        records = yatsm2slim(_file, cache)
     if len(records) > 0:
         pxs = np.unique(records['px'])
         for px in pxs:
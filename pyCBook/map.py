@@ -4,7 +4,14 @@
         -p (pattern): searching pattern
         -t (time): mapping time stamp
         -m (map): what to map
+        -f (factor): aggregation factor of a coarse level, repeat for more,
+                        levels hold total Mg C of each block instead of the
+                        Mg biomass per hectare of a full resolution map
+        --retry-failed: only redo lines recorded as failed
+        --timeout: give up a line after this many seconds
         -R (recursive): recursive when seaching files
+        -M (manifest): use a cached manifest to locate files
+        --prefetch: number of lines to read ahead
         --overwrite: overwrite or not
         ori: origin
         img: image for geoinfo
@@ -17,14 +24,17 @@ import argparse
 import numpy as np
 from osgeo import gdal
 
-from .common import log, get_files, get_int, doy_to_ordinal, ordinal_to_doy
-from .io import yatsm2pixels, yatsm2records, imageGeo, image2array, array2image
-from .carbon import pools
+from .common import (log, get_files, get_int, doy_to_ordinal, ordinal_to_doy,
+                        prefetch, line_timeout, read_failures, failures)
+from .io import (yatsm2pixels, yatsm2records, imageGeo, image2array,
+                    array2image, carbon2stable, store, is_store)
+from .carbon import pools, eval_stable
 from .common import constants as cons
 
 
 def map_carbon(pattern, _time, map, img, ori, des, overwrite=False,
-                recursive=False):
+                recursive=False, ahead=0, manifest=False, retry_failed=False,
+                timeout=0):
     """ mapping carbon bookkeeping results
 
     Args:
@@ -36,6 +46,11 @@ def map_carbon(pattern, _time, map, img, ori, des, overwrite=False,
         des (str): output image
         overwrite (bool): overwrite or not
         recursive (bool): recursive when searching file, or not
+        ahead (int): number of lines to read ahead, 0 for no prefetch
+        manifest (bool): use a cached manifest to locate files or not
+        retry_failed (bool): only redo lines recorded in the retry file, the
+                                rest is kept from the existing output
+        timeout (int): give up a line after this many seconds, 0 for never
 
     Returns:
         0: successful
@@ -48,14 +63,34 @@ def map_carbon(pattern, _time, map, img, ori, des, overwrite=False,
 
     """
     # check if output already exists
-    if (not overwrite) and os.path.isfile(des):
+    if (not overwrite) and (not retry_failed) and os.path.isfile(des):
         log.error('{} already exists.'.format(os.path.basename(des)))
         return 1
 
+    # failed lines are recorded in a retry file next to the output
+    retry = '{}_failed.json'.format(os.path.splitext(des)[0])
+    retries = failures(retry)
+    lines = None
+    if retry_failed:
+        try:
+            lines = set([x['line'] for x in read_failures(retry)])
+        except:
+            log.error('Failed to read retry file {}'.format(retry))
+            return 2
+        if len(lines) == 0:
+            log.info('No failed line to retry.')
+            return 0
+        log.info('Retrying {} failed lines.'.format(len(lines)))
+
     # locate files
     log.info('Locating files...')
     try:
-        carbon_list = get_files(ori, pattern, recursive)
+        if is_store(ori):
+            carbon_list = store(ori).files(pattern)
+        else:
+            carbon_list = get_files(ori, pattern, recursive, manifest)
+        if lines is not None:
+            carbon_list = [x for x in carbon_list if get_int(x[1])[0] in lines]
         n = len(carbon_list)
     except:
         log.error('Failed to search for {}'.format(pattern))
@@ -78,36 +113,62 @@ def map_carbon(pattern, _time, map, img, ori, des, overwrite=False,
     # initialize output
     log.info('Initializing output...')
     try:
-        r = np.zeros((geo['lines'], geo['samples']), np.int32) + cons.MAP_NODATA
+        if retry_failed:
+            r = image2array(des, 1, np.int32)
+        else:
+            r = (np.zeros((geo['lines'], geo['samples']), np.int32) +
+                    cons.MAP_NODATA)
         count = 0
     except:
         log.error('Failed to initialize output.')
         return 5
 
+    # read bookkeeping results of a line
+    def read_line(_line):
+        return [yatsm2pixels(os.path.join(_line[0], _line[1])),
+                carbon2stable(os.path.join(_line[0], _line[1]))]
+
     # mapping
     log.info('Start generating map...')
-    for _line in carbon_list:
+    for _line, inputs, error in prefetch(read_line, carbon_list, ahead):
         try:
-            pixels = yatsm2pixels(os.path.join(_line[0], _line[1]))
             py = get_int(_line[1])[0]
             px = -1
-            if len(pixels) > 0:
-                for pixel in pixels:
-                    px = pixel[0]['px']
-                    pixel_pools = pools(pixel)
-                    record = pixel_pools.eval_sum(_time)
-                    r[py, px] = record[map] / (cons.SCALE_FACTOR * pixel_pools.pools[0]['psize'])
-                    #r['biomass'] += record['biomass']
-                    #r['emission'] += record['emission']
-                    #r['productivity'] += record['productivity']
-                log.info('Processed line {}'.format(py))
-            else:
-                log.warning('Line {} empty.'.format(py))
+            if error is not None:
+                raise error
+            with line_timeout(timeout):
+                pixels, stable = inputs
+                if len(pixels) + len(stable) > 0:
+                    for pixel in pixels:
+                        px = pixel[0]['px']
+                        pixel_pools = pools(pixel)
+                        record = pixel_pools.eval_sum(_time)
+                        r[py, px] = record[map] / (cons.SCALE_FACTOR *
+                                            pixel_pools.pools[0]['psize'])
+                        #r['biomass'] += record['biomass']
+                        #r['emission'] += record['emission']
+                        #r['productivity'] += record['productivity']
+                    if len(stable) > 0:
+                        record = eval_stable(stable, _time)
+                        r[py, stable['px']] = record[map] / (
+                                    cons.SCALE_FACTOR * stable['psize'])
+                    log.info('Processed line {}'.format(py))
+                else:
+                    log.warning('Line {} empty.'.format(py))
             count += 1
-        except:
+        except Exception as e:
             log.warning('Failed to process line {} pixel {}.'.format(py, px))
+            retries.add(py, px, e, _line[1])
             continue
 
+    # record failed lines to be retried
+    try:
+        if retries.save() > 0:
+            log.warning('{} failed lines recorded in {}'.format(
+                                                len(retries.lines()), retry))
+    except:
+        log.warning('Failed to write retry file {}'.format(retry))
+
     # see if anything is processed
     if count == 0:
         log.error('Nothing is processed.')
@@ -126,6 +187,215 @@ def map_carbon(pattern, _time, map, img, ori, des, overwrite=False,
     return 0
 
 
+def line_values(pixels, stable, _time, map):
+    """ evaluate carbon of each pixel of a line at a date
+
+    Args:
+        pixels (list, ndarray): carbon pools of each pixel
+        stable (ndarray): summary records of stable pixels
+        _time (int): date
+        map (str): what to map
+
+    Returns:
+        px (ndarray): pixel x location
+        values (ndarray): carbon of each pixel in Mg C, not per hectare
+
+    """
+    px = [np.array([x[0]['px'] for x in pixels], dtype=np.int64)]
+    values = [np.zeros(len(pixels))]
+    if len(pixels) > 0:
+        group = np.repeat(np.arange(len(pixels)), [len(x) for x in pixels])
+        record = pools(np.concatenate(pixels)).report_interval(
+                        [[[_time, _time], 1]], group, len(pixels))[0]
+        values[0] = record[map][:, 0]
+    if len(stable) > 0:
+        px.append(stable['px'].astype(np.int64))
+        values.append(eval_stable(stable, _time)[map])
+    return np.concatenate(px), np.concatenate(values)
+
+
+def pyramid_geo(geo, factor):
+    """ spatial reference of a coarse level
+
+    Args:
+        geo (dic): spatial reference of the full resolution image
+        factor (int): aggregation factor
+
+    Returns:
+        geo2 (dic): spatial reference of the coarse level
+
+    """
+    geo2 = dict(geo)
+    trans = list(geo['geotrans'])
+    for i in [1, 2, 4, 5]:
+        trans[i] = trans[i] * factor
+    geo2['geotrans'] = tuple(trans)
+    geo2['lines'] = -(-geo['lines'] // factor)
+    geo2['samples'] = -(-geo['samples'] // factor)
+    return geo2
+
+
+def map_pyramid(pattern, _time, map, img, ori, des, factors=[33],
+                overwrite=False, recursive=False, ahead=0, manifest=False,
+                retry_failed=False, timeout=0):
+    """ mapping block sums of carbon at coarse levels in one pass
+
+    Levels are Float32 totals in Mg C of all pixels in each block, unlike
+    map_carbon which writes Int32 Mg biomass per hectare of each pixel, i.e.
+    carbon divided by SCALE_FACTOR and pixel size.
+
+    Args:
+        pattern (str): searching pattern, e.g. carbon_r*.npz
+        _time (int): mapping time stamp
+        map (str): what to map
+        img (str): path to image to read geoinfo from
+        ori (str): place to look for inputs
+        des (str): output image, each level is saved with _x{factor}
+        factors (list, int): aggregation factors
+        overwrite (bool): overwrite or not
+        recursive (bool): recursive when searching file, or not
+        ahead (int): number of lines to read ahead, 0 for no prefetch
+        manifest (bool): use a cached manifest to locate files or not
+        retry_failed (bool): only redo lines recorded in the retry file, the
+                                rest is kept from the existing output
+        timeout (int): give up a line after this many seconds, 0 for never
+
+    Returns:
+        0: successful
+        1: error due to des
+        2: error when searching files
+        3: found no file
+        4: error reading geo info
+        5: error processing
+        6: error writing output
+
+    """
+    # check if output already exists
+    root, ext = os.path.splitext(des)
+    outputs = ['{}_x{}{}'.format(root, x, ext) for x in factors]
+    for x in outputs:
+        if (not overwrite) and (not retry_failed) and os.path.isfile(x):
+            log.error('{} already exists.'.format(os.path.basename(x)))
+            return 1
+
+    # failed lines are recorded in a retry file next to the output
+    retry = '{}_failed.json'.format(os.path.splitext(des)[0])
+    retries = failures(retry)
+    lines = None
+    if retry_failed:
+        try:
+            lines = set([x['line'] for x in read_failures(retry)])
+        except:
+            log.error('Failed to read retry file {}'.format(retry))
+            return 2
+        if len(lines) == 0:
+            log.info('No failed line to retry.')
+            return 0
+        log.info('Retrying {} failed lines.'.format(len(lines)))
+
+    # locate files
+    log.info('Locating files...')
+    try:
+        if is_store(ori):
+            carbon_list = store(ori).files(pattern)
+        else:
+            carbon_list = get_files(ori, pattern, recursive, manifest)
+        if lines is not None:
+            carbon_list = [x for x in carbon_list if get_int(x[1])[0] in lines]
+        n = len(carbon_list)
+    except:
+        log.error('Failed to search for {}'.format(pattern))
+        return 2
+    else:
+        if n == 0:
+            log.error('Found no {}'.format(pattern))
+            return 3
+        else:
+            log.info('Found {} files.'.format(n))
+
+    # read geo information
+    log.info('Reading GeoInfo...')
+    try:
+        geo = imageGeo(img)
+        geos = [pyramid_geo(geo, x) for x in factors]
+    except:
+        log.error('Failed to read Geo from {}'.format(img))
+        return 4
+
+    # initialize output, only the coarse levels are kept in memory
+    log.info('Initializing output...')
+    try:
+        if retry_failed:
+            levels = [image2array(x, 1, np.float64) for x in outputs]
+            counts = [(x != cons.MAP_NODATA).astype(np.int64) for x in levels]
+            for x in levels:
+                x[x == cons.MAP_NODATA] = 0
+        else:
+            levels = [np.zeros((x['lines'], x['samples'])) for x in geos]
+            counts = [np.zeros((x['lines'], x['samples']), np.int64)
+                        for x in geos]
+        count = 0
+    except:
+        log.error('Failed to initialize output.')
+        return 5
+
+    # read bookkeeping results of a line
+    def read_line(_line):
+        return [yatsm2pixels(os.path.join(_line[0], _line[1])),
+                carbon2stable(os.path.join(_line[0], _line[1]))]
+
+    # mapping
+    log.info('Start generating levels...')
+    for _line, inputs, error in prefetch(read_line, carbon_list, ahead):
+        try:
+            py = get_int(_line[1])[0]
+            if error is not None:
+                raise error
+            pixels, stable = inputs
+            if len(pixels) + len(stable) > 0:
+                with line_timeout(timeout):
+                    px, values = line_values(pixels, stable, _time, map)
+                for factor, level, _count in zip(factors, levels, counts):
+                    np.add.at(level[py // factor], px // factor, values)
+                    np.add.at(_count[py // factor], px // factor, 1)
+                log.info('Processed line {}'.format(py))
+            else:
+                log.warning('Line {} empty.'.format(py))
+            count += 1
+        except Exception as e:
+            log.warning('Failed to process line {}.'.format(_line[1]))
+            retries.add(py, -1, e, _line[1])
+            continue
+
+    # record failed lines to be retried
+    try:
+        if retries.save() > 0:
+            log.warning('{} failed lines recorded in {}'.format(
+                                                len(retries.lines()), retry))
+    except:
+        log.warning('Failed to write retry file {}'.format(retry))
+
+    # see if anything is processed
+    if count == 0:
+        log.error('Nothing is processed.')
+        return 5
+
+    # write output
+    log.info('Writing output...')
+    for x, _geo, level, _count in zip(outputs, geos, levels, counts):
+        level[_count == 0] = cons.MAP_NODATA
+        if array2image(level.astype(np.float32), _geo, x, map,
+                        cons.MAP_NODATA, gdal.GDT_Float32, 'GTiff',
+                        ['COMPRESS=PACKBITS']) > 0:
+            log.error('Failed to write output to {}'.format(x))
+            return 6
+
+    # done
+    log.info('Process completed.')
+    log.info('Successfully processed {}/{} files.'.format(count, n))
+    return 0
+
+
 if __name__ == '__main__':
     # parse options
     parser = argparse.ArgumentParser()
@@ -136,6 +406,21 @@ if __name__ == '__main__':
                         default=2001001, help='mapping time stamp')
     parser.add_argument('-m', '--map', action='store', type=str, dest='map',
                         default='net', help='what to map')
+    parser.add_argument('-f', '--factor', action='append', type=int,
+                        dest='factors', default=None,
+                        help='aggregation factor of a coarse level, levels '
+                                'hold total Mg C of each block')
+    parser.add_argument('--retry-failed', action='store_true',
+                        dest='retry_failed',
+                        help='only redo lines recorded as failed or not')
+    parser.add_argument('--timeout', action='store', type=int,
+                        dest='timeout', default=0,
+                        help='give up a line after this many seconds')
+    parser.add_argument('--prefetch', action='store', type=int,
+                        dest='ahead', default=0,
+                        help='number of lines to read ahead')
+    parser.add_argument('-M', '--manifest', action='store_true',
+                        help='use a cached manifest to locate files or not')
     parser.add_argument('-R', '--recursive', action='store_true',
                         help='recursive or not')
     parser.add_argument('--overwrite', action='store_true',
@@ -149,15 +434,33 @@ if __name__ == '__main__':
     log.info('Start mapping carbon...')
     log.info('Time stamp {}.'.format(args.time))
     log.info('Make {} map.'.format(args.map))
+    if args.factors is not None:
+        log.info('Aggregating by {}.'.format(', '.join([str(x) for x in
+                                                        args.factors])))
     log.info('Looking for {}'.format(args.pattern))
     log.info('In {}'.format(args.ori))
     log.info('Geo from {}'.format(args.img))
     log.info('Saving as {}'.format(args.des))
+    if args.retry_failed:
+        log.info('Retrying failed lines.')
+    if args.timeout > 0:
+        log.info('Giving up lines after {} seconds.'.format(args.timeout))
+    if args.ahead > 0:
+        log.info('Reading {} lines ahead.'.format(args.ahead))
+    if args.manifest:
+        log.info('Locating files with manifest.')
     if args.recursive:
         log.info('Recursive seaching.')
     if args.overwrite:
         log.info('Overwriting old files.')
 
     # run function to map carbon
-    map_carbon(args.pattern, args.time, args.map, args.img, args.ori, args.des,
-                args.overwrite, args.recursive)
+    if args.factors is not None:
+        map_pyramid(args.pattern, args.time, args.map, args.img, args.ori,
+                    args.des, args.factors, args.overwrite, args.recursive,
+                    args.ahead, args.manifest, args.retry_failed,
+                    args.timeout)
+    else:
+        map_carbon(args.pattern, args.time, args.map, args.img, args.ori,
+                    args.des, args.overwrite, args.recursive, args.ahead,
+                    args.manifest, args.retry_failed, args.timeout)
@@ -0,0 +1,288 @@
+""" Module for condensing land cover transition matrices
+
+    Args:
+        -p (pattern): searching pattern
+        -b (batch): batch process, thisjob and totaljob
+        -c (condense): condensing or not
+        -a (activity): write activity data with this interval in years
+        -R (recursive): recursive when seaching files
+        --overwrite: overwrite or not
+        ori: origin
+        des: destination
+
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+from .common import log, get_files, get_int, manage_batch, sort_files
+from .io import yatsm2records
+from .carbon import sum_matrices
+from .common import constants as cons
+
+
+def matrix_reduce(matrix_list):
+    """ sum up transition matrices in a fixed order
+
+    Args:
+        matrix_list (list): list of matrix files, [path, name]
+
+    Returns:
+        matrix (ndarray): total count and area of each from, to and year
+        info (list): [row, status] of each file, status 1 for processed, 0
+                        for empty and -1 for failed
+
+    """
+    matrices = []
+    info = []
+    for _file in sort_files(matrix_list):
+        py = -1
+        try:
+            py = get_int(_file[1])[0]
+            m = yatsm2records(os.path.join(_file[0], _file[1]))
+            if len(m) > 0:
+                matrices.append(m)
+                info.append([py, 1])
+            else:
+                info.append([py, 0])
+        except:
+            info.append([py, -1])
+    return sum_matrices(matrices), info
+
+
+def matrix2activity(matrix, lapse=1):
+    """ convert transition matrix to activity data of aggregated bookkeeping
+
+    Args:
+        matrix (ndarray): count and area of each from, to and year
+        lapse (int): interval of activity data in years
+
+    Returns:
+        actvt (ndarray): area of each type of transitions in each interval,
+                            standing secondary forest is not a transition
+                            and is left as 0
+
+    """
+    dtype = ([('start', '<i4'), ('end', '<i4')] +
+                [(x, '<f8') for x in cons.TRANSITIONS])
+    if len(matrix) == 0:
+        return np.zeros(0, dtype=dtype)
+    start = np.arange(matrix['year'].min(), matrix['year'].max() + 1, lapse)
+    actvt = np.zeros(len(start), dtype=dtype)
+    actvt['start'] = start
+    actvt['end'] = start + lapse
+    i = (matrix['year'] - start[0]) // lapse
+    primary = matrix['from'] == cons.FOREST[0]
+    secondary = matrix['from'] == cons.FOREST[1]
+    regrow = matrix['to'] == cons.FOREST[1]
+    cleared = ((~np.isin(matrix['to'], cons.FOREST)) &
+                (matrix['to'] != cons.UNCLASSIFIED))
+    gained = ((~np.isin(matrix['from'], cons.FOREST)) &
+                (matrix['from'] != cons.UNCLASSIFIED))
+    for x, _f in [['for_pas', primary & cleared], ['for_sec', primary & regrow],
+                    ['sec_gain', gained & regrow],
+                    ['sec_pas', secondary & cleared]]:
+        actvt[x] = np.bincount(i[_f], matrix['area'][_f], len(start))
+    return actvt
+
+
+def matrix_condense(pattern, ori, des, recursive=False, batch=[1,1]):
+    """ condense transition matrices of lines
+
+    Args:
+        pattern (str): searching pattern, e.g. transition_r*.npz
+        ori (str): place to look for inputs
+        des (str): place to save outputs
+        recursive (bool): recursive when searching file, or not
+        batch (list, int): batch processing, [thisjob, totaljob]
+
+    Returns:
+        0: successful
+        1: error due to des
+        2: error when searching files
+        3: found no file
+        4: error processing
+        5: error writing output
+
+    """
+    # check if output exists, if not try to create one
+    if not os.path.exists(des):
+        log.warning('{} does not exist, trying to create one.'.format(des))
+        try:
+            os.makedirs(des)
+        except:
+            log.error('Cannot create output folder {}'.format(des))
+            return 1
+
+    # locate files
+    log.info('Locating files...')
+    try:
+        matrix_list = sort_files(get_files(ori, pattern, recursive))
+        n = len(matrix_list)
+    except:
+        log.error('Failed to search for {}'.format(pattern))
+        return 2
+    else:
+        if n == 0:
+            log.error('Found no {}'.format(pattern))
+            return 3
+        else:
+            log.info('Found {} files.'.format(n))
+
+    # handle batch processing
+    if batch[1] > 1:
+        log.info('Handling batch process...')
+        matrix_list = manage_batch(matrix_list, batch[0], batch[1])
+        n = len(matrix_list)
+        log.info('{} files to be processed by this job.'.format(n))
+
+    # sum up matrices
+    log.info('Start condensing matrices...')
+    m, info = matrix_reduce(matrix_list)
+    lcount = len([x for x in info if x[1] >= 0])
+    for py, status in info:
+        if status < 0:
+            log.warning('Failed to process line {}.'.format(py))
+    if lcount == 0:
+        log.error('Failed to process anything.')
+        return 4
+
+    # write output
+    log.info('Writing output...')
+    try:
+        np.savez(os.path.join(des, 'condensed_transition_r{}_l{}.npz'.format(
+                    batch[0], lcount)), m)
+    except:
+        log.error('Failed to write output to {}'.format(des))
+        return 5
+
+    # done
+    log.info('Process completed.')
+    log.info('Successfully processed {}/{} lines.'.format(lcount, n))
+    return 0
+
+
+def matrix_sum(pattern, ori, des, overwrite=False, recursive=False, lapse=0):
+    """ sum up condensed transition matrices into a table
+
+    Args:
+        pattern (str): searching pattern, e.g. condensed_transition_r*.npz
+        ori (str): place to look for inputs
+        des (str): output file
+        overwrite (bool): overwrite or not
+        recursive (bool): recursive when searching file, or not
+        lapse (int): write activity data with this interval in years instead,
+                        0 for the transition matrix
+
+    Returns:
+        0: successful
+        1: error due to des
+        2: error when searching files
+        3: found no file
+        4: error processing
+        5: error writing output
+
+    """
+    # check if output already exists
+    if (not overwrite) and os.path.isfile(des):
+        log.error('{} already exists.'.format(os.path.basename(des)))
+        return 1
+
+    # locate files
+    log.info('Locating files...')
+    try:
+        matrix_list = get_files(ori, pattern, recursive)
+        n = len(matrix_list)
+    except:
+        log.error('Failed to search for {}'.format(pattern))
+        return 2
+    else:
+        if n == 0:
+            log.error('Found no {}'.format(pattern))
+            return 3
+        else:
+            log.info('Found {} files.'.format(n))
+
+    # sum up matrices
+    log.info('Start summarizing...')
+    m, info = matrix_reduce(matrix_list)
+    fcount = len([x for x in info if x[1] >= 0])
+    if fcount == 0:
+        log.error('Failed to process anything.')
+        return 4
+
+    # write output
+    log.info('Writing output...')
+    try:
+        if lapse > 0:
+            actvt = matrix2activity(m, lapse)
+            np.savetxt(des, actvt, delimiter=',',
+                        fmt='%d,%d' + ',%f' * len(cons.TRANSITIONS),
+                        header=','.join(actvt.dtype.names), comments='')
+        else:
+            np.savetxt(des, m, delimiter=',', fmt=cons.TRANSITION_FMT,
+                        header=cons.TRANSITION_HEADER, comments='')
+    except:
+        log.error('Failed to write output to {}'.format(des))
+        return 5
+
+    # done
+    log.info('Process completed.')
+    log.info('Successfully processed {}/{} files.'.format(fcount, n))
+    return 0
+
+
+if __name__ == '__main__':
+    # parse options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--pattern', action='store', type=str,
+                        dest='pattern', default='NA',
+                        help='searching pattern')
+    parser.add_argument('-b', '--batch', action='store', type=int, nargs=2,
+                        dest='batch', default=[1,1],
+                        help='batch process, [thisjob, totaljob]')
+    parser.add_argument('-c', '--condense', action='store_true',
+                        help='condensing or not')
+    parser.add_argument('-a', '--activity', action='store', type=int,
+                        dest='lapse', default=0,
+                        help='write activity data with this interval')
+    parser.add_argument('-R', '--recursive', action='store_true',
+                        help='recursive or not')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite or not')
+    parser.add_argument('ori', default='./', help='origin')
+    parser.add_argument('des', default='./', help='destination')
+    args = parser.parse_args()
+
+    # print logs
+    if args.condense:
+        if not 1 <= args.batch[0] <= args.batch[1]:
+            log.error('Invalid batch inputs: [{}, {}]'.format(args.batch[0],
+                        args.batch[1]))
+            sys.exit(1)
+        log.info('Start condensing transition matrices...')
+        if args.pattern == 'NA':
+            args.pattern = 'transition_r*.npz'
+    else:
+        log.info('Start combining condensed matrices...')
+        if args.pattern == 'NA':
+            args.pattern = 'condensed_transition_r*.npz'
+        if args.lapse > 0:
+            log.info('Writing activity data every {} years.'.format(
+                                                                args.lapse))
+    log.info('Looking for {}'.format(args.pattern))
+    log.info('In {}'.format(args.ori))
+    log.info('Saving in/as {}'.format(args.des))
+    if args.recursive:
+        log.info('Recursive seaching.')
+    if args.overwrite:
+        log.info('Overwriting old files.')
+
+    # run function
+    if args.condense:
+        matrix_condense(args.pattern, args.ori, args.des, args.recursive,
+                        args.batch)
+    else:
+        matrix_sum(args.pattern, args.ori, args.des, args.overwrite,
+                    args.recursive, args.lapse)
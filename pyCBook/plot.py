@@ -5,7 +5,7 @@ import numpy as np
 
 from .common import (log, get_files, get_int, plot_pools, get_class_string,
                         plot_book)
-from .io import yatsm2records, csv2ndarray
+from .io import csv2ndarray, csv2table, carbon2pixels, store, is_store
 from .carbon import pools
 from .common import constants as cons
 
@@ -32,11 +32,17 @@ def plot_pixel(ori, lookup, px, py, _which=0, des='NA'):
     # find line result
     log.info('Looking for line result...')
     try:
-        carbon = get_files(ori, 'carbon_r{}.npz'.format(py))
+        name = 'carbon_r{}.npz'.format(py)
+        if is_store(ori):
+            carbon = store(ori).files(name)
+        elif os.path.isfile(os.path.join(ori, name)):
+            carbon = [[ori, name]]
+        else:
+            carbon = get_files(ori, name)
         # read line cache
         log.info('Reading line result...')
         if len(carbon) > 0:
-            _line = yatsm2records(os.path.join(carbon[0][0], carbon[0][1]))
+            _line = carbon2pixels(os.path.join(carbon[0][0], carbon[0][1]), px)
         else:
             log.error('Find no line result for {}.'.format(py))
             return 1
@@ -46,10 +52,10 @@ def plot_pixel(ori, lookup, px, py, _which=0, des='NA'):
 
     # get pixel pools
     log.info('Locating pixel...')
-    pixel_pools = _line[_line['px'] == px]
-    if len(pixel_pools) == 0:
+    if px not in _line:
         log.error('Can not find pixel {}'.format(px))
         return 3
+    pixel_pools = _line[px]
 
     # gen plot
     log.info('Generating plot...')
@@ -76,13 +82,14 @@ def plot_pixel(ori, lookup, px, py, _which=0, des='NA'):
     return 0
 
 
-def plot_report(ori, des='NA',cum=True):
+def plot_report(ori, des='NA',cum=True, cache=False):
     """ plot bookkeeping result for a pixxel
 
     Args:
         ori (str): place to look for results
         des (str): output file if wanted
         cum (bool): cumulative or not
+        cache (bool): keep a binary copy of the report for reloading
 
     Returns:
         0: successful
@@ -97,7 +104,7 @@ def plot_report(ori, des='NA',cum=True):
     # get pixel pools
     log.info('Reading input...')
     try:
-        data = csv2ndarray(ori)
+        data = csv2table(ori, cache=cache)
     except:
         log.error('Failed to read {}'.format(ori))
         return 1
@@ -1,13 +1,27 @@
 """ Module for carbon reporting
 
+    Reports cover every booked line. To estimate scene totals with standard
+    errors from a stratified sample of pixels instead, see pyCBook.estimate.
+
     Args:
         -p (pattern): searching pattern
-        -t (time): report time frame
-        -i (lapse): reporting interval
+        -t (time): report time frame, repeat for multiple periods
+        -i (lapse): reporting interval, repeat for multiple periods
         -b (batch): batch process, thisjob and totaljob
         -l (line): line by line processing or not
         -c (condense): condensing or not
+        -u (update): update condensed reports with ledgers or not
+        --ledger: keep contributions ledger when condensing
+        --breakdown: break reports down by subpool and transition
+        --retry-failed: only redo lines recorded as failed by this job
+        --timeout: give up a line after this many seconds
+        -w (workers): number of workers reading files
+        -s (sum): summation method, plain, pairwise or kahan
+        --process: read files with processes instead of threads
+        --prefetch: number of lines to read ahead
+        --write-behind: number of lines to write behind
         -R (recursive): recursive when seaching files
+        -M (manifest): use a cached manifest to locate files
         --overwrite: overwrite or not
         ori: origin
         des: destination
@@ -16,27 +30,77 @@
 import os
 import sys
 import argparse
+import tempfile
 import numpy as np
 
-from .common import (log, get_files, get_int, doy_to_ordinal, ordinal_to_doy,
-                        manage_batch)
-from .io import yatsm2pixels, yatsm2records
+from functools import partial
+
+from .common import (log, get_files, get_int, ordinal_to_doy, manage_batch,
+                        get_period, sort_files, map_pool, get_checksum,
+                        prefetch, writer, line_timeout, read_failures,
+                        failures)
+from .common.reduction import (block_sum, tree_sum, tree_partial, tree_level,
+                                METHODS)
+from .io import (yatsm2pixels, yatsm2records, carbon2stable, store, is_store,
+                    report2breakdown, report2nodes)
 from .carbon import pools
 from .common import constants as cons
 
 
+def report_specs(period, lapse=1, des='./'):
+    """ parse reporting specifications
+
+    Args:
+        period (list): reporting time period, [start, end], or a list of
+                        reporting specifications, [start, end, (lapse)]
+        lapse (int): default reporting interval
+        des (str/list): place to save outputs, one for each specification
+
+    Returns:
+        specs (list): reporting specifications, [[start, end], lapse]
+        des (list, str): place to save outputs of each specification
+
+    """
+    if isinstance(period[0], (int, np.integer)):
+        specs = [[[int(x) for x in period], lapse]]
+    else:
+        specs = [[list(x[0:2]), (x[2] if len(x) > 2 else lapse)]
+                    for x in period]
+    if type(des) == str:
+        if len(specs) == 1:
+            des = [des]
+        else:
+            des = [os.path.join(des, '{}_{}_{}'.format(x[0][0], x[0][1], x[1]))
+                    for x in specs]
+    if len(des) != len(specs):
+        raise ValueError('Number of destinations does not match periods.')
+    return specs, des
+
+
 def report_line(pattern, period, ori, des, lapse=1, recursive=False,
-                batch=[1,1]):
+                batch=[1,1], ahead=0, behind=0, manifest=False, lines=None,
+                breakdown=False, retry='NA', retry_failed=False, timeout=0):
     """ carbon reporting from bookkeeping results
 
+    Totals from a sample of pixels are estimated by estimate.estimate_scene.
+
     Args:
         pattern (str): searching pattern, e.g. yatsm_r*.npz
-        period (list, int): reporting time period, [start, end]
+        period (list): reporting time period, [start, end], or a list of
+                        reporting specifications, [start, end, (lapse)]
         ori (str): place to look for inputs
-        des (str): place to save outputs
+        des (str/list): place to save outputs, one for each specification
         laspe (int): reporting interval
         recursive (bool): recursive when searching file, or not
         batch (list, int): batch processing, [thisjob, totaljob]
+        ahead (int): number of lines to read ahead, 0 for no prefetch
+        behind (int): number of lines to write behind, 0 for direct write
+        manifest (bool): use a cached manifest to locate files or not
+        lines (list, int): only process these lines, None for all
+        breakdown (bool): break reports down by subpool and transition
+        retry (str): file to record failed lines in, NA for one in des
+        retry_failed (bool): only redo lines recorded in the retry file
+        timeout (int): give up a line after this many seconds, 0 for never
 
     Returns:
         0: successful
@@ -47,18 +111,47 @@ def report_line(pattern, period, ori, des, lapse=1, recursive=False,
 
     """
     # check if output exists, if not try to create one
-    if not os.path.exists(des):
-        log.warning('{} does not exist, trying to create one.'.format(des))
+    try:
+        specs, des = report_specs(period, lapse, des)
+    except:
+        log.error('Invalid reporting period or destination.')
+        return 1
+    for _des in des:
+        if not os.path.exists(_des):
+            log.warning('{} does not exist, trying to create one.'.format(_des))
+            try:
+                os.makedirs(_des)
+            except:
+                log.error('Cannot create output folder {}'.format(_des))
+                return 1
+
+    # failed lines are recorded in a retry file of each job
+    if retry == 'NA':
+        retry = os.path.join(des[0], cons.RETRY_FILE.format(batch[0],
+                                                                batch[1]))
+    retries = failures(retry)
+    if retry_failed:
         try:
-            os.makedirs(des)
+            _lines = set([x['line'] for x in read_failures(retry)])
         except:
-            log.error('Cannot create output folder {}'.format(des))
-            return 1
+            log.error('Failed to read retry file {}'.format(retry))
+            return 2
+        if len(_lines) == 0:
+            log.info('No failed line to retry.')
+            return 0
+        lines = _lines if lines is None else _lines & set(lines)
+        log.info('Retrying {} failed lines.'.format(len(lines)))
 
     # locate files
     log.info('Locating files...')
     try:
-        carbon_list = get_files(ori, pattern, recursive)
+        if is_store(ori):
+            carbon_list = store(ori).files(pattern)
+        else:
+            carbon_list = get_files(ori, pattern, recursive, manifest)
+        if lines is not None:
+            lines = set(lines)
+            carbon_list = [x for x in carbon_list if get_int(x[1])[0] in lines]
         n = len(carbon_list)
     except:
         log.error('Failed to search for {}'.format(pattern))
@@ -70,53 +163,88 @@ def report_line(pattern, period, ori, des, lapse=1, recursive=False,
         else:
             log.info('Found {} files.'.format(n))
 
-    # handle batch processing
-    if batch[1] > 1:
+    # handle batch processing, lines to retry belong to this job already
+    if (batch[1] > 1) and (not retry_failed):
         log.info('Handling batch process...')
         carbon_list = manage_batch(carbon_list, batch[0], batch[1])
         n = len(carbon_list)
         log.info('{} files to be processed by this job.'.format(n))
 
     # initialize output
-    if max(period) < cons.MAX_YEAR:
-        period2 = [doy_to_ordinal(x * 1000 + 1) for x in range(period[0],
-                    period[1] + 1, lapse)]
-    else:
-        period2 = range(doy_to_ordinal(period[0]),
-                        doy_to_ordinal(period[1]) + 1, lapse)
+    period2 = [get_period(x[0], x[1]) for x in specs]
+
+    # read bookkeeping results of a line
+    def read_line(_line):
+        return [yatsm2pixels(os.path.join(_line[0], _line[1])),
+                carbon2stable(os.path.join(_line[0], _line[1]))]
 
     # loop through all files
     lcount = 0
+    output = writer(behind)
     log.info('Start reporting carbon...')
-    for _line in carbon_list:
+    for _line, inputs, error in prefetch(read_line, carbon_list, ahead):
         try:
-            pixels = yatsm2pixels(os.path.join(_line[0], _line[1]))
             py = get_int(_line[1])[0]
             px = -1
-            pcount = 0
-            r = []
-            if len(pixels) > 0:
-                r = np.array([(ordinal_to_doy(x), 0.0, 0.0, 0.0, 0.0,
-                                0.0) for x in period2], dtype=cons.DTYPES2)
-                for pixel in pixels:
-                    px = pixel[0]['px']
-                    pixel_pools = pools(pixel)
-                    record = pixel_pools.report(period, lapse)
-                    r['emission'] += record['emission']
-                    r['productivity'] += record['productivity']
-                    r['net'] += record['net']
-                    r['unreleased'] += record['unreleased']
-                    pcount += 1
-            np.savez(os.path.join(des, 'report_r{}_c{}.npz'.format(py, pcount)), r)
+            if error is not None:
+                raise error
+            with line_timeout(timeout):
+                pixels, stable = inputs
+                pcount = 0
+                r = [[] for x in specs]
+                b = [{} for x in specs] if breakdown else None
+                if len(pixels) + len(stable) > 0:
+                    r = [np.array([(ordinal_to_doy(x), 0.0, 0.0, 0.0, 0.0,
+                            0.0) for x in y], dtype=cons.DTYPES2)
+                            for y in period2]
+                    for pixel in pixels:
+                        px = pixel[0]['px']
+                        pixel_pools = pools(pixel)
+                        if breakdown:
+                            keys, group = np.unique(pixel_pools.transitions(),
+                                                    return_inverse=True)
+                            records = pixel_pools.report_interval(specs, group,
+                                                                    len(keys))
+                            for b2, record in zip(b, records):
+                                add_breakdown(b2, keys, record)
+                            records = [dict([(x, y[x].sum(axis=0)) for x in
+                                        cons.REDUCE_FIELDS]) for y in records]
+                        else:
+                            records = pixel_pools.report_multi(specs)
+                        for r2, record in zip(r, records):
+                            r2['emission'] += record['emission']
+                            r2['productivity'] += record['productivity']
+                            r2['net'] += record['net']
+                            r2['unreleased'] += record['unreleased']
+                        pcount += 1
+                    # stable pixels have no flux, only counted
+                    pcount += len(stable)
+            output.put(py, save_reports, des, py, pcount, r, b)
             if pcount == 0:
                 log.warning('Processed nothing for line {}.'.format(py))
             else:
                 log.info('Processed line {}'.format(py))
             lcount += 1
-        except:
+        except Exception as e:
             log.warning('Failed to process line {} pixel {}.'.format(py, px))
+            retries.add(py, px, e, _line[1])
             continue
 
+    # wait for outputs to be written
+    failed = output.close()
+    for py, error in failed:
+        log.warning('Failed to write line {}.'.format(py))
+        retries.add(py, -1, error)
+    lcount -= len(failed)
+
+    # record failed lines to be retried
+    try:
+        if retries.save() > 0:
+            log.warning('{} failed lines recorded in {}'.format(
+                                                len(retries.lines()), retry))
+    except:
+        log.warning('Failed to write retry file {}'.format(retry))
+
     # check if anything is processed
     if lcount == 0:
         log.error('Failed to process anything.')
@@ -128,15 +256,450 @@ def report_line(pattern, period, ori, des, lapse=1, recursive=False,
     return 0
 
 
-def report_condense(pattern, ori, des, recursive=False, batch=[1,1]):
+def save_reports(des, py, pcount, r, b=None):
+    """ save reports of a line, one for each reporting specification
+
+    Args:
+        des (list, str): place to save outputs of each specification
+        py (int): line number
+        pcount (int): number of pixels processed
+        r (list, ndarray): report of each specification
+        b (list, dict): breakdown of each specification, None for no breakdown
+
+    Returns:
+        0: successful
+
+    """
+    for i, (_des, r2) in enumerate(zip(des, r)):
+        save_breakdown(os.path.join(_des, 'report_r{}_c{}.npz'.format(py,
+                        pcount)), r2, None if b is None else b[i])
+    return 0
+
+
+def save_breakdown(_file, r, b=None, extra=None):
+    """ save a report with its breakdown by subpool and transition
+
+    Args:
+        _file (str): path to report file
+        r (ndarray): the report
+        b (dict): values of each subpool and transition, [date, field],
+                    None for no breakdown
+        extra (dict): other arrays to save with the report
+
+    Returns:
+        0: successful
+
+    """
+    extra = {} if extra is None else extra
+    if b is None:
+        np.savez(_file, r, **extra)
+        return 0
+    keys = sorted(b)
+    values = np.zeros((len(keys), len(r), len(cons.REDUCE_FIELDS)))
+    for i, x in enumerate(keys):
+        values[i] = b[x]
+    np.savez(_file, r, keys=np.array(keys, dtype=cons.BREAKDOWN),
+                breakdown=values, **extra)
+    return 0
+
+
+def nodes2arrays(r, b, level, first, nodes):
+    """ pack partial sums of the nodes of a condensed report to arrays
+
+    Args:
+        r (ndarray): the condensed report
+        b (dict): breakdown of each subpool and transition, None for none
+        level (int): level of the nodes in the tree of all reports
+        first (int): index of the first node in the tree of all reports
+        nodes (list): [partial sum, partial breakdown] of each node, None
+                        for a node with nothing summed
+
+    Returns:
+        arrays (dict): level, nodes, filled, partial, split and has
+
+    """
+    keys = sorted(b) if b is not None else []
+    shape = (len(r), len(cons.REDUCE_FIELDS))
+    arrays = {'level': level, 'nodes': np.arange(first, first + len(nodes)),
+                'filled': np.zeros(len(nodes), dtype=bool),
+                'partial': np.zeros((len(nodes), 2) + shape),
+                'split': np.zeros((len(nodes), len(keys), 2) + shape),
+                'has': np.zeros((len(nodes), len(keys)), dtype=bool)}
+    for i, x in enumerate(nodes):
+        if x[0] is None:
+            continue
+        arrays['filled'][i] = True
+        arrays['partial'][i] = x[0]
+        for j, key in enumerate(keys):
+            if x[1].get(key) is not None:
+                arrays['has'][i, j] = True
+                arrays['split'][i, j] = x[1][key]
+    return arrays
+
+
+def sum_nodes(report_list, info, method='plain'):
+    """ sum up condensed reports by the partial sums of their nodes, which
+        adds up the same as summing all line reports at once
+
+    Args:
+        report_list (list): list of condensed reports, [path, name]
+        info (list): [row, pixel count, status] of each report, sorted
+        method (str): plain, pairwise or kahan summation
+
+    Returns:
+        r (ndarray): summed report, None if a report has no nodes or the
+                        nodes do not come from one tree
+        b (dict): summed breakdown of each subpool and transition
+
+    """
+    base = None
+    levels = set()
+    tree = {}
+    for report, x in zip(sort_files(report_list), info):
+        if x[2] != 1:
+            continue
+        _file = os.path.join(report[0], report[1])
+        level, index, nodes = report2nodes(_file)
+        if level is None:
+            return None, {}
+        levels.add(level)
+        for i, node in zip(index, nodes):
+            if i in tree:
+                return None, {}
+            tree[i] = node
+        if base is None:
+            base = yatsm2records(_file)
+    if len(levels) != 1:
+        return None, {}
+    return nodes2report(base, [tree.get(i) for i in range(max(tree) + 1)],
+                        method)
+
+
+def add_breakdown(b, keys, record):
+    """ add reports of groups of pools to a breakdown
+
+    Args:
+        b (dict): values of each subpool and transition, [date, field]
+        keys (ndarray): subpool and transition of each group
+        record (ndarray): report of each group, [group, date]
+
+    Returns:
+        b (dict): updated breakdown
+
+    """
+    for key, x in zip(keys, record):
+        key = (str(key['subpool']), int(key['from']), int(key['to']))
+        values = np.column_stack([x[y] for y in cons.REDUCE_FIELDS])
+        if key in b:
+            b[key] += values
+        else:
+            b[key] = values
+    return b
+
+
+def reduce_block(reports, method='plain', keep=False, dates=None):
+    """ read a block of reports and sum them up
+
+    Args:
+        reports (list): list of report files, [path, name]
+        method (str): plain, pairwise or kahan summation
+        keep (bool): keep ledger entry and contribution of each report
+        dates (ndarray): dates all reports must have, None for no check
+
+    Returns:
+        base (ndarray): first non-empty report, None if all empty
+        partial (tuple, ndarray): partial sum and compensation
+        info (list): [row, pixel count, status] of each report, status
+                        1 for processed, 0 for empty and -1 for failed
+        kept (list): [ledger entry, contribution] of each report read
+        split (dict): partial sum of each subpool and transition
+
+    """
+    base = None
+    arrays = []
+    info = []
+    kept = []
+    split = {}
+    for report in reports:
+        py = -1
+        try:
+            # read everything first so a failed report adds nothing
+            py = get_int(report[1])[0]
+            _file = os.path.join(report[0], report[1])
+            records = yatsm2records(_file)
+            contrib = None
+            keys = None
+            row = [py, 0, 0]
+            if len(records) > 0:
+                if (dates is not None) and not same_dates(records, dates):
+                    raise ValueError('Dates differ from other reports.')
+                contrib = np.column_stack([records[x] for x in
+                                            cons.REDUCE_FIELDS])
+                keys, values = report2breakdown(_file)
+                row = [py, get_int(report[1])[-1], 1]
+            entry = ledger_entry(report, row[1]) if keep else None
+        except:
+            info.append([py, 0, -1])
+            continue
+        if contrib is not None:
+            if base is None:
+                base = records
+            arrays.append(contrib)
+            if keys is not None:
+                for key, x in zip(keys, values):
+                    split.setdefault((str(key['subpool']), int(key['from']),
+                                        int(key['to'])), []).append(x)
+        info.append(row)
+        if keep:
+            kept.append([entry, contrib])
+    split = dict([(x, block_sum(y, method)) for x, y in split.items()])
+    return base, block_sum(arrays, method), info, kept, split
+
+
+def first_dates(report_list):
+    """ dates of the first non-empty report that can be read
+
+    Args:
+        report_list (list): list of report files, [path, name]
+
+    Returns:
+        dates (ndarray): dates of the report, None if there is none
+
+    """
+    for report in report_list:
+        try:
+            records = yatsm2records(os.path.join(report[0], report[1]))
+        except:
+            continue
+        if len(records) > 0:
+            return np.array(records['date'])
+    return None
+
+
+def same_dates(r, dates):
+    """ check if a report has the given dates
+
+    Args:
+        r (ndarray): the report
+        dates (ndarray): dates to compare with
+
+    Returns:
+        same (bool): same or not
+
+    """
+    return (len(r) == len(dates)) and bool((r['date'] == dates).all())
+
+
+def ledger_entry(report, pcount):
+    """ generate a ledger entry for a report file
+
+    Args:
+        report (list): report file, [path, name]
+        pcount (int): number of pixels in the report
+
+    Returns:
+        entry (tuple): ledger entry, see constants.LEDGER
+
+    """
+    _file = os.path.join(report[0], report[1])
+    return (report[1], get_int(report[1])[0], pcount,
+            os.path.getsize(_file), os.path.getmtime(_file),
+            get_checksum(_file))
+
+
+def report_reduce(report_list, workers=1, method='plain', process=False,
+                    keep=False, ahead=0, level=0):
+    """ sum up reports with a deterministic tree reduction
+
+    Args:
+        report_list (list): list of report files, [path, name]
+        workers (int): number of workers reading files
+        method (str): plain, pairwise or kahan summation
+        process (bool): use processes instead of threads
+        keep (bool): keep ledger entry and contribution of each report
+        ahead (int): number of blocks to read ahead with a single worker
+        level (int): level of the tree to keep partial sums of
+
+    Returns:
+        r (ndarray): summed report, None if nothing is summed
+        info (list): [row, pixel count, status] of each report
+        kept (list): [ledger entry, contribution] of each report read
+        b (dict): summed breakdown of each subpool and transition
+        nodes (list): [partial sum, partial breakdown] of each node of the
+                        tree at level, None for a node with nothing summed
+
+    """
+    report_list = sort_files(report_list)
+    blocks = [report_list[i:(i + cons.REDUCE_BLOCK)] for i in
+                range(0, len(report_list), cons.REDUCE_BLOCK)]
+    func = partial(reduce_block, method=method, keep=keep,
+                    dates=first_dates(report_list))
+    if (workers <= 1) and (ahead > 0):
+        results = []
+        for block, result, error in prefetch(func, blocks, ahead):
+            if error is not None:
+                log.warning('Failed to read block from {}: {}'.format(
+                                                        block[0][1], error))
+                result = (None, None, [[(get_int(x[1]) or [-1])[0], 0, -1]
+                                        for x in block], [], {})
+            results.append(result)
+    else:
+        results = map_pool(func, blocks, workers, process)
+
+    info = [x for y in results for x in y[2]]
+    kept = [x for y in results for x in y[3]]
+    bases = [y[0] for y in results if y[0] is not None]
+    nodes = [results[i:(i + 2 ** level)] for i in
+                range(0, len(results), 2 ** level)]
+    nodes = [[tree_partial([y[1] for y in x], method),
+                dict([(z, tree_partial([y[4].get(z) for y in x], method))
+                        for z in set().union(*[y[4] for y in x])])]
+                for x in nodes]
+    r, b = nodes2report(bases[0] if len(bases) > 0 else None, nodes, method)
+    return r, info, kept, b, nodes
+
+
+def nodes2report(base, nodes, method='plain'):
+    """ sum up partial sums of the nodes of a tree to a report
+
+    Args:
+        base (ndarray): a report to take dates from, None if nothing summed
+        nodes (list): [partial sum, partial breakdown] of each node in order,
+                        None for a node with nothing summed
+        method (str): plain, pairwise or kahan summation
+
+    Returns:
+        r (ndarray): summed report, None if nothing is summed
+        b (dict): summed breakdown of each subpool and transition
+
+    """
+    nodes = [[None, {}] if x is None else x for x in nodes]
+    total = tree_sum([x[0] for x in nodes], method)
+    if (base is None) or (total is None):
+        return None, {}
+    r = np.array(base)
+    for i, x in enumerate(cons.REDUCE_FIELDS):
+        r[x] = total[:, i]
+    b = dict([(x, tree_sum([y[1].get(x) for y in nodes], method))
+                for x in sorted(set().union(*[y[1] for y in nodes]))])
+    return r, b
+
+
+def write_ledger(_file, condensed, entries, offsets, contrib, pending='',
+                    previous=''):
+    """ write the ledger of a condensed report, replacing the old one only
+        when complete, so that writing the ledger commits an update
+
+    Args:
+        _file (str): path to the ledger
+        condensed (str): name of the condensed report
+        entries (ndarray): ledger entry of each report, see constants.LEDGER
+        offsets (list, int): offset of the contribution of each report in
+                                the contribution file, -1 for none
+        contrib (str): name of the contribution file
+        pending (str): name the condensed report is written under until the
+                        update is finished, not matched by report patterns
+        previous (str): name of the condensed report before the update
+
+    Returns:
+        0: successful
+
+    """
+    temp = '{}.{}.tmp'.format(_file, os.getpid())
+    with open(temp, 'wb') as f:
+        np.savez(f, condensed=condensed, entries=entries,
+                    offsets=np.array(offsets, dtype=np.int64),
+                    contrib=contrib, pending=pending, previous=previous)
+    os.replace(temp, _file)
+    return 0
+
+
+def append_contrib(_file, contrib):
+    """ append contributions of reports to a contribution file, rows already
+        in the file are never changed
+
+    Args:
+        _file (str): path to the contribution file
+        contrib (list, ndarray): contribution of each report, None for none
+
+    Returns:
+        offsets (list, int): offset of each contribution, -1 for none
+
+    """
+    offsets = []
+    with open(_file, 'ab') as f:
+        f.seek(0, 2)
+        for x in contrib:
+            if x is None:
+                offsets.append(-1)
+                continue
+            offsets.append(f.tell())
+            f.write(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    return offsets
+
+
+def read_contrib(_file, offset, shape):
+    """ read the contribution of a report from a contribution file
+
+    Args:
+        _file (str): path to the contribution file
+        offset (int): offset of the contribution, -1 for none
+        shape (tuple): number of dates and fields
+
+    Returns:
+        contrib (ndarray): the contribution, zeros if none
+
+    """
+    if offset < 0:
+        return np.zeros(shape)
+    return np.array(np.memmap(_file, dtype=np.float64, mode='r',
+                                offset=int(offset), shape=shape))
+
+
+def finish_update(des, _file):
+    """ finish an update of a condensed report that its ledger committed
+
+    Args:
+        des (str): place of condensed reports
+        _file (str): path to the ledger
+
+    Returns:
+        0: successful
+
+    """
+    _ledger = np.load(_file)
+    condensed = str(_ledger['condensed'])
+    pending = str(_ledger['pending'])
+    previous = str(_ledger['previous'])
+    if (pending != '') and os.path.isfile(os.path.join(des, pending)):
+        os.replace(os.path.join(des, pending), os.path.join(des, condensed))
+    if ((previous not in ['', condensed]) and
+            os.path.isfile(os.path.join(des, previous))):
+        os.remove(os.path.join(des, previous))
+    return 0
+
+
+def report_condense(pattern, ori, des, recursive=False, batch=[1,1], workers=1,
+                    method='plain', process=False, ledger=False, ahead=0,
+                    manifest=False):
     """ summarizing condensed reports
 
+    Jobs take contiguous nodes of the tree of all reports and keep their
+    partial sums, so summing the condensed reports gives the same total for
+    any number of jobs.
+
     Args:
         pattern (str): searching pattern, e.g. yatsm_r*.npz
         ori (str): place to look for inputs
         des (str): place to save outputs
         recursive (bool): recursive when searching file, or not
         batch (list, int): batch processing, [thisjob, totaljob]
+        workers (int): number of workers reading files
+        method (str): plain, pairwise or kahan summation
+        process (bool): use processes instead of threads
+        ledger (bool): keep a contributions ledger for updates or not
+        ahead (int): number of blocks to read ahead with a single worker
+        manifest (bool): use a cached manifest to locate files or not
 
     Returns:
         0: successful
@@ -159,7 +722,8 @@ def report_condense(pattern, ori, des, recursive=False, batch=[1,1]):
     # locate files
     log.info('Locating files...')
     try:
-        report_list = get_files(ori, pattern, recursive)
+        report_list = sort_files(get_files(ori, pattern, recursive,
+                                            manifest))
         n = len(report_list)
     except:
         log.error('Failed to search for {}'.format(pattern))
@@ -171,41 +735,42 @@ def report_condense(pattern, ori, des, recursive=False, batch=[1,1]):
         else:
             log.info('Found {} files.'.format(n))
 
-    # handle batch processing
+    # each job condenses whole nodes of the tree of all reports
+    blocks = -(-n // cons.REDUCE_BLOCK)
+    level = tree_level(blocks, batch[1])
+    nodes = -(-blocks // 2 ** level)
+    first = (batch[0] - 1) * nodes // batch[1]
+    size = cons.REDUCE_BLOCK * 2 ** level
     if batch[1] > 1:
         log.info('Handling batch process...')
-        report_list = manage_batch(report_list, batch[0], batch[1])
+        report_list = report_list[(first * size):(batch[0] * nodes //
+                                                    batch[1] * size)]
         n = len(report_list)
         log.info('{} files to be processed by this job.'.format(n))
+        if n == 0:
+            log.info('More jobs than blocks of reports, nothing to do.')
+            return 0
 
     # loop through all files
+    log.info('Start condensing reports...')
+    r, info, kept, b, nodes = report_reduce(report_list, workers, method,
+                                            process, ledger, ahead, level)
     fcount = 0
     scount = 0
     lcount = 0
     pcount = 0
-    log.info('Start condensing reports...')
-    for report in report_list:
-        try:
-            py = get_int(report[1])[0]
-            records = yatsm2records(os.path.join(report[0], report[1]))
-            if len(records) > 0:
-                if lcount == 0:
-                    r = records
-                else:
-                    r['emission'] += records['emission']
-                    r['productivity'] += records['productivity']
-                    r['net'] += records['net']
-                    r['unreleased'] += records['unreleased']
-                log.info('Processed line {}'.format(py))
-                lcount += 1
-                pcount += get_int(report[1])[1]
-            else:
-                scount += 1
-                log.info('Skipped empty line {}'.format(py))
-            fcount += 1
-        except:
+    for py, c, status in info:
+        if status == 1:
+            log.info('Processed line {}'.format(py))
+            lcount += 1
+            pcount += c
+        elif status == 0:
+            scount += 1
+            log.info('Skipped empty line {}'.format(py))
+        else:
             log.warning('Failed to process line {}.'.format(py))
             continue
+        fcount += 1
 
     # nothing is processed, all failed
     if pcount == 0:
@@ -215,8 +780,24 @@ def report_condense(pattern, ori, des, recursive=False, batch=[1,1]):
     # write output
     log.info('Writing output...')
     try:
-        np.savez(os.path.join(des, 'condensed_r{}_l{}_c{}.npz'.format(batch[0],
-                    fcount, pcount)), r)
+        condensed = 'condensed_r{}_l{}_c{}.npz'.format(batch[0], fcount, pcount)
+        b = b if len(b) > 0 else None
+        save_breakdown(os.path.join(des, condensed), r, b,
+                        nodes2arrays(r, b, level, first, nodes))
+        if ledger:
+            _ledger = os.path.join(des, 'ledger_r{}.npz'.format(batch[0]))
+            old = ''
+            if os.path.isfile(_ledger):
+                old = str(np.load(_ledger)['contrib'])
+            f, contrib = tempfile.mkstemp(prefix='ledger_r{}_'.format(
+                                            batch[0]), suffix='.bin', dir=des)
+            os.close(f)
+            offsets = append_contrib(contrib, [x[1] for x in kept])
+            write_ledger(_ledger, condensed, np.array([x[0] for x in kept],
+                            dtype=cons.LEDGER), offsets,
+                            os.path.basename(contrib))
+            if (old != '') and os.path.isfile(os.path.join(des, old)):
+                os.remove(os.path.join(des, old))
     except:
         log.error('Failed to write output to {}'.format(des))
         return 5
@@ -229,15 +810,21 @@ def report_condense(pattern, ori, des, recursive=False, batch=[1,1]):
     return 0
 
 
-def report_sum(pattern, ori, des, overwrite=False, recursive=False):
+def report_sum(pattern, ori, des, overwrite=False, recursive=False, workers=1,
+                method='plain', process=False):
     """ summarizing condensed reports
 
+    Totals from a sample of pixels are estimated by estimate.estimate_scene.
+
     Args:
         pattern (str): searching pattern, e.g. yatsm_r*.npz
         ori (str): place to look for inputs
         des (str): place to save outputs
         overwrite (bool): overwrite or not
         recursive (bool): recursive when searching file, or not
+        workers (int): number of workers reading files
+        method (str): plain, pairwise or kahan summation
+        process (bool): use processes instead of threads
 
     Returns:
         0: successful
@@ -269,42 +856,46 @@ def report_sum(pattern, ori, des, overwrite=False, recursive=False):
             log.info('Found {} files.'.format(n))
 
     # loop through all files
+    log.info('Start summarizing...')
+    r, info, kept, b, nodes = report_reduce(report_list, workers, method,
+                                            process)
     fcount = 0
     pcount = 0
     scount = 0
-    log.info('Start summarizing...')
-    for report in report_list:
-        try:
-            py = get_int(report[1])[0]
-            records = yatsm2records(os.path.join(report[0], report[1]))
-            if len(records) > 0:
-                if pcount == 0:
-                    r = records
-                else:
-                    r['emission'] += records['emission']
-                    r['productivity'] += records['productivity']
-                    r['net'] += records['net']
-                    r['unreleased'] += records['unreleased']
-                log.info('Processed file {}'.format(py))
-                pcount += get_int(report[1])[-1]
-            else:
-                log.info('Skipped empty report {}'.format(py))
-                scount += 1
-            fcount += 1
-        except:
+    for py, c, status in info:
+        if status == 1:
+            log.info('Processed file {}'.format(py))
+            pcount += c
+        elif status == 0:
+            log.info('Skipped empty report {}'.format(py))
+            scount += 1
+        else:
             log.warning('Failed to process file {}.'.format(py))
             continue
+        fcount += 1
 
     # nothing is processed, all failed
     if pcount == 0:
         log.error('Failed to process anything.')
         return 4
 
+    # condensed reports add up the same for any number of condensing jobs
+    try:
+        r2, b2 = sum_nodes(report_list, info, method)
+        if r2 is not None:
+            log.info('Summing partial sums of condensed reports.')
+            r, b = r2, b2
+    except:
+        log.warning('Failed to read partial sums, summing totals instead.')
+
     # write output
     log.info('Writing output...')
     try:
         np.savetxt(des, r, delimiter=',', fmt=cons.FMT, header=cons.HEADER,
                     comments='')
+        if len(b) > 0:
+            write_breakdown('{}_breakdown.csv'.format(os.path.splitext(des)[0]),
+                            r, b)
     except:
         log.error('Failed to write output to {}'.format(des))
         return 5
@@ -317,17 +908,210 @@ def report_sum(pattern, ori, des, overwrite=False, recursive=False):
     return 0
 
 
+def write_breakdown(_file, r, b):
+    """ write breakdown by subpool and transition as a long table
+
+    Args:
+        _file (str): output file
+        r (ndarray): the summed report, for dates
+        b (dict): values of each subpool and transition, [date, field]
+
+    Returns:
+        0: successful
+
+    """
+    keys = sorted(b)
+    table = np.zeros((len(keys), len(r)), dtype=[('date', '<i4')] +
+                        cons.BREAKDOWN + [(x, '<f8') for x in
+                                            cons.REDUCE_FIELDS])
+    table['date'] = r['date']
+    for i, key in enumerate(keys):
+        table['subpool'][i], table['from'][i], table['to'][i] = key
+        for j, x in enumerate(cons.REDUCE_FIELDS):
+            table[x][i] = b[key][:, j]
+    np.savetxt(_file, table.ravel(), delimiter=',', fmt=cons.BREAKDOWN_FMT,
+                header=cons.BREAKDOWN_HEADER, comments='')
+    return 0
+
+
+def report_update(pattern, ori, des, recursive=False):
+    """ update condensed reports with changed line reports using ledgers
+
+    Updated condensed reports no longer keep partial sums of the tree, they
+    are summed by their totals.
+
+    Args:
+        pattern (str): searching pattern, e.g. report_r*.npz
+        ori (str): place to look for line reports
+        des (str): place of condensed reports and their ledgers
+        recursive (bool): recursive when searching file, or not
+
+    Returns:
+        0: successful
+        1: found no ledger
+        2: error when searching files
+        3: error reading ledgers
+        4: error updating
+
+    """
+    # locate ledgers
+    log.info('Locating ledgers...')
+    try:
+        ledger_list = sort_files(get_files(des, 'ledger_r*.npz', False))
+    except:
+        ledger_list = []
+    if len(ledger_list) == 0:
+        log.error('Found no ledger in {}'.format(des))
+        return 1
+    log.info('Found {} ledgers.'.format(len(ledger_list)))
+
+    # locate line reports, latest one of each line
+    log.info('Locating files...')
+    try:
+        current = {}
+        for report in sort_files(get_files(ori, pattern, recursive)):
+            py = get_int(report[1])[0]
+            if py in current:
+                if (os.path.getmtime(os.path.join(*current[py])) >=
+                        os.path.getmtime(os.path.join(*report))):
+                    continue
+            current[py] = report
+    except:
+        log.error('Failed to search for {}'.format(pattern))
+        return 2
+    log.info('Found {} lines.'.format(len(current)))
+
+    # read ledgers, finish updates committed but not completed before
+    log.info('Reading ledgers...')
+    try:
+        ledgers = []
+        for x in ledger_list:
+            _file = os.path.join(x[0], x[1])
+            finish_update(des, _file)
+            _ledger = np.load(_file)
+            ledgers.append([_file, str(_ledger['condensed']),
+                            list(_ledger['entries']),
+                            list(_ledger['offsets']),
+                            os.path.join(des, str(_ledger['contrib']))])
+    except:
+        log.error('Failed to read ledgers from {}'.format(des))
+        return 3
+
+    # new lines go to the smallest ledger
+    known = set([y['py'] for x in ledgers for y in x[2]])
+    new = [x for x in sorted(current) if x not in known]
+    target = min(range(len(ledgers)), key=lambda i: len(ledgers[i][2]))
+
+    # update condensed reports
+    ucount = 0
+    lcount = 0
+    log.info('Start updating condensed reports...')
+    for i, (_file, condensed, entries, offsets, contrib) in enumerate(ledgers):
+        try:
+            py = -1
+            r = yatsm2records(os.path.join(des, condensed))
+            if report2breakdown(os.path.join(des, condensed))[0] is not None:
+                log.warning('Breakdown of {} is dropped, condense again to '
+                            'rebuild it.'.format(condensed))
+            changes = []
+            for j, entry in enumerate(entries):
+                py = entry['py']
+                if py not in current:
+                    changes.append([j, None])
+                    continue
+                report = current[py]
+                path = os.path.join(report[0], report[1])
+                if ((report[1] == entry['name']) and
+                        (os.path.getsize(path) == entry['size']) and
+                        (os.path.getmtime(path) == entry['mtime'])):
+                    continue
+                if ((report[1] == entry['name']) and
+                        (get_checksum(path) == entry['checksum'])):
+                    continue
+                changes.append([j, report])
+            if i == target:
+                changes.extend([[-1, current[x]] for x in new])
+            if len(changes) == 0:
+                log.info('Nothing changed for {}'.format(condensed))
+                continue
+            # only contributions of changed lines are read
+            shape = (len(r), len(cons.REDUCE_FIELDS))
+            removed = []
+            added = []
+            for j, report in changes:
+                if j >= 0:
+                    py = entries[j]['py']
+                    old = read_contrib(contrib, offsets[j], shape)
+                    for k, x in enumerate(cons.REDUCE_FIELDS):
+                        r[x] -= old[:, k]
+                if report is None:
+                    removed.append(j)
+                    log.info('Removed line {}'.format(py))
+                    continue
+                py = get_int(report[1])[0]
+                records = yatsm2records(os.path.join(report[0], report[1]))
+                pcount = 0
+                _contrib = None
+                if len(records) > 0:
+                    pcount = get_int(report[1])[-1]
+                    _contrib = np.column_stack([records[x] for x in
+                                                cons.REDUCE_FIELDS])
+                    for k, x in enumerate(cons.REDUCE_FIELDS):
+                        r[x] += _contrib[:, k]
+                entry = np.array([ledger_entry(report, pcount)],
+                                    dtype=cons.LEDGER)[0]
+                if j < 0:
+                    j = len(entries)
+                    entries.append(entry)
+                    offsets.append(-1)
+                entries[j] = entry
+                added.append([j, _contrib])
+                log.info('Updated line {}'.format(py))
+                lcount += 1
+
+            # new contributions are appended, old ones stay until condensed
+            for (j, x), offset in zip(added, append_contrib(contrib,
+                                                    [x[1] for x in added])):
+                offsets[j] = offset
+            kept = [j for j in range(len(entries)) if j not in removed]
+            entries = np.array([entries[j] for j in kept], dtype=cons.LEDGER)
+            offsets = [offsets[j] for j in kept]
+            batch = get_int(condensed)[0]
+            condensed2 = 'condensed_r{}_l{}_c{}.npz'.format(batch, len(kept),
+                                                    int(entries['pixels'].sum()))
+
+            # the ledger commits the update, the pending name is not matched
+            # by sum so the batch is never counted twice
+            pending = '{}.{}.tmp'.format(condensed2, os.getpid())
+            with open(os.path.join(des, pending), 'wb') as f:
+                np.savez(f, r)
+            write_ledger(_file, condensed2, entries, offsets,
+                            os.path.basename(contrib), pending, condensed)
+            finish_update(des, _file)
+            log.info('Updated {} to {}'.format(condensed, condensed2))
+            ucount += 1
+        except:
+            log.warning('Failed to update {} at line {}.'.format(condensed, py))
+            continue
+
+    # done
+    log.info('Process completed.')
+    log.info('Updated {} lines in {}/{} condensed reports.'.format(lcount,
+                                                    ucount, len(ledgers)))
+    return 0
+
+
 if __name__ == '__main__':
     # parse options
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--pattern', action='store', type=str,
                         dest='pattern', default='carbon_r*.npz',
                         help='searching pattern')
-    parser.add_argument('-t', '--time', action='store', type=int, nargs=2,
-                        dest='period', default=[2000001,2015365],
+    parser.add_argument('-t', '--time', action='append', type=int, nargs=2,
+                        dest='period', default=None,
                         help='reporting period, [start, end]')
-    parser.add_argument('-i', '--lapse', action='store', type=int,
-                        dest='lapse', default=1, help='reporting interval')
+    parser.add_argument('-i', '--lapse', action='append', type=int,
+                        dest='lapse', default=None, help='reporting interval')
     parser.add_argument('-b', '--batch', action='store', type=int, nargs=2,
                         dest='batch', default=[1,1],
                         help='batch process, [thisjob, totaljob]')
@@ -335,6 +1119,34 @@ if __name__ == '__main__':
                         help='process line or not')
     parser.add_argument('-c', '--condense', action='store_true',
                         help='condensing or not')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='update condensed reports or not')
+    parser.add_argument('--ledger', action='store_true',
+                        help='keep contributions ledger or not')
+    parser.add_argument('--breakdown', action='store_true',
+                        help='break down by subpool and transition or not')
+    parser.add_argument('--retry-failed', action='store_true',
+                        dest='retry_failed',
+                        help='only redo lines recorded as failed or not')
+    parser.add_argument('--timeout', action='store', type=int,
+                        dest='timeout', default=0,
+                        help='give up a line after this many seconds')
+    parser.add_argument('-w', '--workers', action='store', type=int,
+                        dest='workers', default=1,
+                        help='number of workers reading files')
+    parser.add_argument('-s', '--sum', action='store', type=str,
+                        dest='method', default='plain', choices=METHODS,
+                        help='summation method')
+    parser.add_argument('--process', action='store_true',
+                        help='read files with processes or not')
+    parser.add_argument('--prefetch', action='store', type=int,
+                        dest='ahead', default=0,
+                        help='number of lines to read ahead')
+    parser.add_argument('--write-behind', action='store', type=int,
+                        dest='behind', default=0,
+                        help='number of lines to write behind')
+    parser.add_argument('-M', '--manifest', action='store_true',
+                        help='use a cached manifest to locate files or not')
     parser.add_argument('-R', '--recursive', action='store_true',
                         help='recursive or not')
     parser.add_argument('--overwrite', action='store_true',
@@ -342,6 +1154,12 @@ if __name__ == '__main__':
     parser.add_argument('ori', default='./', help='origin')
     parser.add_argument('des', default='./', help='destination')
     args = parser.parse_args()
+    if args.period is None:
+        args.period = [[2000001, 2015365]]
+    if args.lapse is None:
+        args.lapse = [1]
+    args.period = [x + [args.lapse[min(i, len(args.lapse) - 1)]]
+                    for i, x in enumerate(args.period)]
 
     # print logs
     if args.line:
@@ -351,9 +1169,9 @@ if __name__ == '__main__':
                         args.batch[1]))
             sys.exit(1)
         log.info('Start carbon reporting by line...')
-        log.info('Reporting period {} to {}'.format(args.period[0],
-                                                    args.period[1]))
-        log.info('Reporting interval {}.'.format(args.lapse))
+        for x in args.period:
+            log.info('Reporting period {} to {} interval {}.'.format(x[0],
+                                                                x[1], x[2]))
     else:
         if args.condense:
             # check arguments
@@ -364,6 +1182,10 @@ if __name__ == '__main__':
             log.info('Start condensing line results...')
             if args.pattern == 'carbon_r*.npz':
                 args.pattern = 'report_r*.npz'
+        elif args.update:
+            log.info('Start updating condensed results...')
+            if args.pattern == 'carbon_r*.npz':
+                args.pattern = 'report_r*.npz'
         else:
             log.info('Start combining condensed results...')
             if args.pattern == 'carbon_r*.npz':
@@ -371,6 +1193,21 @@ if __name__ == '__main__':
     log.info('Looking for {}'.format(args.pattern))
     log.info('In {}'.format(args.ori))
     log.info('Saving in/as {}'.format(args.des))
+    if not args.line:
+        log.info('Summing with {} workers by {}.'.format(args.workers,
+                                                            args.method))
+    if args.ahead > 0:
+        log.info('Reading {} ahead.'.format(args.ahead))
+    if args.behind > 0:
+        log.info('Writing {} lines behind.'.format(args.behind))
+    if args.manifest:
+        log.info('Locating files with manifest.')
+    if args.breakdown:
+        log.info('Breaking down by subpool and transition.')
+    if args.retry_failed:
+        log.info('Retrying failed lines.')
+    if args.timeout > 0:
+        log.info('Giving up lines after {} seconds.'.format(args.timeout))
     if args.recursive:
         log.info('Recursive seaching.')
     if args.overwrite:
@@ -378,11 +1215,16 @@ if __name__ == '__main__':
 
     # run function to report carbon
     if args.line:
-        report_line(args.pattern, args.period, args.ori, args.des, args.lapse,
-                    args.recursive, args.batch)
+        report_line(args.pattern, args.period, args.ori, args.des, 1,
+                    args.recursive, args.batch, args.ahead, args.behind,
+                    args.manifest, None, args.breakdown, 'NA',
+                    args.retry_failed, args.timeout)
     elif args.condense:
         report_condense(args.pattern, args.ori, args.des, args.recursive,
-                        args.batch)
+                        args.batch, args.workers, args.method, args.process,
+                        args.ledger, args.ahead, args.manifest)
+    elif args.update:
+        report_update(args.pattern, args.ori, args.des, args.recursive)
     else:
         report_sum(args.pattern, args.ori, args.des, args.overwrite,
-                    args.recursive)
+                    args.recursive, args.workers, args.method, args.process)
@@ -0,0 +1,374 @@
+""" Module for running the whole workflow on a single machine
+
+    Stages book, report, condense, sum, map and audit are read from a
+    configuration file and run as a dependency graph on a local pool of
+    processes. Reporting of a chunk of lines starts as soon as the chunk is
+    booked.
+
+    Args:
+        -w (workers): number of worker processes, overrides config
+        --overwrite: overwrite or not, overrides config
+        config: configuration file, yaml or json
+
+"""
+import os
+import sys
+import json
+import argparse
+import importlib
+
+from .common import log, get_files, get_int
+from .common import constants as cons
+
+
+STAGES = {
+    'book': ['book', 'book_carbon'],
+    'report': ['report', 'report_line'],
+    'condense': ['report', 'report_condense'],
+    'sum': ['report', 'report_sum'],
+    'map': ['map', 'map_carbon'],
+    'audit': ['audit', 'audit_carbon']
+}
+
+
+def read_config(_file):
+    """ read workflow configuration
+
+    Args:
+        _file (str): path to configuration file, yaml or json
+
+    Returns:
+        config (dict): configuration with paths relative to the file resolved
+
+    """
+    with open(_file, 'r') as f:
+        text = f.read()
+    try:
+        import yaml
+        config = yaml.safe_load(text)
+    except ImportError:
+        config = json.loads(text)
+    root = os.path.dirname(os.path.abspath(_file))
+    for key in ['ori', 'para', 'des']:
+        if key not in config:
+            raise ValueError('Missing {} in configuration.'.format(key))
+        config[key] = os.path.join(root, os.path.expanduser(config[key]))
+    if ('map' in config) and ('img' in config['map']):
+        config['map']['img'] = os.path.join(root, config['map']['img'])
+    for stage in STAGES:
+        if (stage in config) and (config[stage] is None):
+            config[stage] = {}
+    return config
+
+
+def run_stage(stage, kwargs):
+    """ run one stage, importing its module on first use
+
+    Args:
+        stage (str): name of the stage
+        kwargs (dict): arguments of the stage function
+
+    Returns:
+        status (int): return code of the stage function
+
+    """
+    module, func = STAGES[stage]
+    module = importlib.import_module('.{}'.format(module), __package__)
+    return getattr(module, func)(**kwargs)
+
+
+def list_lines(config):
+    """ list lines to be processed and lines already booked
+
+    Args:
+        config (dict): workflow configuration
+
+    Returns:
+        lines (list, int): lines to be booked
+        booked (list, int): lines with existing bookkeeping results
+
+    """
+    carbon = os.path.join(config['des'], 'carbon')
+    booked = []
+    if os.path.isdir(carbon):
+        booked = [get_int(x[1])[0] for x in get_files(carbon, 'carbon_r*.npz',
+                                                        False)]
+    if 'book' not in config:
+        return [], sorted(booked)
+    book = config['book']
+    yatsm_list = get_files(config['ori'], book.get('pattern', 'yatsm_r*.npz'),
+                            book.get('recursive', False))
+    if book.get('bundle', False):
+        from .io import bundle2files
+        yatsm_list = [x for y in yatsm_list
+                        for x in bundle2files(os.path.join(y[0], y[1]))]
+    lines = sorted(set([get_int(x[1])[0] for x in yatsm_list]))
+    if config.get('overwrite', False):
+        return lines, []
+    booked = set(booked)
+    return ([x for x in lines if x not in booked],
+            sorted([x for x in lines if x in booked]))
+
+
+def plan_tasks(config):
+    """ build the dependency graph of a workflow
+
+    Args:
+        config (dict): workflow configuration
+
+    Returns:
+        tasks (dict): [stage, kwargs, dependencies] of each task, ordered so
+                        that every task comes after its dependencies
+
+    """
+    des = config['des']
+    chunk = max(config.get('chunk', 10), 1)
+    overwrite = config.get('overwrite', False)
+    carbon = os.path.join(des, 'carbon')
+    report = os.path.join(des, 'report')
+    condensed = os.path.join(des, 'condensed')
+    lines, booked = list_lines(config)
+    chunks = [lines[i:(i + chunk)] for i in range(0, len(lines), chunk)]
+    chunks2 = [booked[i:(i + chunk)] for i in range(0, len(booked), chunk)]
+
+    # book each chunk and report it as soon as it is booked
+    tasks = {}
+    books = []
+    reports = []
+    if 'report' in config:
+        _report = dict(pattern='carbon_r*.npz',
+                        period=config['report'].get('period', [2000001,
+                                                                2015365]),
+                        ori=carbon, des=report,
+                        lapse=config['report'].get('lapse', 1),
+                        breakdown=config['report'].get('breakdown', False),
+                        timeout=config['report'].get('timeout', 0))
+        for x in chunks2:
+            name = 'report_{}'.format(len(reports) + 1)
+            tasks[name] = ['report', dict(_report, lines=x,
+                            retry=os.path.join(report, 'failed_{}.json'.format(
+                                                                    name))),
+                            []]
+            reports.append(name)
+    for i, x in enumerate(chunks):
+        name = 'book_{}'.format(i + 1)
+        book = config['book']
+        tasks[name] = ['book', dict(pattern=book.get('pattern', 'yatsm_r*.npz'),
+                        ori=config['ori'], para=config['para'], des=carbon,
+                        img=book.get('img', 'NA'), mask=book.get('mask', 'NA'),
+                        overwrite=overwrite,
+                        recursive=book.get('recursive', False),
+                        force_end=book.get('end', cons.FORCE_END),
+                        resume=book.get('resume', 'NA'),
+                        stable=book.get('stable', False),
+                        cache=book.get('cache', 'NA'),
+                        bundle=book.get('bundle', False), lines=x,
+                        retry=os.path.join(carbon, 'failed_{}.json'.format(
+                                                                    name)),
+                        timeout=book.get('timeout', 0)), []]
+        books.append(name)
+        if 'report' in config:
+            name2 = 'report_{}'.format(len(reports) + 1)
+            tasks[name2] = ['report', dict(_report, lines=x,
+                            retry=os.path.join(report, 'failed_{}.json'.format(
+                                                                    name2))),
+                            [name]]
+            reports.append(name2)
+
+    # condense and sum after all lines are reported
+    condenses = []
+    if 'condense' in config:
+        _condense = config['condense']
+        jobs = _condense.get('jobs', config.get('workers', 1))
+        jobs = max(min(jobs, -(-(len(lines) + len(booked)) //
+                                cons.REDUCE_BLOCK)), 1)
+        for i in range(0, jobs):
+            name = 'condense_{}'.format(i + 1)
+            tasks[name] = ['condense', dict(pattern='report_r*.npz',
+                            ori=report, des=condensed, batch=[i + 1, jobs],
+                            method=_condense.get('method', 'plain')), reports]
+            condenses.append(name)
+    if 'sum' in config:
+        _sum = config['sum']
+        tasks['sum'] = ['sum', dict(pattern='condensed_r*.npz', ori=condensed,
+                        des=os.path.join(des, _sum.get('des', 'report.csv')),
+                        overwrite=overwrite or ('condense' in config),
+                        method=_sum.get('method', 'plain')), condenses]
+
+    # map after all lines are booked
+    if 'map' in config:
+        _map = config['map']
+        _time = _map.get('time', 2001001)
+        what = _map.get('map', 'net')
+        tasks['map'] = ['map', dict(pattern='carbon_r*.npz', _time=_time,
+                        map=what, img=_map['img'], ori=carbon,
+                        des=os.path.join(des, _map.get('des',
+                                        'map_{}_{}.tif'.format(what, _time))),
+                        overwrite=overwrite), books]
+
+    # audit mass balance after all lines are booked
+    if 'audit' in config:
+        _audit = config['audit']
+        tasks['audit'] = ['audit', dict(pattern='carbon_r*.npz', ori=carbon,
+                            des=os.path.join(des, _audit.get('des',
+                                                            'audit.csv')),
+                            tolerance=_audit.get('tolerance',
+                                                    cons.AUDIT_TOLERANCE),
+                            overwrite=True), books]
+    return tasks
+
+
+def run_tasks(tasks, workers=1):
+    """ run tasks as soon as their dependencies are done
+
+    Args:
+        tasks (dict): [stage, kwargs, dependencies] of each task, ordered so
+                        that every task comes after its dependencies
+        workers (int): number of worker processes, 1 to run in this process
+
+    Returns:
+        failed (list, str): tasks that failed or were skipped
+
+    """
+    status = {}
+
+    def check(name):
+        deps = [status.get(x) for x in tasks[name][2]]
+        if any([(x is not None) and (x != 0) for x in deps]):
+            log.warning('Skipped {}, dependency failed.'.format(name))
+            status[name] = -1
+            return False
+        return all([x == 0 for x in deps])
+
+    def finish(name, result):
+        status[name] = result
+        if result == 0:
+            log.info('Finished {}.'.format(name))
+        else:
+            log.warning('Failed {} with {}.'.format(name, result))
+
+    # run in this process
+    if workers <= 1:
+        for name, (stage, kwargs, deps) in tasks.items():
+            if check(name):
+                log.info('Running {}...'.format(name))
+                try:
+                    finish(name, run_stage(stage, kwargs))
+                except Exception as error:
+                    log.warning('{} raised {}'.format(name, error))
+                    finish(name, 99)
+        return [x for x in tasks if status[x] != 0]
+
+    # run in a pool of processes
+    from concurrent.futures import (ProcessPoolExecutor, wait,
+                                    FIRST_COMPLETED)
+    running = {}
+    with ProcessPoolExecutor(workers) as executor:
+        while len(status) < len(tasks):
+            for name, (stage, kwargs, deps) in tasks.items():
+                if (name in status) or (name in running.values()):
+                    continue
+                if check(name):
+                    log.info('Submitting {}...'.format(name))
+                    running[executor.submit(run_stage, stage, kwargs)] = name
+            if len(running) == 0:
+                break
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    finish(name, future.result())
+                except Exception as error:
+                    log.warning('{} raised {}'.format(name, error))
+                    finish(name, 99)
+    return [x for x in tasks if status.get(x, -1) != 0]
+
+
+def run_config(_file, workers=None, overwrite=False):
+    """ run a workflow from a configuration file
+
+    Args:
+        _file (str): path to configuration file
+        workers (int): number of worker processes, None to use config
+        overwrite (bool): overwrite or not, in addition to config
+
+    Returns:
+        0: successful
+        1: error reading configuration
+        2: error planning tasks or creating outputs
+        3: nothing to run
+        4: some task failed
+
+    """
+    # read configuration
+    log.info('Reading configuration...')
+    try:
+        config = read_config(_file)
+    except:
+        log.error('Failed to read configuration {}'.format(_file))
+        return 1
+    if workers is None:
+        workers = config.get('workers', 1)
+    if overwrite:
+        config['overwrite'] = True
+
+    # build dependency graph
+    log.info('Planning tasks...')
+    try:
+        tasks = plan_tasks(config)
+    except:
+        log.error('Failed to plan tasks.')
+        return 2
+    if len(tasks) == 0:
+        log.error('Nothing to run.')
+        return 3
+    log.info('Planned {} tasks.'.format(len(tasks)))
+
+    # create outputs up front so that workers do not race to create them
+    try:
+        for x in ['carbon', 'report', 'condensed']:
+            os.makedirs(os.path.join(config['des'], x), exist_ok=True)
+    except:
+        log.error('Cannot create output folder {}'.format(config['des']))
+        return 2
+
+    # condensed reports of a previous run would be summed twice
+    if 'condense' in config:
+        condensed = os.path.join(config['des'], 'condensed')
+        for x in get_files(condensed, 'condensed_r*.npz', False):
+            os.remove(os.path.join(x[0], x[1]))
+
+    # run tasks
+    log.info('Running with {} workers...'.format(workers))
+    failed = run_tasks(tasks, workers)
+    if len(failed) > 0:
+        log.error('{} tasks failed or skipped: {}'.format(len(failed),
+                                                        ', '.join(failed)))
+        return 4
+
+    # done
+    log.info('Process completed.')
+    return 0
+
+
+if __name__ == '__main__':
+    # parse options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', action='store', type=int,
+                        dest='workers', default=None,
+                        help='number of worker processes')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite or not')
+    parser.add_argument('config', help='configuration file')
+    args = parser.parse_args()
+
+    # print logs
+    log.info('Start running workflow...')
+    log.info('Configuration {}'.format(args.config))
+    if args.workers is not None:
+        log.info('Running with {} workers.'.format(args.workers))
+    if args.overwrite:
+        log.info('Overwriting old files.')
+
+    # run workflow
+    sys.exit(run_config(args.config, args.workers, args.overwrite))
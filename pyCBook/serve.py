@@ -0,0 +1,375 @@
+""" Module for serving bookkeeping results to interactive queries
+
+    A long lived local HTTP server keeps parameters and recently used lines
+    in memory and answers queries in JSON:
+        /pixel?px=&py=[&start=&end=&lapse=]: report of a pixel
+        /state?px=&py=&date=: biomass and net flux of each pool of a pixel
+        /region?px=x0,x1&py=y0,y1[&start=&end=&lapse=]: report of a region
+        /book?px=&py=[&start=&end=&lapse=]: rerun bookkeeping of a pixel
+        /stats: cache statistics
+
+    Args:
+        -p (port): port on localhost
+        -s (socket): unix socket to listen on instead of a port
+        -c (cache): number of lines to keep in memory
+        -i (inputs): YATSM results for rerunning bookkeeping
+        -P (para): parameter files location for rerunning bookkeeping
+        ori: origin
+
+"""
+import os
+import sys
+import json
+import argparse
+import threading
+import numpy as np
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from socketserver import ThreadingMixIn, UnixStreamServer
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .common import log, get_files, get_int
+from .io import (csv2ndarray, carbon2pixels, yatsm2pixels, store, is_store)
+from .carbon import carbon, pools
+from .common import constants as cons
+
+
+class line_cache:
+    """ least recently used cache of bookkeeping results by line
+
+    Args:
+        ori (str): place to look for bookkeeping results
+        size (int): maximum number of lines to keep
+
+    Variables:
+        ori: place to look for bookkeeping results
+        size: maximum number of lines to keep
+        lines: freshness key and pixels of cached lines, the key is the
+                mtime of the file or the index entries of the line in a
+                store, most recently used last
+        store: carbon store at ori, None for npz files
+        hits: number of queries answered from memory
+        misses: number of lines read from disk
+
+    Functions:
+        get (py): get pools of each pixel in a line, None if not found
+        stats (): cache statistics
+
+    """
+    def __init__(self, ori, size=cons.SERVE_CACHE):
+        self.ori = ori
+        self.size = max(size, 1)
+        self.lines = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.store = store(ori) if is_store(ori) else None
+
+    def get(self, py):
+        _file = os.path.join(self.ori, 'carbon_r{}.npz'.format(py))
+        if self.store is not None:
+            # offsets of the line change whenever it is written again
+            index = self.store.index(py // self.store.chunk)
+            if (py, 0) not in index:
+                return None
+            key = tuple([tuple(index.get((py, k), []))
+                            for k in range(len(self.store.kinds))])
+        elif os.path.isfile(_file):
+            key = os.path.getmtime(_file)
+        else:
+            return None
+        with self.lock:
+            if (py in self.lines) and (self.lines[py][0] == key):
+                self.lines.move_to_end(py)
+                self.hits += 1
+                return self.lines[py][1]
+        pixels = carbon2pixels(_file)
+        with self.lock:
+            self.misses += 1
+            self.lines[py] = [key, pixels]
+            self.lines.move_to_end(py)
+            while len(self.lines) > self.size:
+                self.lines.popitem(last=False)
+        return pixels
+
+    def stats(self):
+        with self.lock:
+            return {'lines': list(self.lines), 'size': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+def table2json(table):
+    """ convert a structured array to columns for JSON
+
+    Args:
+        table (ndarray): structured array
+
+    Returns:
+        columns (dict): list of values of each field
+
+    """
+    return dict([(x, table[x].tolist()) for x in table.dtype.names])
+
+
+def query_pixel(lines, px, py, period=[2000001, 2015365], lapse=1):
+    """ report of a pixel
+
+    Args:
+        lines (line_cache): cached bookkeeping results
+        px (int): pixel x location
+        py (int): pixel y location
+        period (list, int): reporting time period, [start, end]
+        lapse (int): reporting interval
+
+    Returns:
+        report (ndarray): report of the pixel, None if not found
+
+    """
+    pixels = lines.get(py)
+    if (pixels is None) or (px not in pixels):
+        return None
+    return pools(pixels[px]).report_interval([[period, lapse]])[0]
+
+
+def query_state(lines, px, py, t):
+    """ biomass and net flux of each pool of a pixel at date t
+
+    Args:
+        lines (line_cache): cached bookkeeping results
+        px (int): pixel x location
+        py (int): pixel y location
+        t (int): date
+
+    Returns:
+        state (dict): pools of the pixel and their values, None if not found
+
+    """
+    pixels = lines.get(py)
+    if (pixels is None) or (px not in pixels):
+        return None
+    _pools = pixels[px]
+    biomass, net = pools(_pools).eval(t)
+    state = dict([(x, _pools[x].tolist()) for x in ['pool', 'subpool',
+                    'class', 'start', 'end']])
+    state['biomass'] = [float(x) for x in biomass]
+    state['net'] = [float(x) for x in net]
+    return state
+
+
+def query_region(lines, px, py, period=[2000001, 2015365], lapse=1):
+    """ total report of all pixels in a region
+
+    Args:
+        lines (line_cache): cached bookkeeping results
+        px (list, int): first and last pixel x location
+        py (list, int): first and last pixel y location
+        period (list, int): reporting time period, [start, end]
+        lapse (int): reporting interval
+
+    Returns:
+        report (ndarray): total report of the region, None if empty
+        n (int): number of pixels in the region
+
+    """
+    if py[1] - py[0] + 1 > lines.size:
+        raise ValueError('Region is larger than the line cache.')
+    found = []
+    for y in range(py[0], py[1] + 1):
+        pixels = lines.get(y)
+        if pixels is not None:
+            found.extend([pixels[x] for x in sorted(pixels)
+                            if px[0] <= x <= px[1]])
+    if len(found) == 0:
+        return None, 0
+    return (pools(np.concatenate(found)).report_interval([[period,
+                                                            lapse]])[0],
+            len(found))
+
+
+def book_pixel(p, inputs, px, py, period=[2000001, 2015365], lapse=1):
+    """ rerun bookkeeping of a pixel with parameters kept in memory
+
+    Args:
+        p (list): parameters, biomass, flux and product
+        inputs (dict): YATSM result file of each line
+        px (int): pixel x location
+        py (int): pixel y location
+        period (list, int): reporting time period, [start, end]
+        lapse (int): reporting interval
+
+    Returns:
+        report (ndarray): report of the pixel, None if not found
+
+    """
+    if py not in inputs:
+        return None
+    pixel = yatsm2pixels(inputs[py], px)
+    if len(pixel) == 0:
+        return None
+    _pools = carbon(p, pixel[0]).pools
+    return pools(np.array(_pools, dtype=cons.DTYPES)).report_interval(
+                                                    [[period, lapse]])[0]
+
+
+class handler(BaseHTTPRequestHandler):
+    """ answer queries on bookkeeping results in JSON
+
+    Attributes:
+        lines (line_cache): cached bookkeeping results
+        p (list): parameters, None if bookkeeping is not served
+        inputs (dict): YATSM result file of each line
+
+    Functions:
+        do_GET (): answer a query
+        reply (code, body): send a JSON response
+
+    """
+    lines = None
+    p = None
+    inputs = {}
+
+    def reply(self, code, body):
+        body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        q = dict([(x, y[0]) for x, y in parse_qs(url.query).items()])
+        try:
+            period = [int(q.get('start', 2000001)), int(q.get('end', 2015365))]
+            lapse = int(q.get('lapse', 1))
+            if url.path == '/stats':
+                return self.reply(200, self.lines.stats())
+            elif url.path == '/region':
+                px = [int(x) for x in q['px'].split(',')]
+                py = [int(x) for x in q['py'].split(',')]
+                r, n = query_region(self.lines, px, py, period, lapse)
+                if r is None:
+                    return self.reply(404, {'error': 'Found no pixel.'})
+                return self.reply(200, {'pixels': n, 'report': table2json(r)})
+            px = int(q['px'])
+            py = int(q['py'])
+            if url.path == '/pixel':
+                r = query_pixel(self.lines, px, py, period, lapse)
+                r = None if r is None else table2json(r)
+            elif url.path == '/state':
+                r = query_state(self.lines, px, py, int(q['date']))
+            elif (url.path == '/book') and (self.p is not None):
+                r = book_pixel(self.p, self.inputs, px, py, period, lapse)
+                r = None if r is None else table2json(r)
+            else:
+                return self.reply(404, {'error': 'Unknown query.'})
+        except (KeyError, ValueError) as error:
+            return self.reply(400, {'error': 'Bad query: {}'.format(error)})
+        except Exception as error:
+            log.warning('Failed to answer {}'.format(self.path))
+            return self.reply(500, {'error': str(error)})
+        if r is None:
+            return self.reply(404, {'error': 'Can not find pixel {} {}'.format(
+                                                                    px, py)})
+        return self.reply(200, r)
+
+    def log_message(self, format, *args):
+        log.info(format % args)
+
+
+class unix_server(ThreadingMixIn, UnixStreamServer):
+    """ threaded HTTP server on a unix socket
+    """
+    daemon_threads = True
+
+    def get_request(self):
+        request, address = super().get_request()
+        return request, ['local', 0]
+
+
+def serve(ori, port=cons.SERVE_PORT, socket='NA', size=cons.SERVE_CACHE,
+            inputs='NA', para='NA'):
+    """ serve bookkeeping results until interrupted
+
+    Args:
+        ori (str): place to look for bookkeeping results
+        port (int): port on localhost
+        socket (str): unix socket to listen on, NA for a port
+        size (int): number of lines to keep in memory
+        inputs (str): YATSM results for rerunning bookkeeping, NA for none
+        para (str): parameter files location for rerunning bookkeeping
+
+    Returns:
+        0: successful
+        1: error reading parameters or inputs
+        2: error starting server
+
+    """
+    # reading parameters and inputs once
+    handler.lines = line_cache(ori, size)
+    if (inputs != 'NA') and (para != 'NA'):
+        log.info('Reading parameters...')
+        try:
+            handler.p = [csv2ndarray(os.path.join(para, 'biomass.csv')),
+                            csv2ndarray(os.path.join(para, 'flux.csv')),
+                            csv2ndarray(os.path.join(para, 'product.csv'))]
+            handler.inputs = dict([(get_int(x[1])[0], os.path.join(x[0], x[1]))
+                                    for x in get_files(inputs, 'yatsm_r*.npz')])
+        except:
+            log.error('Failed to read parameter from {}'.format(para))
+            return 1
+
+    # start server
+    try:
+        if socket != 'NA':
+            if os.path.exists(socket):
+                os.remove(socket)
+            server = unix_server(socket, handler)
+            log.info('Listening on {}'.format(socket))
+        else:
+            server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+            log.info('Listening on http://127.0.0.1:{}'.format(port))
+    except:
+        log.error('Failed to start server.')
+        return 2
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('Shutting down...')
+    finally:
+        server.server_close()
+        if socket != 'NA':
+            os.remove(socket)
+
+    # done
+    log.info('Process completed.')
+    return 0
+
+
+if __name__ == '__main__':
+    # parse options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', action='store', type=int, dest='port',
+                        default=cons.SERVE_PORT, help='port on localhost')
+    parser.add_argument('-s', '--socket', action='store', type=str,
+                        dest='socket', default='NA', help='unix socket')
+    parser.add_argument('-c', '--cache', action='store', type=int,
+                        dest='size', default=cons.SERVE_CACHE,
+                        help='number of lines to keep in memory')
+    parser.add_argument('-i', '--inputs', action='store', type=str,
+                        dest='inputs', default='NA', help='YATSM results')
+    parser.add_argument('-P', '--para', action='store', type=str,
+                        dest='para', default='NA', help='parameters')
+    parser.add_argument('ori', default='./', help='origin')
+    args = parser.parse_args()
+
+    # print logs
+    log.info('Start serving bookkeeping results...')
+    log.info('From {}'.format(args.ori))
+    log.info('Keeping {} lines in memory.'.format(args.size))
+    if args.inputs != 'NA':
+        log.info('Rerunning bookkeeping from {}'.format(args.inputs))
+
+    # run server
+    sys.exit(serve(args.ori, args.port, args.socket, args.size, args.inputs,
+                    args.para))
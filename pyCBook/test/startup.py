@@ -0,0 +1,85 @@
+""" Module for benchmarking start up time of entry points
+
+    Args:
+        -l (limit): maximum import time in seconds
+        -r (repeat): number of runs for each entry point
+
+"""
+import sys
+import argparse
+import subprocess
+
+from ..common import log
+
+
+ENTRIES = ['pyCBook.book', 'pyCBook.report', 'pyCBook.area',
+            'pyCBook.extract', 'pyCBook.run', 'pyCBook.audit']
+HEAVY = ['matplotlib', 'osgeo']
+
+
+def import_time(module, repeat=5):
+    """ measure time to import a module in a fresh interpreter
+
+    Args:
+        module (str): module to import
+        repeat (int): number of runs
+
+    Returns:
+        t (float): shortest import time in seconds
+        heavy (list, str): heavy modules loaded by the import
+
+    """
+    code = ('import sys, time; t = time.time(); import {}; '
+            'print(time.time() - t); '
+            'print(",".join([x for x in {} if x in sys.modules]))')
+    t = []
+    for i in range(0, repeat):
+        out = subprocess.check_output([sys.executable, '-c',
+                                        code.format(module, HEAVY)])
+        out = out.decode().strip().split('\n')
+        t.append(float(out[0]))
+        heavy = [x for x in out[1:] if x != '']
+    return min(t), heavy
+
+
+def check_startup(entries=ENTRIES, limit=0.5, repeat=5):
+    """ check that entry points start fast and load no heavy modules
+
+    Args:
+        entries (list, str): entry points to check
+        limit (float): maximum import time in seconds
+        repeat (int): number of runs for each entry point
+
+    Returns:
+        0: successful
+        1: some entry point is too slow or loads heavy modules
+
+    """
+    failed = 0
+    for module in entries:
+        t, heavy = import_time(module, repeat)
+        if len(heavy) > 0:
+            log.error('{} loads {}'.format(module, ', '.join(heavy)))
+            failed = 1
+        elif t > limit:
+            log.error('{} takes {:.3f}s to import'.format(module, t))
+            failed = 1
+        else:
+            log.info('{} takes {:.3f}s to import'.format(module, t))
+    return failed
+
+
+if __name__ == '__main__':
+    # parse options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--limit', action='store', type=float,
+                        dest='limit', default=0.5,
+                        help='maximum import time in seconds')
+    parser.add_argument('-r', '--repeat', action='store', type=int,
+                        dest='repeat', default=5,
+                        help='number of runs for each entry point')
+    args = parser.parse_args()
+
+    # run benchmark
+    log.info('Benchmarking start up time...')
+    sys.exit(check_startup(ENTRIES, args.limit, args.repeat))
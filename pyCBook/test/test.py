@@ -92,10 +92,8 @@ class test:
     def rerun(self):
         book.book_carbon('yatsm_r*.npz', self.input, self.para, self.output,
                             'NA', 'NA', True, True)
-        rpt.report_line('carbon_r*.npz', [1990001, 2015365], self.output,
-                        self.daily, 1, True)
-        rpt.report_line('carbon_r*.npz', [1990, 2016], self.output, self.annual,
-                        1, True)
+        rpt.report_line('carbon_r*.npz', [[1990001, 2015365, 1], [1990, 2016, 1]],
+                        self.output, [self.daily, self.annual], 1, True)
         rpt.report_sum('report_r*.npz', self.daily, os.path.join(self.report,
                         'daily.csv'), True, True)
         rpt.report_sum('report_r*.npz', self.annual, os.path.join(self.report,